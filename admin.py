@@ -1,15 +1,30 @@
 import logging
-import asyncio
-import time
+import os
+import tempfile
+from datetime import datetime
 from functools import wraps
-from telegram import Update
+from html import escape
+from telegram import InputFile, Update
 from telegram.ext import ContextTypes
-from telegram.error import TelegramError
 from config import ADMIN_ID
+import broadcast
 import database
+import user_dump
 
 logger = logging.getLogger(__name__)
 
+# Bot API отдает боту файлы до 20 МБ; большие файлы загружаются через user_dump.py
+MAX_IMPORT_FILE_SIZE = 20 * 1024 * 1024
+
+async def _resolve_user(arg: str) -> int:
+    """id пользователя из аргумента команды: число, @username или ник"""
+    if arg.lstrip("-").isdigit():
+        return int(arg)
+    user_id = await database.find_user_id(arg.removeprefix("@"))
+    if user_id is None:
+        raise ValueError(f"Пользователь {arg} не найден")
+    return user_id
+
 def admin_only(func):
     @wraps(func)
     async def wrapped(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
@@ -28,14 +43,18 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/add_balance <code>[user_id] [amount]</code> - Начислить баланс\n"
         "/sub_balance <code>[user_id] [amount]</code> - Списать баланс\n"
         "/broadcast <code>[message]</code> - Сделать рассылку\n"
-        "/server_stats - Показать статистику сервера"
+        "/server_stats - Показать статистику сервера\n"
+        "/history <code>[user_id]</code> - История операций и сверка баланса\n"
+        "/export <code>[csv|jsonl]</code> - Выгрузить пользователей файлом\n"
+        "/import - Загрузить пользователей: ответом на файл .csv или .jsonl (можно .gz)\n\n"
+        "Вместо <code>user_id</code> можно указать @username или ник."
     )
     await update.message.reply_html(text)
 
 @admin_only
 async def check_user_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        target_id = int(context.args[0])
+        target_id = await _resolve_user(context.args[0])
         balance = await database.get_user_balance(target_id)
         await update.message.reply_text(f"Баланс пользователя {target_id}: {balance} руб.")
     except (IndexError, ValueError):
@@ -44,10 +63,11 @@ async def check_user_balance(update: Update, context: ContextTypes.DEFAULT_TYPE)
 @admin_only
 async def add_to_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        target_id = int(context.args[0])
+        target_id = await _resolve_user(context.args[0])
         amount = int(context.args[1])
-        await database.update_user_balance(target_id, amount, relative=True)
-        new_balance = await database.get_user_balance(target_id)
+        new_balance = await database.update_user_balance(
+            target_id, amount, relative=True, tx_type="admin_add", ref=str(update.effective_user.id)
+        )
         await update.message.reply_text(f"Баланс пользователя {target_id} пополнен на {amount}. Новый баланс: {new_balance} руб.")
     except (IndexError, ValueError):
         await update.message.reply_text("Использование: /add_balance [user_id] [amount]")
@@ -55,21 +75,89 @@ async def add_to_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
 @admin_only
 async def subtract_from_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        target_id = int(context.args[0])
+        target_id = await _resolve_user(context.args[0])
         amount = int(context.args[1])
-        await database.update_user_balance(target_id, -amount, relative=True)
-        new_balance = await database.get_user_balance(target_id)
+        new_balance = await database.update_user_balance(
+            target_id, -amount, relative=True, tx_type="admin_sub", ref=str(update.effective_user.id)
+        )
         await update.message.reply_text(f"С баланса пользователя {target_id} списано {amount}. Новый баланс: {new_balance} руб.")
     except (IndexError, ValueError):
         await update.message.reply_text("Использование: /sub_balance [user_id] [amount]")
 
-async def send_message_to_user(bot, user_id: int, message: str) -> bool:
+@admin_only
+async def show_user_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        target_id = await _resolve_user(context.args[0])
+    except (IndexError, ValueError):
+        await update.message.reply_text("Использование: /history [user_id]")
+        return
+
+    transactions = await database.get_user_transactions(target_id, 10)
+    balance = await database.get_user_balance(target_id)
+    reconstructed = await database.reconstruct_balance(target_id)
+
+    lines = [f"<b>История операций пользователя {target_id}</b>\n"]
+    for tx in transactions:
+        created = datetime.fromtimestamp(tx['created_at']).strftime("%d.%m %H:%M")
+        ref = f" ({escape(tx['ref'])})" if tx['ref'] else ""
+        lines.append(f"{created} {tx['type']}{ref}: <b>{tx['amount']:+d}</b> → {tx['balance_after']}")
+    if not transactions:
+        lines.append("Операций нет.")
+    check = "✅" if reconstructed == balance else "❗️"
+    lines.append(f"\nБаланс: <b>{balance}</b> руб. | По журналу: <b>{reconstructed}</b> руб. {check}")
+    await update.message.reply_html("\n".join(lines))
+
+@admin_only
+async def export_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    fmt = context.args[0].lower() if context.args else "csv"
+    if fmt not in user_dump.FORMATS:
+        await update.message.reply_text("Использование: /export [csv|jsonl]")
+        return
+
+    status_msg = await update.message.reply_text("⏳ Выгружаю пользователей...")
+    # Сжатая выгрузка миллиона пользователей укладывается в лимит Telegram на документы (50 МБ)
+    filename = f"users_{datetime.now():%Y%m%d_%H%M%S}.{fmt}.gz"
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, filename)
+        count = await user_dump.export_file(path, fmt)
+        with open(path, "rb") as f:
+            # Файл передается HTTP-клиенту потоком, а не читается в память целиком
+            await update.message.reply_document(
+                InputFile(f, filename=filename, read_file_handle=False),
+                caption=f"Пользователей: {count}"
+            )
+    await status_msg.delete()
+    logger.info("Выгружено пользователей: %s", count)
+
+@admin_only
+async def import_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    # Команда в подписи к файлу или ответом на сообщение с файлом
+    document = message.document or (message.reply_to_message and message.reply_to_message.document)
+    if not document:
+        await message.reply_text("Отправьте файл .csv или .jsonl с подписью /import или ответьте на него командой /import.")
+        return
     try:
-        await bot.send_message(chat_id=user_id, text=message, parse_mode='HTML')
-        return True
-    except TelegramError as e:
-        logger.error(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
-        return False
+        fmt = user_dump.detect_format(document.file_name or "")
+    except ValueError as e:
+        await message.reply_text(str(e))
+        return
+    if document.file_size and document.file_size > MAX_IMPORT_FILE_SIZE:
+        await message.reply_text("Файл больше 20 МБ: сожмите его в .gz или загрузите через user_dump.py.")
+        return
+
+    status_msg = await message.reply_text("⏳ Загружаю пользователей...")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, os.path.basename(document.file_name))
+        telegram_file = await document.get_file()
+        await telegram_file.download_to_drive(path)
+        try:
+            count = await user_dump.import_file(path, fmt, ref=str(update.effective_user.id))
+        except ValueError as e:
+            await status_msg.edit_text(f"❌ Файл не загружен: {e}")
+            return
+    await status_msg.edit_text(f"✅ Загружено пользователей: {count}")
+    logger.info("Загружено пользователей: %s", count)
 
 @admin_only
 async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -78,24 +166,12 @@ async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Пожалуйста, укажите текст для рассылки. /broadcast [текст]")
         return
 
-    await update.message.reply_text("⏳ Начинаю рассылку...")
-    start_time = time.time()
-    
-    user_ids = await database.get_all_user_ids()
-    tasks = [send_message_to_user(context.bot, user_id, message_to_send) for user_id in user_ids]
-    results = await asyncio.gather(*tasks)
-    
-    end_time = time.time()
-    duration = end_time - start_time
-    
-    success_count = sum(results)
-    fail_count = len(user_ids) - success_count
-    
-    await update.message.reply_text(
-        f"✅ Рассылка завершена за {duration:.2f} сек.\n"
-        f"Успешно отправлено: {success_count}\n"
-        f"Не удалось отправить: {fail_count}"
+    status_msg = await update.message.reply_text("⏳ Начинаю рассылку...")
+    # Рассылка идет в фоне с ограничением скорости, прогресс обновляется в status_msg
+    broadcast_id = await broadcast.start_broadcast(
+        context.bot, message_to_send, update.effective_chat.id, status_msg.message_id
     )
+    logger.info("Запущена рассылка #%s", broadcast_id)
 
 @admin_only
 async def show_server_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -124,5 +200,33 @@ async def show_server_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"💰 Средний баланс на игрока: <b>{avg_balance:.2f}</b> руб.\n"
         f"🎮 Среднее кол-во игр на игрока: <b>{avg_games:.2f}</b>"
     )
-    
-    await update.message.reply_html(text)
\ No newline at end of file
+
+    cache = database.get_user_cache_stats()
+    if cache:
+        lookups = cache['hits'] + cache['misses']
+        hit_rate = cache['hits'] / lookups * 100 if lookups else 0
+        text += (
+            f"\n\n<b>Кэш балансов:</b>\n"
+            f"🗄️ Записей: <b>{cache['size']}</b>, попаданий: <b>{hit_rate:.1f}%</b> "
+            f"({cache['hits']} / {lookups})"
+        )
+
+    await update.message.reply_html(text)
+
+async def recompute_global_stats_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Периодическая сверка поддерживаемой статистики с полным пересчетом"""
+    drift = await database.recompute_global_stats()
+    if drift:
+        logger.warning("Расхождение общей статистики исправлено: %s", drift)
+
+async def snapshot_balances_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Периодические снимки балансов для быстрой сверки по журналу операций"""
+    created = await database.snapshot_balances()
+    if created:
+        logger.info("Создано снимков балансов: %s", created)
+
+async def build_indexes_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Построение индексов из миграций после запуска, не задерживая его"""
+    built = await database.build_indexes()
+    if built:
+        logger.info("Построены индексы: %s", ", ".join(built))
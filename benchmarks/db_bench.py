@@ -0,0 +1,221 @@
+"""Микробенчмарк функций database.py на базах разного размера.
+
+Для каждого размера (по умолчанию 10k, 100k и 1M пользователей) создает базу со
+схемой init_db, заполняет ее синтетическими пользователями и замеряет функции
+горячих путей под параллельной нагрузкой из нескольких задач asyncio. Результаты
+(операций в секунду, p50/p95/p99/макс) печатаются и записываются в JSON, чтобы
+сравнивать прогоны до и после изменений.
+
+Пример:
+    python benchmarks/db_bench.py --sizes 10000 100000 --concurrency 16 --json db_bench.json
+
+Заполненные базы можно сохранить между прогонами (--seed-dir): каждый прогон
+работает с копией, поэтому записи бенчмарка не влияют на следующие прогоны.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Замеряем обращения к БД, а не кэш балансов; config читает переменные при импорте
+os.environ.setdefault("USER_CACHE_SIZE", "0")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+# Бенчмарку не нужны токены, но config требует их наличия
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:bench")
+os.environ.setdefault("YOOMONEY_WALLET", "bench")
+
+import database
+
+FIRST_USER_ID = 100000
+SEED_BATCH = 50000
+
+def seed_database(path: str, users: int, seed: int):
+    """Схема из init_db и users синтетическими данными"""
+    database.DB_NAME = path
+
+    async def create_schema():
+        await database.init_pool(1)
+        await database.init_db()
+        # В боте индексы строит фоновая задача после запуска
+        await database.build_indexes()
+        await database.close_pool()
+
+    asyncio.run(create_schema())
+    rng = random.Random(seed)
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=OFF")
+    for start in range(0, users, SEED_BATCH):
+        rows = []
+        for user_id in range(FIRST_USER_ID + start, FIRST_USER_ID + min(users, start + SEED_BATCH)):
+            games = rng.randint(0, 500)
+            wagered = games * rng.randint(1, 200)
+            rows.append((
+                user_id,
+                f"user{user_id}",
+                f"nick{user_id}" if rng.random() < 0.3 else None,
+                rng.randint(0, 100000),
+                games,
+                rng.randint(0, games),
+                wagered,
+                rng.randint(-wagered, wagered),
+            ))
+        db.executemany(
+            "INSERT INTO users (user_id, username, nickname, balance, games_played, games_won, total_wagered, net_profit) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        db.commit()
+    db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    db.close()
+
+def prepare_database(seed_dir: str, work_dir: str, users: int, seed: int) -> str:
+    seeded = os.path.join(seed_dir, f"seed_{users}_{seed}.db")
+    if not os.path.exists(seeded):
+        print(f"Заполнение базы на {users} пользователей...", flush=True)
+        started = time.perf_counter()
+        partial = seeded + ".tmp"
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(partial + suffix):
+                os.remove(partial + suffix)
+        seed_database(partial, users, seed)
+        os.replace(partial, seeded)
+        print(f"  готово за {time.perf_counter() - started:.1f} сек.", flush=True)
+    path = os.path.join(work_dir, f"bench_{users}.db")
+    shutil.copyfile(seeded, path)
+    return path
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def summarize(latencies: list[float], duration: float) -> dict:
+    values = sorted(latencies)
+    return {
+        "ops": len(values),
+        "ops_per_sec": round(len(values) / duration, 1),
+        "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3),
+    }
+
+async def _drain(rows) -> int:
+    count = 0
+    async for _ in rows:
+        count += 1
+    return count
+
+def operations(users: int) -> dict:
+    """Замеряемые операции: имя -> (доля от --ops, функция от случайного генератора)"""
+    def user_id(rng: random.Random) -> int:
+        return FIRST_USER_ID + rng.randrange(users)
+
+    return {
+        "get_user_balance": (1, lambda rng: database.get_user_balance(user_id(rng))),
+        "update_user_balance": (1, lambda rng: database.update_user_balance(user_id(rng), rng.randint(-100, 100), relative=True)),
+        "update_user_stats": (1, lambda rng: database.update_user_stats(user_id(rng), 10, rng.choice((0, 20)))),
+        "settle_bet": (1, lambda rng: database.settle_bet(user_id(rng), 1, rng.choice((0, 2)))),
+        "get_top_users": (0.25, lambda rng: database.get_top_users(50)),
+        "get_global_stats": (1, lambda rng: database.get_global_stats()),
+        # Полный проход по users: на больших базах заметно медленнее остальных
+        "iter_users": (0.005, lambda rng: _drain(database.iter_users())),
+    }
+
+async def run_operation(call, ops: int, concurrency: int, seed: int) -> dict:
+    latencies: list[float] = []
+    remaining = ops
+
+    async def worker(worker_id: int):
+        nonlocal remaining
+        rng = random.Random(seed * 1000 + worker_id)
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            await call(rng)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(min(concurrency, ops))))
+    return summarize(latencies, time.perf_counter() - started)
+
+async def bench_size(path: str, users: int, args: argparse.Namespace) -> dict:
+    database.DB_NAME = path
+    await database.init_pool(args.pool_size)
+    results = {}
+    try:
+        for name, (share, call) in operations(users).items():
+            if args.only and name not in args.only:
+                continue
+            ops = max(1, int(args.ops * share))
+            # Прогрев кэша страниц SQLite и подготовленных выражений
+            await run_operation(call, min(ops, args.concurrency), args.concurrency, args.seed)
+            results[name] = await run_operation(call, ops, args.concurrency, args.seed)
+            row = results[name]
+            print(
+                f"  {name:<22}{row['ops']:>8}{row['ops_per_sec']:>12.1f}"
+                f"{row['p50_ms']:>10.3f}{row['p95_ms']:>10.3f}{row['p99_ms']:>10.3f}{row['max_ms']:>10.3f}",
+                flush=True
+            )
+    finally:
+        await database.close_pool()
+    return results
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Бенчмарк функций database.py")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000], help="размеры баз, пользователей")
+    parser.add_argument("--ops", type=int, default=2000, help="операций на функцию (тяжелые функции — меньше)")
+    parser.add_argument("--concurrency", type=int, default=16, help="параллельных задач")
+    parser.add_argument("--pool-size", type=int, default=database.DB_POOL_SIZE, help="соединений в пуле")
+    parser.add_argument("--only", nargs="+", help="замерять только эти функции")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--seed-dir", help="каталог для заполненных баз (по умолчанию временный)")
+    parser.add_argument("--json", help="записать результаты в файл JSON")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    work_dir = tempfile.mkdtemp(prefix="casino-db-bench-")
+    seed_dir = args.seed_dir or work_dir
+    os.makedirs(seed_dir, exist_ok=True)
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "pool_size": args.pool_size,
+            "concurrency": args.concurrency,
+            "ops": args.ops,
+            "seed": args.seed,
+        },
+        "results": {},
+    }
+    try:
+        for users in args.sizes:
+            path = prepare_database(seed_dir, work_dir, users, args.seed)
+            print(f"\n{users} пользователей")
+            print(f"  {'':<22}{'операций':>8}{'в сек':>12}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'макс мс':>10}")
+            report["results"][str(users)] = asyncio.run(bench_size(path, users, args))
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    else:
+        print()
+        print(json.dumps(report, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
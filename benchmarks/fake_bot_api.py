@@ -0,0 +1,107 @@
+"""Локальная замена Bot API Telegram и API ЮMoney для нагрузочных тестов.
+
+Отвечает на методы, которые вызывает бот, правдоподобными объектами и считает
+вызовы. Задержка ответа имитирует сетевой путь до api.telegram.org.
+"""
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+from aiohttp import web
+
+BOT_ID = 1
+BOT_USERNAME = "casino_bench_bot"
+
+# Максимальное значение анимированного кубика по эмодзи
+DICE_MAX_VALUES = {"🎲": 6, "🎯": 6, "🎳": 6, "🏀": 5, "⚽": 5, "🎰": 64}
+
+def _int_field(form, name: str, default: int = 0) -> int:
+    try:
+        return int(form.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+class FakeBotApi:
+    """aiohttp-сервер с ответами Bot API (/bot<token>/<method>) и ЮMoney (/yoomoney/<method>)"""
+
+    def __init__(self, latency: float = 0.0, paid_labels: bool = True):
+        self.latency = latency
+        # Считать ли все платежи оплаченными при запросе истории ЮMoney
+        self.paid_labels = paid_labels
+        self.calls: Counter[str] = Counter()
+        self._message_id = 0
+        self._runner: web.AppRunner | None = None
+        self.port: int | None = None
+
+    @property
+    def bot_api_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    @property
+    def yoomoney_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/yoomoney"
+
+    async def start(self, port: int = 0):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._bot_method)
+        app.router.add_post("/yoomoney/{method}", self._yoomoney_method)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def _message(self, chat_id: int, **fields) -> dict:
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "Casino", "username": BOT_USERNAME},
+            **fields,
+        }
+
+    async def _bot_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        form = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        chat_id = _int_field(form, "chat_id")
+        if method == "getMe":
+            result = {
+                "id": BOT_ID, "is_bot": True, "first_name": "Casino", "username": BOT_USERNAME,
+                "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False,
+            }
+        elif method == "sendMessage":
+            result = self._message(chat_id, text=form.get("text", ""))
+        elif method == "sendDice":
+            emoji = form.get("emoji", "🎲")
+            result = self._message(chat_id, dice={"emoji": emoji, "value": random.randint(1, DICE_MAX_VALUES.get(emoji, 6))})
+        elif method == "editMessageText":
+            message_id = _int_field(form, "message_id")
+            result = self._message(chat_id, text=form.get("text", "")) | {"message_id": message_id}
+        else:
+            # answerCallbackQuery, deleteMessage, setWebhook и прочие методы без объекта в ответе
+            result = True
+        return web.json_response({"ok": True, "result": result}, dumps=lambda data: json.dumps(data, ensure_ascii=False))
+
+    async def _yoomoney_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[f"yoomoney:{method}"] += 1
+        form = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        operations = []
+        if method == "operation-history" and self.paid_labels and form.get("label"):
+            # Поступившая сумма не меньше любой запрошенной
+            operations.append({"status": "success", "label": form["label"], "direction": "in", "amount": "1000000.00"})
+        return web.json_response({"operations": operations})
@@ -0,0 +1,295 @@
+"""Нагрузочный тест обработчиков бота без обращения к Telegram.
+
+Запускает Application из main против локального FakeBotApi (Bot API и ЮMoney)
+и прогоняет синтетические сценарии от множества пользователей: /start, игра со
+ставкой, пополнение, навигация по меню, /top и рассылка. Обновления проходят
+тот же путь, что и в боте: PerUserUpdateProcessor и Application.process_update.
+Для каждого обработчика выводятся число вызовов, p50/p99 задержки и обновления
+в секунду.
+
+Пример:
+    python benchmarks/load_test.py --users 2000 --rounds 5 --latency-ms 20 --json results.json
+
+БД создается во временном каталоге, рабочая casino_bot.db не используется.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_bot_api import FakeBotApi, BOT_ID, BOT_USERNAME
+
+BENCH_TOKEN = "123456:bench"
+ADMIN_USER_ID = 1000
+FIRST_USER_ID = 100000
+START_BALANCE = 100000
+
+# Доли сценариев в одном раунде пользователя
+SCENARIO_WEIGHTS = {"game": 60, "navigation": 20, "top": 10, "deposit": 10}
+
+def configure_environment(args: argparse.Namespace, api: FakeBotApi):
+    """Настройки бота для теста; задаются до импорта config"""
+    os.environ.update({
+        "TELEGRAM_TOKEN": BENCH_TOKEN,
+        "TELEGRAM_API_URL": api.bot_api_url,
+        "YOOMONEY_ACCESS_TOKEN": "bench",
+        "YOOMONEY_WALLET": "bench",
+        "ADMIN_ID": str(ADMIN_USER_ID),
+        "ADMIN_CHAT_ID": str(ADMIN_USER_ID),
+        "WEBHOOK_MODE": "false",
+        "WEBHOOK_WORKERS": "1",
+        "WORKER_ID": "0",
+        "DICE_ANIMATION_SECONDS": str(args.dice_delay),
+        "BROADCAST_RATE": str(args.broadcast_rate),
+        "LOG_LEVEL": args.log_level,
+        "RATE_LIMIT_RATE": str(args.rate_limit),
+    })
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def summarize(samples: list[float], duration: float) -> dict:
+    values = sorted(samples)
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3) if values else 0.0,
+        "per_sec": round(len(values) / duration, 1) if duration else 0.0,
+    }
+
+class UpdateFactory:
+    """Синтетические обновления Telegram в виде JSON"""
+
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._query_ids = itertools.count(1)
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+    @staticmethod
+    def _chat(user_id: int) -> dict:
+        return {"id": user_id, "type": "private"}
+
+    def message(self, user_id: int, text: str) -> dict:
+        message = {
+            "message_id": next(self._query_ids),
+            "date": int(time.time()),
+            "chat": self._chat(user_id),
+            "from": self._user(user_id),
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": next(self._update_ids), "message": message}
+
+    def callback(self, user_id: int, data: str) -> dict:
+        return {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._query_ids)),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": 1,
+                    "date": int(time.time()),
+                    "chat": self._chat(user_id),
+                    "from": {"id": BOT_ID, "is_bot": True, "first_name": "Casino", "username": BOT_USERNAME},
+                    "text": "menu",
+                },
+            },
+        }
+
+class LoadTest:
+    def __init__(self, application, args: argparse.Namespace):
+        self.application = application
+        self.args = args
+        self.updates = UpdateFactory()
+        # Задержки обработки обновлений по шагам сценариев и по обработчикам
+        self.steps: dict[str, list[float]] = defaultdict(list)
+        self.handlers: dict[str, list[float]] = defaultdict(list)
+        self._record_handlers(application.handlers.values())
+
+    def _record_handlers(self, groups):
+        from telegram.ext import ConversationHandler
+
+        for handlers in groups:
+            for handler in handlers:
+                if isinstance(handler, ConversationHandler):
+                    self._record_handlers([handler.entry_points, *handler.states.values(), handler.fallbacks])
+                else:
+                    self._record(handler)
+
+    def _record(self, handler):
+        callback = handler.callback
+        samples = self.handlers[f"{callback.__module__}.{callback.__qualname__}"]
+
+        async def recorded(update, context):
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            finally:
+                samples.append(time.perf_counter() - started)
+
+        handler.callback = recorded
+
+    async def send(self, step: str, data: dict):
+        from telegram import Update
+
+        update = Update.de_json(data, self.application.bot)
+        started = time.perf_counter()
+        # Тот же путь, что у обновлений из update_queue
+        await self.application.update_processor.process_update(update, self.application.process_update(update))
+        self.steps[step].append(time.perf_counter() - started)
+
+    async def scenario_game(self, user_id: int):
+        import games
+
+        await self.send("play", self.updates.callback(user_id, "play"))
+        await self.send("choose_game", self.updates.callback(user_id, f"game_{random.choice(list(games.GAMES))}"))
+        await self.send("bet", self.updates.message(user_id, str(random.randint(1, 100))))
+
+    async def scenario_navigation(self, user_id: int):
+        for data in ("balance", "back_to_start", "rules", "main_menu_from_nested"):
+            await self.send(data, self.updates.callback(user_id, data))
+
+    async def scenario_top(self, user_id: int):
+        await self.send("top", self.updates.callback(user_id, "top"))
+        await self.send("/top", self.updates.message(user_id, "/top"))
+
+    async def scenario_deposit(self, user_id: int):
+        await self.send("deposit", self.updates.callback(user_id, "deposit"))
+        await self.send("deposit_amount", self.updates.message(user_id, str(random.randint(100, 1000))))
+        await self.send("payment_confirmed", self.updates.callback(user_id, "payment_confirmed"))
+
+    async def simulate_user(self, user_id: int):
+        import database
+
+        await self.send("/start", self.updates.message(user_id, "/start"))
+        # Стартовый баланс не входит в замер: это подготовка данных
+        await database.update_user_balance(user_id, START_BALANCE)
+        scenarios = list(SCENARIO_WEIGHTS)
+        weights = list(SCENARIO_WEIGHTS.values())
+        for _ in range(self.args.rounds):
+            scenario = random.choices(scenarios, weights)[0]
+            await getattr(self, f"scenario_{scenario}")(user_id)
+
+    async def run_broadcast(self, api: FakeBotApi) -> dict:
+        import broadcast
+
+        sent_before = api.calls["sendMessage"]
+        started = time.perf_counter()
+        await self.send("/broadcast", self.updates.message(ADMIN_USER_ID, "/broadcast Нагрузочный тест"))
+        await asyncio.gather(*list(broadcast._tasks))
+        duration = time.perf_counter() - started
+        # Сообщения админу о ходе рассылки тоже идут через sendMessage, их единицы
+        messages = api.calls["sendMessage"] - sent_before
+        return {
+            "messages": messages,
+            "seconds": round(duration, 3),
+            "per_sec": round(messages / duration, 1) if duration else 0.0,
+        }
+
+async def run(args: argparse.Namespace) -> dict:
+    api = FakeBotApi(latency=args.latency_ms / 1000)
+    await api.start(args.port)
+    configure_environment(args, api)
+
+    import database
+    import payments
+    import main as bot_main
+
+    db_dir = tempfile.mkdtemp(prefix="casino-bench-")
+    database.DB_NAME = os.path.join(db_dir, "bench.db")
+    payments.YOOMONEY_API_URL = api.yoomoney_url
+
+    application = bot_main.build_application()
+    test = LoadTest(application, args)
+    results = {}
+
+    async def serve(application):
+        random.seed(args.seed)
+        started = time.perf_counter()
+        user_ids = range(FIRST_USER_ID, FIRST_USER_ID + args.users)
+        await asyncio.gather(*(test.simulate_user(user_id) for user_id in user_ids))
+        duration = time.perf_counter() - started
+
+        total = sum(len(samples) for samples in test.steps.values())
+        results["users"] = args.users
+        results["rounds"] = args.rounds
+        results["api_latency_ms"] = args.latency_ms
+        results["seconds"] = round(duration, 3)
+        results["updates"] = total
+        results["updates_per_sec"] = round(total / duration, 1)
+        results["handlers"] = {name: summarize(samples, duration) for name, samples in sorted(test.handlers.items()) if samples}
+        results["steps"] = {name: summarize(samples, duration) for name, samples in sorted(test.steps.items())}
+        if args.broadcast:
+            results["broadcast"] = await test.run_broadcast(api)
+
+    try:
+        await bot_main.run_application(application, serve)
+    finally:
+        await api.stop()
+        shutil.rmtree(db_dir, ignore_errors=True)
+    results["api_calls"] = dict(sorted(api.calls.items()))
+    return results
+
+def print_table(title: str, rows: dict):
+    print(f"\n{title}")
+    print(f"{'':<45}{'вызовов':>9}{'p50 мс':>10}{'p99 мс':>10}{'макс мс':>10}{'в сек':>10}")
+    for name, row in rows.items():
+        print(f"{name:<45}{row['count']:>9}{row['p50_ms']:>10.2f}{row['p99_ms']:>10.2f}{row['max_ms']:>10.2f}{row['per_sec']:>10.1f}")
+
+def print_report(results: dict):
+    print(
+        f"Пользователей: {results['users']}, раундов: {results['rounds']}, "
+        f"задержка API: {results['api_latency_ms']} мс"
+    )
+    print(f"Обновлений: {results['updates']} за {results['seconds']} сек. — {results['updates_per_sec']} в сек.")
+    print_table("Обработчики", results["handlers"])
+    print_table("Шаги сценариев (от передачи обновления до конца обработки)", results["steps"])
+    if "broadcast" in results:
+        broadcast = results["broadcast"]
+        print(f"\nРассылка: {broadcast['messages']} сообщений за {broadcast['seconds']} сек. — {broadcast['per_sec']} в сек.")
+    print("\nВызовы API:", ", ".join(f"{method}={count}" for method, count in results["api_calls"].items()))
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест обработчиков бота с локальным Bot API")
+    parser.add_argument("--users", type=int, default=1000, help="число пользователей")
+    parser.add_argument("--rounds", type=int, default=5, help="сценариев на пользователя после /start")
+    parser.add_argument("--latency-ms", type=float, default=0, help="задержка ответа Bot API и ЮMoney, мс")
+    parser.add_argument("--dice-delay", type=float, default=0, help="DICE_ANIMATION_SECONDS, сек.")
+    parser.add_argument("--no-broadcast", dest="broadcast", action="store_false", help="не запускать рассылку")
+    parser.add_argument("--broadcast-rate", type=float, default=1000, help="BROADCAST_RATE, сообщений в секунду")
+    parser.add_argument("--rate-limit", type=float, default=0,
+                        help="RATE_LIMIT_RATE; по умолчанию отключен, пользователи теста шлют запросы без пауз")
+    parser.add_argument("--port", type=int, default=0, help="порт Bot API (0 — любой свободный)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", help="записать результаты в файл JSON")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    results = asyncio.run(run(args))
+    print_report(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+from telegram import Bot
+from telegram.error import Forbidden, RetryAfter, TelegramError
+from config import BROADCAST_RATE, BROADCAST_PAGE_SIZE
+import database
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Интервал обновления сообщения о прогрессе рассылки, секунды
+PROGRESS_INTERVAL = 5
+# Сколько раз повторять отправку одному пользователю после RetryAfter
+MAX_RETRIES = 3
+
+SENT, FAILED, BLOCKED = "sent", "failed", "blocked"
+
+MESSAGES = metrics.Counter("broadcast_messages_total", "Сообщения рассылок по результату: sent, failed, blocked", ("result",))
+FLOOD_WAITS = metrics.Counter("broadcast_flood_waits_total", "Паузы рассылки из-за flood control")
+
+class TokenBucket:
+    """Ограничитель скорости: в среднем не больше rate отправок в секунду"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Приостановка всех отправок (flood wait от Telegram)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+async def send_message_to_user(bot: Bot, limiter: TokenBucket, user_id: int, message: str) -> str:
+    for _ in range(MAX_RETRIES + 1):
+        await limiter.acquire()
+        try:
+            await bot.send_message(chat_id=user_id, text=message, parse_mode='HTML')
+            return SENT
+        except RetryAfter as e:
+            delay = e.retry_after
+            seconds = delay.total_seconds() if isinstance(delay, timedelta) else delay
+            FLOOD_WAITS.inc()
+            logger.warning("Flood control при рассылке, пауза %s сек.", seconds)
+            limiter.pause(seconds)
+        except Forbidden:
+            return BLOCKED
+        except TelegramError as e:
+            logger.error("Не удалось отправить сообщение пользователю %s: %s", user_id, e)
+            return FAILED
+    return FAILED
+
+async def _report(bot: Bot, broadcast, text: str):
+    try:
+        await bot.edit_message_text(text, chat_id=broadcast['admin_chat_id'], message_id=broadcast['status_message_id'])
+    except TelegramError as e:
+        logger.warning("Не удалось обновить прогресс рассылки #%s: %s", broadcast['broadcast_id'], e)
+
+async def run_broadcast(bot: Bot, broadcast) -> None:
+    """Рассылка по страницам id с сохранением прогресса после каждой страницы"""
+    broadcast_id = broadcast['broadcast_id']
+    last_user_id = broadcast['last_user_id']
+    counters = {SENT: broadcast['sent'], FAILED: broadcast['failed'], BLOCKED: broadcast['blocked']}
+    limiter = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+    started = time.monotonic()
+    sent_at_start = counters[SENT]
+    last_report = started
+
+    while True:
+        user_ids = await database.get_user_ids_page(last_user_id, BROADCAST_PAGE_SIZE)
+        if not user_ids:
+            break
+        results = await asyncio.gather(*(
+            send_message_to_user(bot, limiter, user_id, broadcast['text']) for user_id in user_ids
+        ))
+        for result in results:
+            counters[result] += 1
+            MESSAGES.inc(result)
+        blocked_ids = [user_id for user_id, result in zip(user_ids, results) if result == BLOCKED]
+        if blocked_ids:
+            # Заблокировавших бота пропускаем в следующих рассылках
+            await database.mark_users_blocked(blocked_ids)
+        last_user_id = user_ids[-1]
+        await database.save_broadcast_progress(broadcast_id, last_user_id, counters[SENT], counters[FAILED], counters[BLOCKED])
+
+        now = time.monotonic()
+        if now - last_report >= PROGRESS_INTERVAL:
+            last_report = now
+            speed = (counters[SENT] - sent_at_start) / (now - started)
+            await _report(bot, broadcast, (
+                f"⏳ Рассылка #{broadcast_id} идет...\n"
+                f"Успешно отправлено: {counters[SENT]}\n"
+                f"Не удалось отправить: {counters[FAILED]}\n"
+                f"Заблокировали бота: {counters[BLOCKED]}\n"
+                f"Скорость: {speed:.1f} сообщ./сек."
+            ))
+
+    await database.save_broadcast_progress(
+        broadcast_id, last_user_id, counters[SENT], counters[FAILED], counters[BLOCKED], finished=True
+    )
+    duration = time.time() - broadcast['created_at']
+    await _report(bot, broadcast, (
+        f"✅ Рассылка завершена за {duration:.2f} сек.\n"
+        f"Успешно отправлено: {counters[SENT]}\n"
+        f"Не удалось отправить: {counters[FAILED]}\n"
+        f"Заблокировали бота: {counters[BLOCKED]}"
+    ))
+    logger.info("Рассылка #%s завершена: %s", broadcast_id, counters)
+
+# Запущенные рассылки, чтобы корректно остановить их при выключении
+_tasks: set[asyncio.Task] = set()
+
+async def _run_safely(bot: Bot, broadcast):
+    try:
+        await run_broadcast(bot, broadcast)
+    except asyncio.CancelledError:
+        logger.info("Рассылка #%s приостановлена, продолжится после перезапуска", broadcast['broadcast_id'])
+        raise
+    except Exception as e:
+        logger.error("Ошибка рассылки #%s: %s", broadcast['broadcast_id'], e)
+
+def _start_task(bot: Bot, broadcast):
+    task = asyncio.create_task(_run_safely(bot, broadcast))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+async def start_broadcast(bot: Bot, text: str, admin_chat_id: int, status_message_id: int) -> int:
+    """Создание рассылки и запуск ее в фоне"""
+    broadcast_id = await database.create_broadcast(text, admin_chat_id, status_message_id)
+    _start_task(bot, await database.get_broadcast(broadcast_id))
+    return broadcast_id
+
+async def resume_broadcasts(bot: Bot):
+    """Продолжение рассылок, прерванных перезапуском"""
+    for broadcast in await database.get_running_broadcasts():
+        logger.info("Продолжаем рассылку #%s с пользователя %s", broadcast['broadcast_id'], broadcast['last_user_id'])
+        _start_task(bot, broadcast)
+
+async def stop_broadcasts():
+    for task in list(_tasks):
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
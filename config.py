@@ -13,6 +13,8 @@ WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "False").lower() == "true"
 PORT = int(os.getenv("PORT", 10000))
 WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip('/')
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Адрес Bot API: можно указать локальный telegram-bot-api или тестовый сервер
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org/bot")
 
 MIN_DEPOSIT = int(os.getenv("MIN_DEPOSIT", 2))
 MAX_DEPOSIT = int(os.getenv("MAX_DEPOSIT", 100000))
@@ -25,3 +27,89 @@ if not YOOMONEY_WALLET:
 MIN_BET = int(os.getenv("MIN_BET", 1))
 MAX_BET = int(os.getenv("MAX_BET", 100000))
 MIN_WITHDRAWAL = int(os.getenv("MIN_WITHDRAWAL", 500))
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 4))
+
+# Отложенная запись игровой статистики
+STATS_FLUSH_INTERVAL_MS = int(os.getenv("STATS_FLUSH_INTERVAL_MS", 500))
+STATS_FLUSH_MAX_ROWS = int(os.getenv("STATS_FLUSH_MAX_ROWS", 500))
+
+# Параллельная обработка обновлений
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", 256))
+DICE_ANIMATION_SECONDS = float(os.getenv("DICE_ANIMATION_SECONDS", 3.5))
+# Лимит принятых, но еще не обработанных обновлений процесса (см. PerUserUpdateProcessor)
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 1000))
+
+# HTTP-клиент API ЮMoney
+YOOMONEY_TIMEOUT = float(os.getenv("YOOMONEY_TIMEOUT", 15))
+YOOMONEY_MAX_CONCURRENCY = int(os.getenv("YOOMONEY_MAX_CONCURRENCY", 10))
+YOOMONEY_RETRIES = int(os.getenv("YOOMONEY_RETRIES", 3))
+
+# Фоновая сверка платежей
+PAYMENT_POLL_INTERVAL = int(os.getenv("PAYMENT_POLL_INTERVAL", 60))
+PAYMENT_PENDING_TTL = int(os.getenv("PAYMENT_PENDING_TTL", 86400))
+# Комиссия ЮMoney за оплату картой, %: на кошелек поступает меньше запрошенной
+# суммы. Платеж, по которому поступило еще меньше, уходит на ручную проверку
+YOOMONEY_FEE_PERCENT = float(os.getenv("YOOMONEY_FEE_PERCENT", 3))
+
+# Рассылка: лимит Telegram ~30 сообщений в секунду
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", 100))
+
+# Таблица лидеров
+LEADERBOARD_SIZE = int(os.getenv("LEADERBOARD_SIZE", 10))
+LEADERBOARD_RESYNC_INTERVAL = int(os.getenv("LEADERBOARD_RESYNC_INTERVAL", 300))
+
+# Сверка общей статистики полным пересчетом
+GLOBAL_STATS_RECOMPUTE_INTERVAL = int(os.getenv("GLOBAL_STATS_RECOMPUTE_INTERVAL", 3600))
+
+# Снимки балансов для журнала операций
+BALANCE_SNAPSHOT_INTERVAL = int(os.getenv("BALANCE_SNAPSHOT_INTERVAL", 3600))
+
+# Несколько процессов-обработчиков в режиме вебхука (1 — один процесс)
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 1))
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", 1000))
+# Номер текущего процесса-обработчика, задается приемником при запуске
+WORKER_ID = int(os.getenv("WORKER_ID", 0))
+
+# Хранение состояния диалогов в БД
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv("PERSISTENCE_UPDATE_INTERVAL", 10))
+PERSISTENCE_MAX_USERS = int(os.getenv("PERSISTENCE_MAX_USERS", 50000))
+PERSISTENCE_IDLE_TTL = int(os.getenv("PERSISTENCE_IDLE_TTL", 3600))
+
+# Кэш балансов в памяти процесса (0 — отключен). С несколькими процессами-обработчиками
+# балансы меняются и в других процессах, поэтому кэш не используется
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 100000)) if not (WEBHOOK_MODE and WEBHOOK_WORKERS > 1) else 0
+
+# Выгрузка и загрузка пользователей (/export, /import, user_dump.py): строк в странице
+# чтения и в одной транзакции записи
+USER_TRANSFER_BATCH_SIZE = int(os.getenv("USER_TRANSFER_BATCH_SIZE", 1000))
+
+# Ограничение частоты запросов на пользователя (0 — отключено): токенов в секунду,
+# размер ведра и стоимость действий — данных кнопки или /команды, по умолчанию 1
+RATE_LIMIT_RATE = float(os.getenv("RATE_LIMIT_RATE", 1))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", 10))
+RATE_LIMIT_COSTS = {
+    action.strip(): float(cost)
+    for action, _, cost in (item.partition("=") for item in os.getenv(
+        "RATE_LIMIT_COSTS", "payment_confirmed=5,deposit=3,top=2,/top=2,/start=2"
+    ).split(","))
+    if action.strip()
+}
+
+# Метрики Prometheus на отдельном внутреннем порту (0 — отключены), не на
+# публичном порту вебхука. Если задан METRICS_TOKEN, запрос должен содержать
+# заголовок Authorization: Bearer <токен>
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9090))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# Логирование: уровень, формат (text или json) и доля записываемых событий
+# с большим потоком, например "bet=0.1,navigation=0.1"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_SAMPLE_RATES = {
+    event.strip(): float(rate)
+    for event, _, rate in (item.partition("=") for item in os.getenv("LOG_SAMPLE_RATES", "bet=0.1,navigation=0.1").split(","))
+    if event.strip()
+}
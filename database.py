@@ -1,91 +1,945 @@
+import asyncio
+import glob
+import os
+import time
 import aiosqlite
 import logging
+import metrics
+import migrations
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from functools import wraps
+from typing import AsyncIterator
+from config import (
+    DB_POOL_SIZE, STATS_FLUSH_INTERVAL_MS, STATS_FLUSH_MAX_ROWS, WORKER_ID, USER_CACHE_SIZE, USER_TRANSFER_BATCH_SIZE,
+)
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: блокировка файла БД между процессами недоступна
+    fcntl = None
 
 logger = logging.getLogger(__name__)
 DB_NAME = "casino_bot.db"
 
+# Прагмы, применяемые к каждому соединению пула
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+# Размер кэша подготовленных выражений sqlite3 на одно соединение
+STATEMENT_CACHE_SIZE = 256
+
+QUERY_SECONDS = metrics.Histogram("db_query_duration_seconds", "Время запросов к БД по функциям database", ("query",))
+POOL_WAIT_SECONDS = metrics.Histogram("db_pool_wait_seconds", "Ожидание свободного соединения из пула")
+
+def _timed(func):
+    """Замер времени функции, обращающейся к БД"""
+    @wraps(func)
+    async def wrapped(*args, **kwargs):
+        with QUERY_SECONDS.time(func.__name__):
+            return await func(*args, **kwargs)
+    return wrapped
+
+class ConnectionPool:
+    """Пул долгоживущих соединений aiosqlite"""
+
+    def __init__(self, db_name: str, size: int):
+        self.db_name = db_name
+        self.size = size
+        self._idle: asyncio.Queue = asyncio.Queue()
+        self._connections: list[aiosqlite.Connection] = []
+
+    async def open(self):
+        for _ in range(self.size):
+            db = await aiosqlite.connect(self.db_name, cached_statements=STATEMENT_CACHE_SIZE)
+            db.row_factory = aiosqlite.Row
+            for pragma in CONNECTION_PRAGMAS:
+                await db.execute(pragma)
+            self._connections.append(db)
+            self._idle.put_nowait(db)
+
+    @asynccontextmanager
+    async def acquire(self):
+        with POOL_WAIT_SECONDS.time():
+            db = await self._idle.get()
+        try:
+            yield db
+        finally:
+            # Не возвращаем в пул соединение с незавершенной транзакцией
+            if db.in_transaction:
+                await db.rollback()
+            self._idle.put_nowait(db)
+
+    async def close(self):
+        # Дожидаемся возврата всех соединений, чтобы не оборвать текущие запросы
+        for _ in range(len(self._connections)):
+            await self._idle.get()
+        for db in self._connections:
+            await db.close()
+        self._connections.clear()
+
+_pool: ConnectionPool | None = None
+_pool_lock = asyncio.Lock()
+
+async def init_pool(size: int = DB_POOL_SIZE):
+    global _pool
+    async with _pool_lock:
+        if _pool is not None:
+            return
+        pool = ConnectionPool(DB_NAME, size)
+        await pool.open()
+        _pool = pool
+        logger.info("Пул соединений с БД открыт (%s соединений).", size)
+
+async def close_pool():
+    global _pool
+    async with _pool_lock:
+        if _pool is None:
+            return
+        pool, _pool = _pool, None
+        await pool.close()
+        logger.info("Пул соединений с БД закрыт.")
+
+# Файл блокировки рядом с БД: процессы бота держат совместную блокировку, загрузка
+# пользователей из командной строки — исключительную. Кэши бота не видят изменений
+# из другого процесса, поэтому такая загрузка идет только при остановленном боте
+_bot_lock = None
+
+def _lock_path() -> str:
+    return f"{DB_NAME}.lock"
+
+async def acquire_bot_lock():
+    """Отметка запущенного бота; ждет окончания загрузки из командной строки"""
+    global _bot_lock
+    if fcntl is None or _bot_lock is not None:
+        return
+    lock = open(_lock_path(), "a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except BlockingIOError:
+        logger.warning("Идет загрузка пользователей из командной строки, запуск ждет ее окончания.")
+        await asyncio.to_thread(fcntl.flock, lock, fcntl.LOCK_SH)
+    _bot_lock = lock
+
+def release_bot_lock():
+    global _bot_lock
+    if _bot_lock is not None:
+        # Блокировка снимается вместе с закрытием файла
+        _bot_lock.close()
+        _bot_lock = None
+
+@contextmanager
+def exclusive_lock():
+    """Исключительный доступ к БД для user_dump.py; RuntimeError, если бот запущен"""
+    if fcntl is None:
+        logger.warning("Проверка запущенного бота недоступна на этой платформе.")
+        yield
+        return
+    with open(_lock_path(), "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise RuntimeError("Бот запущен: остановите его или загрузите файл через /import") from None
+        yield
+
+# Подписчики на изменения пользователей: callback(user_id, balance, name),
+# где balance и name (ник или username) равны None, если не менялись
+_user_listeners = []
+
+def add_user_listener(callback):
+    _user_listeners.append(callback)
+
+def _notify_user_changed(user_id: int, balance: int | None = None, name: str | None = None):
+    for callback in _user_listeners:
+        try:
+            callback(user_id, balance, name)
+        except Exception as e:
+            logger.error("Ошибка обработчика изменения пользователя %s: %s", user_id, e)
+
+class UserCache:
+    """LRU-кэш балансов пользователей.
+
+    Заполняется при чтении и обновляется функциями записи через
+    _notify_user_changed сразу после коммита, поэтому повторное чтение
+    баланса не обращается к БД.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._balances: OrderedDict[int, int] = OrderedDict()
+        # Чтения из БД в процессе: запись во время чтения снимает отметку,
+        # и прочитанный до нее баланс не попадает в кэш
+        self._loading: dict[int, object] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int) -> int | None:
+        balance = self._balances.get(user_id)
+        if balance is None:
+            self.misses += 1
+            return None
+        self._balances.move_to_end(user_id)
+        self.hits += 1
+        return balance
+
+    def begin_load(self, user_id: int) -> object:
+        token = self._loading[user_id] = object()
+        return token
+
+    def finish_load(self, user_id: int, token: object, balance: int | None):
+        if self._loading.get(user_id) is not token:
+            return
+        del self._loading[user_id]
+        if balance is not None:
+            self._put(user_id, balance)
+
+    def _put(self, user_id: int, balance: int):
+        self._balances[user_id] = balance
+        self._balances.move_to_end(user_id)
+        if len(self._balances) > self.size:
+            self._balances.popitem(last=False)
+
+    def on_user_changed(self, user_id: int, balance: int | None, name: str | None):
+        if balance is None:
+            return
+        self._loading.pop(user_id, None)
+        self._put(user_id, balance)
+
+_user_cache = UserCache(USER_CACHE_SIZE) if USER_CACHE_SIZE > 0 else None
+if _user_cache is not None:
+    add_user_listener(_user_cache.on_user_changed)
+
+def get_user_cache_stats() -> dict | None:
+    if _user_cache is None:
+        return None
+    return {"size": len(_user_cache._balances), "hits": _user_cache.hits, "misses": _user_cache.misses}
+
+@asynccontextmanager
+async def _connection():
+    if _pool is None:
+        await init_pool()
+    async with _pool.acquire() as db:
+        yield db
+
+STATS_UPDATE_SQL = """
+    UPDATE users
+    SET games_played = games_played + ?,
+        games_won = games_won + ?,
+        total_wagered = total_wagered + ?,
+        net_profit = net_profit + ?
+    WHERE user_id = ?
+"""
+
+class StatsBuffer:
+    """Буфер отложенной записи игровой статистики с журналом на диске.
+
+    Дельты копятся в памяти по пользователям и записываются одной транзакцией.
+    Каждая игра дописывается в журнал текущего поколения, чтобы после падения
+    процесса незаписанные дельты можно было восстановить.
+    """
+
+    def __init__(self, journal_prefix: str, max_rows: int, meta_key: str = "stats_journal_generation"):
+        self.journal_prefix = journal_prefix
+        self.max_rows = max_rows
+        # Ключ в meta с последним записанным поколением журнала
+        self.meta_key = meta_key
+        self._deltas: dict[int, list[int]] = {}
+        self._generation = 0
+        self._journal = None
+        self._lock = asyncio.Lock()
+
+    def _journal_path(self, generation: int) -> str:
+        return f"{self.journal_prefix}.{generation}"
+
+    def _journal_generations(self) -> list[int]:
+        generations = []
+        for path in glob.glob(f"{glob.escape(self.journal_prefix)}.*"):
+            suffix = path.rsplit(".", 1)[1]
+            if suffix.isdigit():
+                generations.append(int(suffix))
+        return sorted(generations)
+
+    def _open_journal(self):
+        self._generation += 1
+        self._journal = open(self._journal_path(self._generation), "a", encoding="utf-8")
+
+    def _apply(self, user_id: int, bet: int, win_amount: int):
+        delta = self._deltas.get(user_id)
+        if delta is None:
+            delta = self._deltas[user_id] = [0, 0, 0, 0]
+        delta[0] += 1
+        delta[1] += 1 if win_amount > 0 else 0
+        delta[2] += bet
+        delta[3] += win_amount - bet
+
+    async def open(self):
+        """Восстановление незаписанных дельт из журналов и открытие нового журнала"""
+        async with _connection() as db:
+            cursor = await db.execute("SELECT value FROM meta WHERE key = ?", (self.meta_key,))
+            row = await cursor.fetchone()
+        applied = int(row[0]) if row else 0
+        generations = self._journal_generations()
+        recovered = 0
+        for generation in generations:
+            if generation <= applied:
+                continue
+            with open(self._journal_path(generation), encoding="utf-8") as journal:
+                for line in journal:
+                    parts = line.split()
+                    # Последняя строка могла оборваться при падении процесса
+                    if len(parts) != 3:
+                        continue
+                    self._apply(int(parts[0]), int(parts[1]), int(parts[2]))
+                    recovered += 1
+        self._generation = max(generations + [applied])
+        self._open_journal()
+        if recovered:
+            logger.warning("Восстановлено %s незаписанных записей статистики из журнала.", recovered)
+            await self.flush()
+
+    def add(self, user_id: int, bet: int, win_amount: int) -> int:
+        """Добавляет результат игры, возвращает число пользователей в буфере"""
+        self._journal.write(f"{user_id} {bet} {win_amount}\n")
+        self._journal.flush()
+        self._apply(user_id, bet, win_amount)
+        return len(self._deltas)
+
+    async def flush(self):
+        async with self._lock:
+            if not self._deltas:
+                return
+            deltas, self._deltas = self._deltas, {}
+            # Новые игры пишутся уже в журнал следующего поколения
+            generation = self._generation
+            self._journal.close()
+            self._open_journal()
+            rows = [(*delta, user_id) for user_id, delta in deltas.items()]
+            try:
+                with QUERY_SECONDS.time("stats_flush"):
+                    async with _connection() as db:
+                        await db.execute("BEGIN IMMEDIATE")
+                        await db.executemany(STATS_UPDATE_SQL, rows)
+                        await db.execute(
+                            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                            (self.meta_key, generation)
+                        )
+                        await db.commit()
+            except Exception:
+                # Возвращаем дельты в буфер, журналы остаются до успешной записи
+                for user_id, delta in deltas.items():
+                    current = self._deltas.setdefault(user_id, [0, 0, 0, 0])
+                    for i, value in enumerate(delta):
+                        current[i] += value
+                raise
+            for old_generation in self._journal_generations():
+                if old_generation <= generation:
+                    os.remove(self._journal_path(old_generation))
+
+    async def close(self):
+        await self.flush()
+        self._journal.close()
+        if not self._deltas:
+            os.remove(self._journal_path(self._generation))
+
+_stats_buffer: StatsBuffer | None = None
+_stats_flush_task: asyncio.Task | None = None
+_stats_flush_requested = asyncio.Event()
+
+async def _stats_flush_loop(interval: float):
+    while True:
+        try:
+            await asyncio.wait_for(_stats_flush_requested.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+        _stats_flush_requested.clear()
+        try:
+            await _stats_buffer.flush()
+        except Exception as e:
+            logger.error("Ошибка записи буфера статистики: %s", e)
+
+async def init_stats_buffer(interval_ms: int = STATS_FLUSH_INTERVAL_MS, max_rows: int = STATS_FLUSH_MAX_ROWS):
+    """Запуск отложенной записи статистики (после init_db)"""
+    global _stats_buffer, _stats_flush_task
+    if _stats_buffer is not None:
+        return
+    if WORKER_ID:
+        # У каждого процесса-обработчика свой журнал и свое записанное поколение
+        buffer = StatsBuffer(f"{DB_NAME}-stats-journal-w{WORKER_ID}", max_rows, f"stats_journal_generation:w{WORKER_ID}")
+    else:
+        buffer = StatsBuffer(f"{DB_NAME}-stats-journal", max_rows)
+    await buffer.open()
+    _stats_buffer = buffer
+    _stats_flush_task = asyncio.create_task(_stats_flush_loop(interval_ms / 1000))
+
+async def flush_stats():
+    """Немедленная запись буфера статистики, если он запущен"""
+    if _stats_buffer is not None:
+        await _stats_buffer.flush()
+
+def stats_journal_files() -> list[str]:
+    """Журналы буфера статистики всех процессов; после штатной остановки их нет"""
+    return glob.glob(f"{glob.escape(DB_NAME)}-stats-journal*")
+
+async def close_stats_buffer():
+    """Остановка отложенной записи с финальным сбросом буфера"""
+    global _stats_buffer, _stats_flush_task
+    if _stats_buffer is None:
+        return
+    _stats_flush_task.cancel()
+    try:
+        await _stats_flush_task
+    except asyncio.CancelledError:
+        pass
+    buffer, _stats_buffer, _stats_flush_task = _stats_buffer, None, None
+    await buffer.close()
+
 async def init_db():
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                balance INTEGER DEFAULT 0 NOT NULL,
-                games_played INTEGER DEFAULT 0 NOT NULL,
-                games_won INTEGER DEFAULT 0 NOT NULL,
-                total_wagered INTEGER DEFAULT 0 NOT NULL,
-                net_profit INTEGER DEFAULT 0 NOT NULL,
-                nickname TEXT
-            )
-        ''')
-        await db.commit()
-        logger.info("База данных и таблица 'users' успешно проверены/созданы.")
+    """Применение миграций схемы (см. migrations)"""
+    async with _connection() as db:
+        version = await migrations.migrate(db)
+    logger.info("Схема БД в актуальной версии %s.", version)
+    # Первичное заполнение общей статистики для существующей базы
+    if await get_global_stats() is None:
+        await recompute_global_stats()
 
+async def check_db():
+    """Проверка версии схемы без миграций — для процессов, которые только читают БД"""
+    async with _connection() as db:
+        await migrations.check_version(db)
+
+@_timed
 async def add_user_if_not_exists(user_id: int, username: str):
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
-        if not await cursor.fetchone():
-            await db.execute("INSERT INTO users (user_id, username) VALUES (?, ?)", (user_id, username))
-        else:
-            await db.execute("UPDATE users SET username = ? WHERE user_id = ?", (username, user_id))
+    async with _connection() as db:
+        # Повторно написавший боту пользователь его больше не блокирует
+        cursor = await db.execute("""
+            INSERT INTO users (user_id, username) VALUES (?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET username = excluded.username, is_blocked = 0
+            RETURNING balance, COALESCE(nickname, username)
+        """, (user_id, username))
+        row = await cursor.fetchone()
         await db.commit()
+    _notify_user_changed(user_id, row[0], row[1])
 
 async def get_user_balance(user_id: int) -> int:
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
-        row = await cursor.fetchone()
-        return row[0] if row else 0
+    if _user_cache is None:
+        token = None
+    else:
+        balance = _user_cache.get(user_id)
+        if balance is not None:
+            return balance
+        token = _user_cache.begin_load(user_id)
+    balance = None
+    try:
+        # Время замеряется только для чтения из БД, попадания в кэш не учитываются
+        with QUERY_SECONDS.time("get_user_balance"):
+            async with _connection() as db:
+                cursor = await db.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
+                row = await cursor.fetchone()
+                # Отсутствующий пользователь тоже кэшируется: при создании придет уведомление
+                balance = row[0] if row else 0
+    finally:
+        if token is not None:
+            _user_cache.finish_load(user_id, token, balance)
+    return balance
 
-async def update_user_balance(user_id: int, amount: int, relative: bool = False):
-    async with aiosqlite.connect(DB_NAME) as db:
+async def _record_transaction(db: aiosqlite.Connection, user_id: int, tx_type: str, amount: int, balance_after: int, ref: str | None):
+    """Запись в журнал операций; вызывается внутри транзакции, меняющей баланс"""
+    await db.execute(
+        "INSERT INTO transactions (user_id, type, amount, balance_after, ref, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        (user_id, tx_type, amount, balance_after, ref, int(time.time()))
+    )
+
+@_timed
+async def update_user_balance(user_id: int, amount: int, relative: bool = False,
+                              tx_type: str = "adjustment", ref: str | None = None) -> int | None:
+    async with _connection() as db:
+        await db.execute("BEGIN IMMEDIATE")
         if relative:
-            await db.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount, user_id))
+            cursor = await db.execute("UPDATE users SET balance = balance + ? WHERE user_id = ? RETURNING balance", (amount, user_id))
+            row = await cursor.fetchone()
+            delta = amount
         else:
-            await db.execute("UPDATE users SET balance = ? WHERE user_id = ?", (amount, user_id))
+            cursor = await db.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
+            old = await cursor.fetchone()
+            cursor = await db.execute("UPDATE users SET balance = ? WHERE user_id = ? RETURNING balance", (amount, user_id))
+            row = await cursor.fetchone()
+            delta = amount - old[0] if old else 0
+        if row and delta:
+            await _record_transaction(db, user_id, tx_type, delta, row[0], ref)
         await db.commit()
+    if not row:
+        return None
+    _notify_user_changed(user_id, row[0])
+    return row[0]
 
 async def update_user_stats(user_id: int, bet: int, win_amount: int):
+    # При запущенном буфере статистика пишется отложенно, пачками
+    if _stats_buffer is not None:
+        if _stats_buffer.add(user_id, bet, win_amount) >= _stats_buffer.max_rows:
+            _stats_flush_requested.set()
+        return
     is_win = 1 if win_amount > 0 else 0
     profit = win_amount - bet
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("""
+    with QUERY_SECONDS.time("update_user_stats"):
+        async with _connection() as db:
+            await db.execute(STATS_UPDATE_SQL, (1, is_win, bet, profit, user_id))
+            await db.commit()
+
+@_timed
+async def settle_bet(user_id: int, bet: int, win_amount: int, ref: str | None = None) -> int | None:
+    """Атомарно списывает ставку и начисляет выигрыш, затем учитывает статистику.
+
+    Возвращает новый баланс или None, если на балансе недостаточно средств.
+    """
+    async with _connection() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        cursor = await db.execute("""
             UPDATE users 
-            SET games_played = games_played + 1,
-                games_won = games_won + ?,
-                total_wagered = total_wagered + ?,
-                net_profit = net_profit + ?
-            WHERE user_id = ?
-        """, (is_win, bet, profit, user_id))
+            SET balance = balance - ? + ?
+            WHERE user_id = ? AND balance >= ?
+            RETURNING balance
+        """, (bet, win_amount, user_id, bet))
+        row = await cursor.fetchone()
+        if row:
+            await _record_transaction(db, user_id, "game", win_amount - bet, row[0], ref)
         await db.commit()
+    if not row:
+        return None
+    _notify_user_changed(user_id, row[0])
+    await update_user_stats(user_id, bet, win_amount)
+    return row[0]
 
+async def build_indexes() -> list[str]:
+    """Фоновое построение индексов из миграций, по одному за транзакцию"""
+    async with _connection() as db:
+        pending = await migrations.pending_indexes(db)
+    for name, sql in pending:
+        # Соединение берется на время одного индекса, чтобы не занимать пул
+        async with _connection() as db:
+            await migrations.build_index(db, name, sql)
+    return [name for name, _ in pending]
+
+@_timed
 async def get_top_users(limit: int = 10) -> list[aiosqlite.Row]:
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
+    async with _connection() as db:
         cursor = await db.execute("SELECT user_id, username, nickname, balance FROM users ORDER BY balance DESC LIMIT ?", (limit,))
         return await cursor.fetchall()
 
+@_timed
 async def set_user_nickname(user_id: int, nickname: str):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _connection() as db:
         await db.execute("UPDATE users SET nickname = ? WHERE user_id = ?", (nickname, user_id))
         await db.commit()
+    _notify_user_changed(user_id, name=nickname)
 
-async def get_all_user_ids() -> list[int]:
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute("SELECT user_id FROM users")
-        rows = await cursor.fetchall()
-        return [row[0] for row in rows]
+@_timed
+async def get_user_names(user_ids: list[int]) -> dict[int, str | None]:
+    """Отображаемые имена (ник или username) для списка пользователей"""
+    placeholders = ", ".join("?" * len(user_ids))
+    async with _connection() as db:
+        cursor = await db.execute(
+            f"SELECT user_id, COALESCE(nickname, username) FROM users WHERE user_id IN ({placeholders})",
+            user_ids
+        )
+        return {row[0]: row[1] for row in await cursor.fetchall()}
+
+@_timed
+async def get_user_rank(user_id: int) -> tuple[int, int] | None:
+    """Место пользователя по балансу и его баланс.
+
+    COUNT идет по индексу balance от самого большого баланса до баланса
+    пользователя, поэтому стоимость растет с местом: O(место), на 1 млн
+    пользователей ~0.3 мс у лидеров, ~13 мс в середине и ~25 мс в конце.
+    Игрокам из таблицы лидеров место считается в памяти (leaderboard).
+    """
+    async with _connection() as db:
+        cursor = await db.execute("""
+            SELECT (SELECT COUNT(*) FROM users WHERE balance > u.balance) + 1, u.balance
+            FROM users u WHERE u.user_id = ?
+        """, (user_id,))
+        row = await cursor.fetchone()
+        return (row[0], row[1]) if row else None
 
+@_timed
+async def find_user_id(name: str) -> int | None:
+    """id пользователя по username или нику (индексы idx_users_username и idx_users_nickname)"""
+    async with _connection() as db:
+        cursor = await db.execute("""
+            SELECT user_id FROM users WHERE username = ?
+            UNION ALL
+            SELECT user_id FROM users WHERE nickname = ?
+            LIMIT 1
+        """, (name, name))
+        row = await cursor.fetchone()
+        return row[0] if row else None
+
+# Столбцы users, которые выгружаются и загружаются (user_dump.py)
+USER_COLUMNS = (
+    "user_id", "username", "nickname", "balance", "games_played", "games_won",
+    "total_wagered", "net_profit", "is_blocked",
+)
+
+async def iter_users(batch_size: int = USER_TRANSFER_BATCH_SIZE) -> AsyncIterator[aiosqlite.Row]:
+    """Все пользователи по возрастанию id, столбцы USER_COLUMNS.
+
+    Читается страницами по первичному ключу: соединение занято только на время
+    одной страницы, и память не растет с размером таблицы.
+    """
+    select = f"SELECT {', '.join(USER_COLUMNS)} FROM users"
+    after_user_id = None
+    while True:
+        with QUERY_SECONDS.time("iter_users"):
+            async with _connection() as db:
+                if after_user_id is None:
+                    cursor = await db.execute(f"{select} ORDER BY user_id LIMIT ?", (batch_size,))
+                else:
+                    cursor = await db.execute(f"{select} WHERE user_id > ? ORDER BY user_id LIMIT ?", (after_user_id, batch_size))
+                rows = await cursor.fetchall()
+        for row in rows:
+            yield row
+        if len(rows) < batch_size:
+            return
+        after_user_id = rows[-1]['user_id']
+
+@_timed
+async def import_users(columns: tuple[str, ...], rows: list[tuple], ref: str | None = None) -> int:
+    """Вставка или обновление пачки пользователей одной транзакцией.
+
+    columns — столбцы из USER_COLUMNS, первым идет user_id. У существующих
+    пользователей меняются только переданные столбцы; изменения баланса
+    записываются в журнал операций с типом import.
+    """
+    updates = ", ".join(f"{column} = excluded.{column}" for column in columns[1:])
+    sql = (
+        f"INSERT INTO users ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+        f"ON CONFLICT(user_id) DO {f'UPDATE SET {updates}' if updates else 'NOTHING'}"
+    )
+    balance_index = columns.index("balance") if "balance" in columns else None
+    names = {}
+    if "username" in columns and "nickname" in columns:
+        username_index, nickname_index = columns.index("username"), columns.index("nickname")
+        names = {row[0]: row[nickname_index] or row[username_index] for row in rows}
+    balances = {}
+
+    async with _connection() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        if balance_index is not None:
+            user_ids = list({row[0] for row in rows})
+            cursor = await db.execute(
+                f"SELECT user_id, balance FROM users WHERE user_id IN ({', '.join('?' * len(user_ids))})", user_ids
+            )
+            balances = {row[0]: row[1] for row in await cursor.fetchall()}
+        await db.executemany(sql, rows)
+        if balance_index is not None:
+            now = int(time.time())
+            entries = []
+            for row in rows:
+                # Новые пользователи начинают с нулевого баланса, как и в журнале
+                old_balance = balances.get(row[0], 0)
+                balances[row[0]] = row[balance_index]
+                if row[balance_index] != old_balance:
+                    entries.append((row[0], "import", row[balance_index] - old_balance, row[balance_index], ref, now))
+            await db.executemany(
+                "INSERT INTO transactions (user_id, type, amount, balance_after, ref, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                entries
+            )
+        await db.commit()
+
+    for user_id in balances.keys() | names.keys():
+        _notify_user_changed(user_id, balances.get(user_id), names.get(user_id))
+    return len(rows)
+
+@_timed
+async def get_user_ids_page(after_user_id: int, limit: int) -> list[int]:
+    """Страница id активных пользователей по возрастанию, начиная после after_user_id"""
+    async with _connection() as db:
+        cursor = await db.execute(
+            "SELECT user_id FROM users WHERE user_id > ? AND is_blocked = 0 ORDER BY user_id LIMIT ?",
+            (after_user_id, limit)
+        )
+        return [row[0] for row in await cursor.fetchall()]
+
+@_timed
+async def mark_users_blocked(user_ids: list[int]):
+    async with _connection() as db:
+        await db.executemany("UPDATE users SET is_blocked = 1 WHERE user_id = ?", [(user_id,) for user_id in user_ids])
+        await db.commit()
+
+GLOBAL_STATS_SQL = """
+    SELECT 
+        COUNT(user_id) as total_users,
+        COALESCE(SUM(balance), 0) as total_balance,
+        COALESCE(SUM(games_played), 0) as total_games,
+        COALESCE(SUM(total_wagered), 0) as total_wager,
+        COALESCE(SUM(net_profit), 0) as casino_profit
+    FROM users
+"""
+
+@_timed
 async def get_global_stats() -> dict | None:
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
+    """Общая статистика из поддерживаемой триггерами строки global_stats"""
+    async with _connection() as db:
         cursor = await db.execute("""
-            SELECT 
-                COUNT(user_id) as total_users,
-                SUM(balance) as total_balance,
-                SUM(games_played) as total_games,
-                SUM(total_wagered) as total_wager,
-                SUM(net_profit) as casino_profit
-            FROM users
+            SELECT total_users, total_balance, total_games, total_wager, casino_profit
+            FROM global_stats WHERE id = 1
         """)
         row = await cursor.fetchone()
-        return dict(row) if row else None
\ No newline at end of file
+        return dict(row) if row else None
+
+@_timed
+async def recompute_global_stats() -> dict:
+    """Полный пересчет общей статистики по таблице users.
+
+    Возвращает расхождение поддерживаемых счетчиков с пересчитанными значениями
+    (только ненулевые поля) и исправляет строку global_stats.
+
+    Подсчет идет в читающей транзакции и не блокирует запись. Строка
+    global_stats и users читаются из одного снимка, поэтому расхождение точное;
+    изменения после снимка применяют триггеры, и под блокировкой записи из
+    счетчиков вычитается только расхождение.
+    """
+    async with _connection() as db:
+        # Пустая строка для новой базы: с этого момента изменения учитывают триггеры
+        cursor = await db.execute("""
+            INSERT OR IGNORE INTO global_stats
+                (id, total_users, total_balance, total_games, total_wager, casino_profit)
+            VALUES (1, 0, 0, 0, 0, 0)
+        """)
+        seeded = cursor.rowcount == 1
+        await db.commit()
+
+        await db.execute("BEGIN")
+        cursor = await db.execute("SELECT * FROM global_stats WHERE id = 1")
+        maintained = await cursor.fetchone()
+        cursor = await db.execute(GLOBAL_STATS_SQL)
+        actual = dict(await cursor.fetchone())
+        await db.commit()
+        drift = {key: maintained[key] - value for key, value in actual.items() if maintained[key] != value}
+
+        await db.execute("BEGIN IMMEDIATE")
+        await db.execute("""
+            UPDATE global_stats SET
+                total_users = total_users - :total_users,
+                total_balance = total_balance - :total_balance,
+                total_games = total_games - :total_games,
+                total_wager = total_wager - :total_wager,
+                casino_profit = casino_profit - :casino_profit,
+                recomputed_at = :recomputed_at
+            WHERE id = 1
+        """, {**dict.fromkeys(actual, 0), **drift, "recomputed_at": int(time.time())})
+        await db.commit()
+    # Для новой строки расхождение — это вся существующая статистика
+    return {} if seeded else drift
+
+@_timed
+async def add_pending_payment(label: str, user_id: int, amount: int):
+    async with _connection() as db:
+        await db.execute(
+            "INSERT OR IGNORE INTO payments (label, user_id, amount, created_at) VALUES (?, ?, ?, ?)",
+            (label, user_id, amount, int(time.time()))
+        )
+        await db.commit()
+
+@_timed
+async def get_pending_payments(created_after: int) -> list[aiosqlite.Row]:
+    async with _connection() as db:
+        cursor = await db.execute(
+            "SELECT label, user_id, amount, created_at FROM payments WHERE status = 'pending' AND created_at >= ?",
+            (created_after,)
+        )
+        return await cursor.fetchall()
+
+@_timed
+async def get_payment(label: str) -> aiosqlite.Row | None:
+    async with _connection() as db:
+        cursor = await db.execute(
+            "SELECT label, user_id, amount, status, created_at, credited_at, received_amount FROM payments WHERE label = ?",
+            (label,)
+        )
+        return await cursor.fetchone()
+
+@_timed
+async def get_latest_payment(user_id: int) -> aiosqlite.Row | None:
+    async with _connection() as db:
+        cursor = await db.execute(
+            "SELECT label, user_id, amount, status, created_at, credited_at, received_amount FROM payments "
+            "WHERE user_id = ? ORDER BY created_at DESC LIMIT 1",
+            (user_id,)
+        )
+        return await cursor.fetchone()
+
+@_timed
+async def expire_pending_payments(created_before: int) -> int:
+    """Переводит старые неоплаченные платежи в статус 'expired'"""
+    async with _connection() as db:
+        cursor = await db.execute(
+            "UPDATE payments SET status = 'expired' WHERE status = 'pending' AND created_at < ?",
+            (created_before,)
+        )
+        await db.commit()
+        return cursor.rowcount
+
+@_timed
+async def credit_payment(label: str, received: float, min_share: float = 1.0) -> aiosqlite.Row | None:
+    """Зачисляет незачисленный платеж на баланс.
+
+    received — сумма операции ЮMoney. Платеж зачисляется, только если она не
+    меньше ожидаемой суммы, умноженной на min_share (доля без комиссии), иначе
+    переводится в статус 'review' для ручной проверки. Возвращает user_id,
+    amount и новый status.
+
+    Статус меняется одним условным UPDATE, поэтому повторный или параллельный
+    вызов для того же платежа ничего не зачисляет и возвращает None.
+    Просроченный платеж, оплаченный позже, тоже зачисляется.
+    """
+    async with _connection() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        cursor = await db.execute("""
+            UPDATE payments SET
+                status = CASE WHEN :received >= ROUND(amount * :min_share, 2) THEN 'credited' ELSE 'review' END,
+                credited_at = CASE WHEN :received >= ROUND(amount * :min_share, 2) THEN :now END,
+                received_amount = :received
+            WHERE label = :label AND status IN ('pending', 'expired')
+            RETURNING user_id, amount, status
+        """, {"received": received, "min_share": min_share, "now": int(time.time()), "label": label})
+        payment = await cursor.fetchone()
+        balance = None
+        if payment and payment['status'] == 'credited':
+            cursor = await db.execute(
+                "UPDATE users SET balance = balance + ? WHERE user_id = ? RETURNING balance",
+                (payment['amount'], payment['user_id'])
+            )
+            balance = await cursor.fetchone()
+            if balance:
+                await _record_transaction(db, payment['user_id'], "deposit", payment['amount'], balance[0], label)
+        await db.commit()
+    if balance:
+        _notify_user_changed(payment['user_id'], balance[0])
+    return payment
+
+@_timed
+async def create_broadcast(text: str, admin_chat_id: int, status_message_id: int) -> int:
+    async with _connection() as db:
+        cursor = await db.execute(
+            "INSERT INTO broadcasts (text, admin_chat_id, status_message_id, created_at) VALUES (?, ?, ?, ?)",
+            (text, admin_chat_id, status_message_id, int(time.time()))
+        )
+        await db.commit()
+        return cursor.lastrowid
+
+@_timed
+async def get_broadcast(broadcast_id: int) -> aiosqlite.Row | None:
+    async with _connection() as db:
+        cursor = await db.execute("SELECT * FROM broadcasts WHERE broadcast_id = ?", (broadcast_id,))
+        return await cursor.fetchone()
+
+@_timed
+async def get_running_broadcasts() -> list[aiosqlite.Row]:
+    async with _connection() as db:
+        cursor = await db.execute("SELECT * FROM broadcasts WHERE status = 'running' ORDER BY broadcast_id")
+        return await cursor.fetchall()
+
+@_timed
+async def save_broadcast_progress(broadcast_id: int, last_user_id: int, sent: int, failed: int, blocked: int, finished: bool = False):
+    async with _connection() as db:
+        await db.execute("""
+            UPDATE broadcasts
+            SET last_user_id = ?, sent = ?, failed = ?, blocked = ?,
+                status = CASE WHEN ? THEN 'done' ELSE status END,
+                finished_at = CASE WHEN ? THEN ? ELSE finished_at END
+            WHERE broadcast_id = ?
+        """, (last_user_id, sent, failed, blocked, finished, finished, int(time.time()), broadcast_id))
+        await db.commit()
+
+@_timed
+async def get_user_transactions(user_id: int, limit: int = 10) -> list[aiosqlite.Row]:
+    async with _connection() as db:
+        cursor = await db.execute(
+            "SELECT tx_id, type, amount, balance_after, ref, created_at FROM transactions "
+            "WHERE user_id = ? ORDER BY tx_id DESC LIMIT ?",
+            (user_id, limit)
+        )
+        return await cursor.fetchall()
+
+@_timed
+async def snapshot_balances() -> int:
+    """Снимки балансов пользователей, у которых были операции после прошлого снимка"""
+    async with _connection() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        cursor = await db.execute("SELECT value FROM meta WHERE key = 'snapshot_tx_id'")
+        row = await cursor.fetchone()
+        last_tx_id = int(row[0]) if row else 0
+        # SQLite берет balance_after из строки с MAX(tx_id) в каждой группе
+        cursor = await db.execute("""
+            INSERT INTO balance_snapshots (user_id, tx_id, balance, created_at)
+            SELECT user_id, MAX(tx_id), balance_after, ? FROM transactions
+            WHERE tx_id > ? GROUP BY user_id
+        """, (int(time.time()), last_tx_id))
+        created = cursor.rowcount
+        await db.execute("""
+            INSERT OR REPLACE INTO meta (key, value)
+            SELECT 'snapshot_tx_id', COALESCE(MAX(tx_id), ?) FROM transactions
+        """, (last_tx_id,))
+        await db.commit()
+        return created
+
+@_timed
+async def reconstruct_balance(user_id: int) -> int:
+    """Баланс по журналу: последний снимок плюс операции после него"""
+    async with _connection() as db:
+        cursor = await db.execute(
+            "SELECT tx_id, balance FROM balance_snapshots WHERE user_id = ? ORDER BY tx_id DESC LIMIT 1",
+            (user_id,)
+        )
+        snapshot = await cursor.fetchone()
+        tx_id, balance = (snapshot[0], snapshot[1]) if snapshot else (0, 0)
+        cursor = await db.execute(
+            "SELECT COALESCE(SUM(amount), 0) FROM transactions WHERE user_id = ? AND tx_id > ?",
+            (user_id, tx_id)
+        )
+        return balance + (await cursor.fetchone())[0]
+
+@_timed
+async def load_user_data(user_id: int) -> str | None:
+    async with _connection() as db:
+        cursor = await db.execute("SELECT data FROM user_data WHERE user_id = ?", (user_id,))
+        row = await cursor.fetchone()
+        return row[0] if row else None
+
+@_timed
+async def load_conversations(name: str, updated_after: int) -> list[aiosqlite.Row]:
+    """Состояния диалога name, менявшиеся не раньше updated_after; более старые удаляются"""
+    async with _connection() as db:
+        await db.execute("DELETE FROM conversations WHERE updated_at < ?", (updated_after,))
+        cursor = await db.execute("SELECT key, state FROM conversations WHERE name = ?", (name,))
+        rows = await cursor.fetchall()
+        await db.commit()
+        return rows
+
+@_timed
+async def save_persistent_state(user_rows: list[tuple[int, str]], dropped_user_ids: list[int],
+                                conversation_rows: list[tuple[str, str, str]], ended_conversations: list[tuple[str, str]]):
+    """Запись накопленных изменений persistence одной транзакцией"""
+    now = int(time.time())
+    async with _connection() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        if user_rows:
+            await db.executemany(
+                "INSERT OR REPLACE INTO user_data (user_id, data, updated_at) VALUES (?, ?, ?)",
+                [(user_id, data, now) for user_id, data in user_rows]
+            )
+        if dropped_user_ids:
+            await db.executemany("DELETE FROM user_data WHERE user_id = ?", [(user_id,) for user_id in dropped_user_ids])
+        if conversation_rows:
+            await db.executemany(
+                "INSERT OR REPLACE INTO conversations (name, key, state, updated_at) VALUES (?, ?, ?, ?)",
+                [(name, key, state, now) for name, key, state in conversation_rows]
+            )
+        if ended_conversations:
+            await db.executemany("DELETE FROM conversations WHERE name = ? AND key = ?", ended_conversations)
+        await db.commit()
@@ -0,0 +1,81 @@
+"""Реестр игр: выплаты, тексты результатов и правила из одного источника"""
+
+class Payout:
+    """Выигрышный исход: значения кубика, множитель и тексты"""
+
+    def __init__(self, values: tuple[int, ...], multiplier: float, rule: str, result_text: str):
+        self.values = values
+        self.multiplier = multiplier
+        self.rule = rule
+        self.result_text = result_text
+
+    @property
+    def multiplier_label(self) -> str:
+        label = f"x{self.multiplier:g}"
+        return f"{label} (возврат ставки)" if self.multiplier == 1 else label
+
+LOSS_TEXT = "К сожалению, вы проиграли."
+
+class Game:
+    """Игра на основе анимированного кубика Telegram"""
+
+    def __init__(self, key: str, emoji: str, title: str, max_value: int, payouts: list[Payout]):
+        self.key = key
+        self.emoji = emoji
+        self.title = title
+        self.payouts = payouts
+        # Таблица исходов по значению кубика: (множитель, текст результата)
+        self.outcomes = [(0, LOSS_TEXT)] * (max_value + 1)
+        for payout in payouts:
+            for value in payout.values:
+                self.outcomes[value] = (payout.multiplier, payout.result_text)
+
+    def settle(self, dice_value: int, bet: int) -> tuple[int, str]:
+        """Возвращает сумму выигрыша и текст результата"""
+        multiplier, result_text = self.outcomes[dice_value]
+        return int(bet * multiplier), result_text
+
+_BALL_PAYOUTS = [
+    Payout((5,), 2.5, "Мяч в цели (попадание)", "ГОЛ! Вы победили!"),
+    Payout((4,), 1, "Почти попал (рядом)", "Почти! Ваша ставка возвращена."),
+]
+
+# Порядок реестра определяет порядок кнопок и разделов правил
+GAMES = {
+    game.key: game
+    for game in (
+        Game("dice", "🎲", "Кости", 6, [
+            Payout((6,), 3, "Выпало 6", "Выпало 6! Ваш выигрыш!"),
+            Payout((5,), 2, "Выпало 5", "Выпало 5! Вы победили!"),
+        ]),
+        Game("basketball", "🏀", "Баскетбол", 5, _BALL_PAYOUTS),
+        Game("football", "⚽", "Футбол", 5, _BALL_PAYOUTS),
+        Game("dart", "🎰", "Слот-машина", 64, [
+            Payout((64,), 50, "7️⃣7️⃣7️⃣ (Джекпот)", "ДЖЕКПОТ! 7️⃣7️⃣7️⃣"),
+            Payout((43,), 20, "🍇🍇🍇 (Три винограда)", "Отлично! Три винограда! 🍇🍇🍇"),
+            Payout((22,), 10, "🍋🍋🍋 (Три лимона)", "Неплохо! Три лимона! 🍋🍋🍋"),
+            Payout((1,), 5, "🅱️🅱️🅱️ (Три BAR)", "Выигрыш! Три BAR! 🅱️🅱️🅱️"),
+        ]),
+    )
+}
+
+def _render_rules() -> str:
+    # Соседние игры с одинаковыми выплатами объединяются в один раздел
+    groups: list[list[Game]] = []
+    for game in GAMES.values():
+        if groups and groups[-1][0].payouts is game.payouts:
+            groups[-1].append(game)
+        else:
+            groups.append([game])
+
+    sections = []
+    for group in groups:
+        emojis = "/".join(game.emoji for game in group)
+        titles = "/".join(game.title for game in group)
+        lines = [f"<b>{emojis} {titles}:</b>"]
+        lines.extend(f"  {payout.rule}: <b>{payout.multiplier_label}</b>" for payout in group[0].payouts)
+        sections.append("\n".join(lines))
+    return "\n\n".join(sections)
+
+# Раздел правил с коэффициентами, собранный из таблицы выплат
+RULES_TEXT = _render_rules()
@@ -1,11 +1,12 @@
 import logging
-import asyncio
 import re
-from html import escape
 from telegram import Update
 from telegram.ext import ContextTypes, ConversationHandler
 import database
-from config import MIN_BET, MAX_BET, MIN_WITHDRAWAL, ADMIN_CHAT_ID
+import games
+import leaderboard
+from config import MIN_BET, MAX_BET, MIN_WITHDRAWAL, ADMIN_CHAT_ID, DICE_ANIMATION_SECONDS
+import templates
 import ui
 
 logger = logging.getLogger(__name__)
@@ -17,9 +18,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обработка команды /start"""
     user = update.effective_user
     await database.add_user_if_not_exists(user.id, user.username)
-    logger.info(f"Пользователь {user.id} ({user.username}) запустил/перезапустил бота.")
+    logger.info("Пользователь %s (%s) запустил/перезапустил бота.", user.id, user.username, extra={"event": "navigation"})
     
-    text = f"👋 Привет, {user.mention_html()}!\n\nДобро пожаловать в наше казино! Выбери действие:"
+    text = templates.welcome(user.mention_html())
     reply_markup = ui.get_main_menu_keyboard()
     
     if update.message:
@@ -33,17 +34,17 @@ async def start_over(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Возврат в начало"""
     query = update.callback_query
     await query.answer()
-    logger.info(f"Пользователь {query.from_user.id} нажал 'Назад в начало'")
+    logger.info("Пользователь %s нажал 'Назад в начало'", query.from_user.id, extra={"event": "navigation"})
     return await start(update, context)
 
 async def back_to_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Возврат в главное меню"""
     query = update.callback_query
     await query.answer()
-    logger.info(f"Пользователь {query.from_user.id} нажал 'Назад в меню'")
+    logger.info("Пользователь %s нажал 'Назад в меню'", query.from_user.id, extra={"event": "navigation"})
     
     user = update.effective_user
-    text = f"👋 Привет, {user.mention_html()}!\n\nВы в главном меню. Выбери действие:"
+    text = templates.main_menu(user.mention_html())
     reply_markup = ui.get_main_menu_keyboard()
     
     await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='HTML')
@@ -55,16 +56,16 @@ async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
     user_id = update.effective_user.id
-    logger.info(f"Пользователь {user_id} запросил баланс")
+    logger.info("Пользователь %s запросил баланс", user_id, extra={"event": "navigation"})
     
     user_balance = await database.get_user_balance(user_id)
-    text = f"💰 Ваш текущий баланс: <b>{user_balance}</b> руб."
+    text = templates.balance(user_balance)
     
     await query.edit_message_text(text, reply_markup=ui.get_back_to_menu_keyboard_simple(), parse_mode='HTML')
 
 async def rules(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показать правила"""
-    logger.info("Обработка запроса правил")
+    logger.info("Обработка запроса правил", extra={"event": "navigation"})
     
     # Получаем query из update
     query = update.callback_query
@@ -72,27 +73,13 @@ async def rules(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # Если есть query (вызов из callback)
     if query:
         await query.answer()
-        logger.info(f"Пользователь {query.from_user.id} запросил правила через кнопку")
+        logger.info("Пользователь %s запросил правила через кнопку", query.from_user.id, extra={"event": "navigation"})
     # Если нет query (прямой вызов команды)
     elif update.message:
-        logger.info(f"Пользователь {update.effective_user.id} запросил правила через команду")
+        logger.info("Пользователь %s запросил правила через команду", update.effective_user.id, extra={"event": "navigation"})
     
-    rules_text = (
-        "<b>📜 Правила Игры и Коэффициенты</b>\n\n"
-        f"<b>Ставки:</b> от {MIN_BET} до {MAX_BET} руб.\n"
-        f"<b>Вывод:</b> от {MIN_WITHDRAWAL} руб.\n\n"
-        "<b>🎰 Слот-машина:</b>\n"
-        "  7️⃣7️⃣7️⃣ (Джекпот): <b>x50</b>\n"
-        "  🍇🍇🍇 (Три винограда): <b>x20</b>\n"
-        "  🍋🍋🍋 (Три лимона): <b>x10</b>\n"
-        "  🅱️🅱️🅱️ (Три BAR): <b>x5</b>\n\n"
-        "<b>🎲 Кости:</b>\n"
-        "  Выпало 6: <b>x3</b>\n"
-        "  Выпало 5: <b>x2</b>\n\n"
-        "<b>🏀/⚽ Баскетбол/Футбол:</b>\n"
-        "  Мяч в цели (попадание): <b>x2.5</b>\n"
-        "  Почти попал (рядом): <b>x1 (возврат ставки)</b>"
-    )
+    # Текст правил собран один раз при импорте templates
+    rules_text = templates.RULES
     
     if query:
         await query.edit_message_text(
@@ -111,9 +98,9 @@ async def play_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Начать игру"""
     query = update.callback_query
     await query.answer()
-    logger.info(f"Пользователь {query.from_user.id} начал игру")
+    logger.info("Пользователь %s начал игру", query.from_user.id, extra={"event": "bet"})
     
-    await query.edit_message_text("Выберите игру:", reply_markup=ui.get_game_choice_keyboard())
+    await query.edit_message_text(templates.CHOOSE_GAME, reply_markup=ui.get_game_choice_keyboard())
     return GAME_CHOICE
 
 async def choose_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -121,94 +108,85 @@ async def choose_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     query = update.callback_query
     await query.answer()
     game_type = query.data.split('_')[1]
-    logger.info(f"Пользователь {query.from_user.id} выбрал игру: {game_type}")
+    logger.info("Пользователь %s выбрал игру: %s", query.from_user.id, game_type, extra={"event": "bet"})
     
     context.user_data["game"] = game_type
-    await query.edit_message_text(f"Вы выбрали игру. Теперь введите вашу ставку (от {MIN_BET} до {MAX_BET} руб.):")
+    await query.edit_message_text(templates.ENTER_BET)
     return BET_PLACEMENT
 
 async def place_bet(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Размещение ставки"""
     user = update.effective_user
-    logger.info(f"Пользователь {user.id} вводит ставку")
+    logger.info("Пользователь %s вводит ставку", user.id, extra={"event": "bet"})
     
     try:
         bet = int(update.message.text)
-        logger.info(f"Ставка пользователя {user.id}: {bet} руб.")
+        logger.info("Ставка пользователя %s: %s руб.", user.id, bet, extra={"event": "bet"})
     except (ValueError, TypeError):
-        await update.message.reply_text("Пожалуйста, введите числовое значение.", reply_markup=ui.get_back_to_menu_keyboard_nested())
+        await update.message.reply_text(templates.NOT_A_NUMBER, reply_markup=ui.get_back_to_menu_keyboard_nested())
         return RESULT_SHOWN
 
     user_balance = await database.get_user_balance(user.id)
 
     if not (MIN_BET <= bet <= MAX_BET) or bet > user_balance:
-        error_msg = f"Некорректная ставка. Ваш баланс: {user_balance} руб."
-        logger.warning(f"Ошибка ставки: {error_msg}")
+        error_msg = templates.invalid_bet(user_balance)
+        logger.warning("Ошибка ставки: %s", error_msg)
         await update.message.reply_text(error_msg, reply_markup=ui.get_back_to_menu_keyboard_nested())
         return RESULT_SHOWN
 
-    await database.update_user_balance(user.id, -bet, relative=True)
-    
-    game_emoji = {"dice": "🎲", "basketball": "🏀", "football": "⚽", "dart": "🎰"}[context.user_data["game"]]
+    game = games.GAMES[context.user_data["game"]]
     
-    msg = await context.bot.send_dice(chat_id=update.effective_chat.id, emoji=game_emoji)
-    logger.info(f"Отправлен кубик для игры {context.user_data['game']}")
+    msg = await context.bot.send_dice(chat_id=update.effective_chat.id, emoji=game.emoji)
+    logger.info("Отправлен кубик для игры %s", game.key, extra={"event": "bet"})
     
-    await asyncio.sleep(3.5)
-    
-    dice_value = msg.dice.value
-    win_amount = 0
-    result_text = "К сожалению, вы проиграли."
-    game = context.user_data["game"]
-
-    if game == 'dart':
-        if dice_value == 64: 
-            win_amount, result_text = bet * 50, "ДЖЕКПОТ! 7️⃣7️⃣7️⃣"
-        elif dice_value == 43: 
-            win_amount, result_text = bet * 20, "Отлично! Три винограда! 🍇🍇🍇"
-        elif dice_value == 22: 
-            win_amount, result_text = bet * 10, "Неплохо! Три лимона! 🍋🍋🍋"
-        elif dice_value == 1: 
-            win_amount, result_text = bet * 5, "Выигрыш! Три BAR! 🅱️🅱️🅱️"
-    elif game == 'dice':
-        if dice_value == 6: 
-            win_amount, result_text = bet * 3, "Выпало 6! Ваш выигрыш!"
-        elif dice_value == 5: 
-            win_amount, result_text = bet * 2, "Выпало 5! Вы победили!"
-    elif game in ['basketball', 'football']:
-        if dice_value == 5: 
-            win_amount, result_text = int(bet * 2.5), "ГОЛ! Вы победили!"
-        elif dice_value == 4: 
-            win_amount, result_text = bet, "Почти! Ваша ставка возвращена."
+    # Значение известно сразу, ждать окончания анимации в обработчике не нужно
+    win_amount, result_text = game.settle(msg.dice.value, bet)
 
-    if win_amount > 0:
-        await database.update_user_balance(user.id, win_amount, relative=True)
-        logger.info(f"Пользователь {user.id} выиграл {win_amount} руб.")
-    
-    await database.update_user_stats(user.id, bet, win_amount)
-    
-    final_balance = await database.get_user_balance(user.id)
-    
-    text = (f"{result_text}\n\n"
-            f"Ваша ставка: {bet} руб. | Выигрыш: {win_amount} руб.\n"
-            f"Ваш новый баланс: <b>{final_balance}</b> руб.")
+    # Списание ставки, выигрыш и запись в журнал операций — одной транзакцией
+    final_balance = await database.settle_bet(user.id, bet, win_amount, ref=f"{game.key}:{msg.dice.value}")
+    if final_balance is None:
+        error_msg = templates.INSUFFICIENT_FUNDS
+        logger.warning("Ошибка ставки пользователя %s: %s", user.id, error_msg)
+        await update.message.reply_text(error_msg, reply_markup=ui.get_back_to_menu_keyboard_nested())
+        return RESULT_SHOWN
     
-    logger.info(f"Результат игры: {text}")
-    await update.message.reply_html(text, reply_markup=ui.get_back_to_menu_keyboard_nested())
+    if win_amount > 0:
+        logger.info("Пользователь %s выиграл %s руб.", user.id, win_amount, extra={"event": "bet"})
+    
+    text = templates.bet_result(result_text, bet, win_amount, final_balance)
+    
+    logger.info("Результат игры: %s", text, extra={"event": "bet"})
+    # Результат показываем после окончания анимации, не блокируя обработку обновлений
+    context.job_queue.run_once(
+        send_bet_result,
+        DICE_ANIMATION_SECONDS,
+        data=text,
+        chat_id=update.effective_chat.id,
+        user_id=user.id,
+    )
     return RESULT_SHOWN
 
+async def send_bet_result(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Отправка результата игры после анимации кубика"""
+    job = context.job
+    await context.bot.send_message(
+        job.chat_id,
+        job.data,
+        reply_markup=ui.get_back_to_menu_keyboard_nested(),
+        parse_mode='HTML'
+    )
+
 async def withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Запрос вывода средств"""
     query = update.callback_query
     await query.answer()
     user_id = update.effective_user.id
-    logger.info(f"Пользователь {user_id} запросил вывод средств")
+    logger.info("Пользователь %s запросил вывод средств", user_id)
     
     user_balance = await database.get_user_balance(user_id)
 
     if user_balance < MIN_WITHDRAWAL:
-        error_msg = (f"❌ Ошибка: минимальная сумма для вывода {MIN_WITHDRAWAL} руб. "
-                    f"У вас на балансе {user_balance} руб.")
+        error_msg = templates.withdrawal_too_low(user_balance)
         logger.warning(error_msg)
         await query.edit_message_text(
             error_msg,
@@ -216,7 +194,7 @@ async def withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         )
         return REQUEST_SENT
     
-    await query.edit_message_text(f"Ваш баланс: {user_balance} руб. Введите сумму, которую хотите вывести:")
+    await query.edit_message_text(templates.withdrawal_prompt(user_balance))
     return WITHDRAW_AMOUNT
 
 async def process_withdrawal_amount(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -224,17 +202,15 @@ async def process_withdrawal_amount(update: Update, context: ContextTypes.DEFAUL
     user = update.effective_user
     try:
         amount = int(update.message.text)
-        logger.info(f"Пользователь {user.id} ввел сумму для вывода: {amount} руб.")
+        logger.info("Пользователь %s ввел сумму для вывода: %s руб.", user.id, amount)
     except (ValueError, TypeError):
-        await update.message.reply_text("Пожалуйста, введите числовое значение.", reply_markup=ui.get_back_to_menu_keyboard_nested())
+        await update.message.reply_text(templates.NOT_A_NUMBER, reply_markup=ui.get_back_to_menu_keyboard_nested())
         return REQUEST_SENT
 
     user_balance = await database.get_user_balance(user.id)
 
     if amount < MIN_WITHDRAWAL or amount > user_balance:
-        error_text = (f"❌ Некорректная сумма.\n"
-                    f"• Минимальный вывод: {MIN_WITHDRAWAL} руб.\n"
-                    f"• Ваш баланс: {user_balance} руб.")
+        error_text = templates.invalid_withdrawal(user_balance)
         logger.warning(error_text)
         await update.message.reply_text(error_text, reply_markup=ui.get_back_to_menu_keyboard_nested())
         return REQUEST_SENT
@@ -244,10 +220,9 @@ async def process_withdrawal_amount(update: Update, context: ContextTypes.DEFAUL
     context.user_data['withdrawal_user_id'] = user.id
     
     # Просто подтверждаем запрос
-    success_msg = (f"✅ Ваш запрос на вывод {amount} руб. принят в обработку.\n"
-                 "Администратор свяжется с вами в ближайшее время для уточнения деталей.")
+    success_msg = templates.withdrawal_accepted(amount)
     
-    logger.info(f"Пользователь {user.id} запросил вывод {amount} руб.")
+    logger.info("Пользователь %s запросил вывод %s руб.", user.id, amount)
     await update.message.reply_text(
         success_msg,
         reply_markup=ui.get_back_to_menu_keyboard_nested()
@@ -257,31 +232,17 @@ async def process_withdrawal_amount(update: Update, context: ContextTypes.DEFAUL
 
 async def show_top(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показать топ игроков"""
-    logger.info("Обработка запроса топа игроков")
+    logger.info("Обработка запроса топа игроков", extra={"event": "navigation"})
     query = update.callback_query
     if query:
         await query.answer()
-        logger.info(f"Пользователь {query.from_user.id} запросил топ игроков через кнопку")
+        logger.info("Пользователь %s запросил топ игроков через кнопку", query.from_user.id, extra={"event": "navigation"})
     else:
-        logger.info(f"Пользователь {update.effective_user.id} запросил топ игроков через команду")
+        logger.info("Пользователь %s запросил топ игроков через команду", update.effective_user.id, extra={"event": "navigation"})
     
-    top_users = await database.get_top_users(10)
+    # Топ поддерживается в памяти, HTML кэшируется до изменения балансов лидеров
+    text = await leaderboard.render_top(update.effective_user.id)
     
-    if not top_users:
-        text = "🏆 Таблица лидеров пока пуста."
-    else:
-        text = "<b>🏆 Топ-10 игроков по балансу:</b>\n\n"
-        for i, user in enumerate(top_users):
-            rank = i + 1
-            display_name = user['nickname'] if user['nickname'] else user['username']
-            safe_display_name = escape(display_name) if display_name else f"User {user['user_id']}"
-            balance = user['balance']
-            
-            line = f"<b>{rank}.</b> {safe_display_name} — <code>{balance}</code> руб.\n"
-            if user['user_id'] == update.effective_user.id:
-                line = f"➡️ {line}"
-            text += line
-            
     reply_markup = ui.get_back_to_menu_keyboard_simple()
     
     if query:
@@ -292,35 +253,35 @@ async def show_top(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def request_nickname_from_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Запрос никнейма через команду"""
     user = update.effective_user
-    logger.info(f"Пользователь {user.id} запросил установку никнейма через команду")
-    await update.message.reply_text("Введите ваш новый никнейм (3-15 символов, буквы, цифры, _-):")
+    logger.info("Пользователь %s запросил установку никнейма через команду", user.id)
+    await update.message.reply_text(templates.ENTER_NICKNAME)
     return SETTING_NICKNAME
 
 async def request_nickname(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Запрос никнейма через кнопку"""
     query = update.callback_query
     await query.answer()
-    logger.info(f"Пользователь {query.from_user.id} запросил установку никнейма")
-    await query.edit_message_text("Введите ваш новый никнейм (3-15 символов, буквы, цифры, _-):")
+    logger.info("Пользователь %s запросил установку никнейма", query.from_user.id)
+    await query.edit_message_text(templates.ENTER_NICKNAME)
     return SETTING_NICKNAME
 
 async def save_nickname(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Сохранение никнейма"""
     nickname = update.message.text
     user = update.effective_user
-    logger.info(f"Пользователь {user.id} пытается установить никнейм: {nickname}")
+    logger.info("Пользователь %s пытается установить никнейм: %s", user.id, nickname)
     
     # Исправленное условие проверки никнейма
     if len(nickname) < 3 or len(nickname) > 15 or not re.match(r'^[a-zA-Z0-9_-]+$', nickname):
-        error_msg = "❌ <b>Ошибка:</b> Никнейм должен быть длиной от 3 до 15 символов и содержать только латинские буквы, цифры, знаки подчеркивания (_) или дефисы (-)."
-        logger.warning(f"Некорректный никнейм: {nickname}")
+        error_msg = templates.INVALID_NICKNAME
+        logger.warning("Некорректный никнейм: %s", nickname)
         await update.message.reply_html(error_msg)
         return SETTING_NICKNAME
 
     user_id = update.effective_user.id
     await database.set_user_nickname(user_id, nickname)
     
-    success_msg = f"✅ Ваш никнейм успешно изменен на: <b>{escape(nickname)}</b>"
+    success_msg = templates.nickname_saved(nickname)
     logger.info(success_msg)
     await update.message.reply_html(
         success_msg,
@@ -330,18 +291,18 @@ async def save_nickname(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
 
 async def unknown_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обработка неизвестных команд"""
-    logger.warning(f"Получена неизвестная команда: {update.message.text if update.message else 'callback'}")
+    logger.warning("Получена неизвестная команда: %s", update.message.text if update.message else 'callback')
     
     if update.message:
         await update.message.reply_text(
-            "Неизвестная команда. Используйте /start для начала работы.",
+            templates.UNKNOWN_COMMAND,
             reply_markup=ui.get_back_to_menu_keyboard_nested()
         )
     elif update.callback_query:
         query = update.callback_query
         await query.answer()
         await query.edit_message_text(
-            "Неизвестная команда. Возвращаемся в меню.",
+            templates.UNKNOWN_CALLBACK,
             reply_markup=ui.get_main_menu_keyboard()
         )
     return MAIN_MENU
@@ -0,0 +1,134 @@
+import logging
+from telegram.ext import ContextTypes
+from config import LEADERBOARD_SIZE
+import database
+import templates
+
+logger = logging.getLogger(__name__)
+
+# Сколько игроков держать в памяти сверх показываемых, чтобы падение баланса
+# одного из лидеров не требовало сразу перечитывать таблицу из БД
+RESERVE = 40
+
+class Leaderboard:
+    """Топ игроков по балансу в памяти, обновляемый при каждом изменении баланса.
+
+    Инвариант: у любого игрока вне таблицы баланс не больше минимального
+    баланса в таблице. Если его нельзя сохранить, таблица перечитывается из БД.
+    """
+
+    def __init__(self, size: int, reserve: int):
+        self.size = size
+        self.capacity = size + reserve
+        self._header = templates.leaderboard_header(size)
+        # user_id -> [баланс, отображаемое имя или None, если еще не загружено]
+        self._entries: dict[int, list] = {}
+        self._synced = False
+        # В таблице все пользователи БД, вставлять можно любого
+        self._complete = False
+        # Кэш отрисованных строк топа: [(user_id, строка)]
+        self._lines: list[tuple[int, str]] | None = None
+        self._html: str | None = None
+
+    def _invalidate(self):
+        self._lines = None
+        self._html = None
+
+    def on_user_changed(self, user_id: int, balance: int | None, name: str | None):
+        if not self._synced:
+            return
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            if name is not None:
+                entry[1] = name
+            if balance is not None:
+                cutoff = min(b for b, _ in self._entries.values())
+                if not self._complete and balance < cutoff:
+                    # Вне таблицы может оказаться кто-то богаче — убираем игрока
+                    del self._entries[user_id]
+                    if len(self._entries) < self.size:
+                        self._synced = False
+                else:
+                    entry[0] = balance
+            self._invalidate()
+            return
+
+        if balance is None:
+            return
+        if not self._complete and self._entries and balance < min(b for b, _ in self._entries.values()):
+            return
+        self._entries[user_id] = [balance, name]
+        if len(self._entries) > self.capacity:
+            weakest = min(self._entries, key=lambda uid: self._entries[uid][0])
+            del self._entries[weakest]
+            self._complete = False
+        self._invalidate()
+
+    async def resync(self):
+        """Полное перечитывание топа из БД (по индексу balance)"""
+        rows = await database.get_top_users(self.capacity)
+        self._entries = {row['user_id']: [row['balance'], row['nickname'] or row['username']] for row in rows}
+        self._complete = len(rows) < self.capacity
+        self._synced = True
+        self._invalidate()
+
+    async def _render_lines(self):
+        top = sorted(self._entries.items(), key=lambda item: -item[1][0])[:self.size]
+        missing = [user_id for user_id, (_, name) in top if name is None]
+        if missing:
+            for user_id, name in (await database.get_user_names(missing)).items():
+                if user_id in self._entries:
+                    self._entries[user_id][1] = name
+            # Пока загружались имена, таблица могла измениться
+            top = sorted(self._entries.items(), key=lambda item: -item[1][0])[:self.size]
+        self._lines = [
+            (user_id, templates.leaderboard_line(rank, user_id, name, balance))
+            for rank, (user_id, (balance, name)) in enumerate(top, start=1)
+        ]
+        self._html = templates.leaderboard(self._header, (line for _, line in self._lines))
+
+    def _reserve_rank(self, user_id: int) -> tuple[int, int] | None:
+        """Место и баланс игрока из запаса таблицы без запроса к БД.
+
+        По инварианту у игроков вне таблицы баланс не больше минимального в ней,
+        поэтому богаче игрока из таблицы могут быть только игроки в таблице.
+        """
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        balance = entry[0]
+        return sum(1 for b, _ in self._entries.values() if b > balance) + 1, balance
+
+    async def render(self, user_id: int) -> str:
+        """HTML таблицы лидеров с отметкой и местом запросившего пользователя"""
+        if not self._synced:
+            await self.resync()
+        if self._lines is None:
+            await self._render_lines()
+        # Кэш сбрасывается при изменении балансов, в том числе во время запроса места ниже
+        lines, html = self._lines, self._html
+        if not lines:
+            return templates.LEADERBOARD_EMPTY
+
+        if any(uid == user_id for uid, _ in lines):
+            return templates.leaderboard(self._header, (
+                templates.LEADERBOARD_MARK + line if uid == user_id else line for uid, line in lines
+            ))
+
+        rank = self._reserve_rank(user_id)
+        if rank is None:
+            # Запрос к БД стоит O(место), см. database.get_user_rank
+            rank = await database.get_user_rank(user_id)
+        if rank is None:
+            return html
+        return html + templates.leaderboard_own_rank(rank[0], rank[1])
+
+_leaderboard = Leaderboard(LEADERBOARD_SIZE, RESERVE)
+database.add_user_listener(_leaderboard.on_user_changed)
+
+async def render_top(user_id: int) -> str:
+    return await _leaderboard.render(user_id)
+
+async def resync_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Периодическая сверка топа с БД на случай пропущенных изменений"""
+    await _leaderboard.resync()
@@ -0,0 +1,86 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from telegram import Update
+
+# Обновление, которое обрабатывается в текущей задаче asyncio
+current_user_id: contextvars.ContextVar[int | None] = contextvars.ContextVar("current_user_id", default=None)
+current_update_id: contextvars.ContextVar[int | None] = contextvars.ContextVar("current_update_id", default=None)
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+def set_update_context(update: object) -> None:
+    """Привязка записей лога текущей задачи к обновлению и его пользователю"""
+    if isinstance(update, Update):
+        user = update.effective_user
+        current_user_id.set(user.id if user else None)
+        current_update_id.set(update.update_id)
+
+class ContextFilter(logging.Filter):
+    """Добавляет к записи id пользователя и обновления"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.user_id = current_user_id.get()
+        record.update_id = current_update_id.get()
+        return True
+
+class SamplingFilter(logging.Filter):
+    """Записывает только долю записей событий с большим потоком.
+
+    Событие задается через extra={"event": ...}; предупреждения и ошибки
+    записываются всегда.
+    """
+
+    def __init__(self, rates: dict[str, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(getattr(record, "event", None), 1.0)
+        return rate >= 1 or random.random() < rate
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key in ("user_id", "update_id", "event"):
+            value = getattr(record, key, None)
+            if value is not None:
+                data[key] = value
+        return json.dumps(data, ensure_ascii=False)
+
+def setup_logging(level: str, fmt: str, sample_rates: dict[str, float]) -> logging.handlers.QueueListener:
+    """Логирование через очередь: запись в stderr идет в отдельном потоке, не блокируя цикл событий"""
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT))
+
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # Отброшенные выборкой записи не попадают в очередь и не форматируются
+    queue_handler.addFilter(SamplingFilter(sample_rates))
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    # Дописываем оставшиеся в очереди записи при выходе
+    atexit.register(listener.stop)
+    return listener
@@ -1,6 +1,7 @@
 import os
 import asyncio
 import logging
+from telegram import Bot, Update
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -9,58 +10,120 @@ from telegram.ext import (
     MessageHandler,
     filters,
 )
-from config import TELEGRAM_TOKEN, WEBHOOK_MODE, PORT, WEBHOOK_URL, WEBHOOK_SECRET
+from config import (
+    TELEGRAM_TOKEN, TELEGRAM_API_URL, WEBHOOK_MODE, PORT, WEBHOOK_URL, WEBHOOK_SECRET,
+    MAX_CONCURRENT_UPDATES, LEADERBOARD_RESYNC_INTERVAL, GLOBAL_STATS_RECOMPUTE_INTERVAL,
+    BALANCE_SNAPSHOT_INTERVAL, UPDATE_QUEUE_SIZE, WEBHOOK_WORKERS, WORKER_QUEUE_SIZE, WORKER_ID,
+    PERSISTENCE_UPDATE_INTERVAL, PERSISTENCE_MAX_USERS, PERSISTENCE_IDLE_TTL,
+    METRICS_HOST, METRICS_PORT, METRICS_TOKEN,
+    LOG_LEVEL, LOG_FORMAT, LOG_SAMPLE_RATES,
+)
 import database
 import handlers
 import payments
 import admin
+import broadcast
+import leaderboard
+import metrics
+import ratelimit
+from update_processor import PerUserUpdateProcessor
+from persistence import SQLitePersistence
+from logging_setup import setup_logging
 
 # Настройка логирования
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", 
-    level=logging.INFO
-)
+setup_logging(LOG_LEVEL, LOG_FORMAT, LOG_SAMPLE_RATES)
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 async def post_init(application: Application) -> None:
     """Инициализация после запуска приложения"""
-    await database.init_db()
-    logger.info("База данных успешно инициализирована.")
+    await database.init_stats_buffer()
+    await payments.init_http_session()
+    # Таблица лидеров в памяти у каждого процесса своя
+    application.job_queue.run_repeating(
+        leaderboard.resync_job,
+        interval=LEADERBOARD_RESYNC_INTERVAL,
+        first=LEADERBOARD_RESYNC_INTERVAL,
+        name="leaderboard_resync",
+    )
+    if WORKER_ID != 0:
+        # Общие фоновые задачи выполняет только первый процесс-обработчик
+        return
+    # Индексы по большим таблицам строятся в фоне, после начала обработки обновлений
+    application.job_queue.run_once(admin.build_indexes_job, 0, name="build_indexes")
     payments.setup_payment_verification(application)
+    await broadcast.resume_broadcasts(application.bot)
+    application.job_queue.run_repeating(
+        admin.recompute_global_stats_job,
+        interval=GLOBAL_STATS_RECOMPUTE_INTERVAL,
+        first=GLOBAL_STATS_RECOMPUTE_INTERVAL,
+        name="global_stats_recompute",
+    )
+    application.job_queue.run_repeating(
+        admin.snapshot_balances_job,
+        interval=BALANCE_SNAPSHOT_INTERVAL,
+        first=BALANCE_SNAPSHOT_INTERVAL,
+        name="balance_snapshots",
+    )
+
+async def post_stop(application: Application) -> None:
+    """Остановка фоновых задач, пока бот еще может отправлять сообщения"""
+    await broadcast.stop_broadcasts()
+
+async def post_shutdown(application: Application) -> None:
+    """Освобождение ресурсов при остановке приложения"""
+    await payments.close_http_session()
+    await database.close_stats_buffer()
+    await database.close_pool()
+    database.release_bot_lock()
 
 def setup_handlers(application: Application) -> None:
     """Настройка всех обработчиков бота"""
     # Основные обработчики callback-запросов
-    application.add_handler(CallbackQueryHandler(handlers.play_game, pattern='^play$'))
     application.add_handler(CallbackQueryHandler(handlers.balance, pattern='^balance$'))
     application.add_handler(CallbackQueryHandler(handlers.rules, pattern='^rules$'))
     application.add_handler(CallbackQueryHandler(handlers.show_top, pattern='^top$'))
     application.add_handler(CallbackQueryHandler(handlers.start_over, pattern='^back_to_start$'))
     application.add_handler(CallbackQueryHandler(handlers.back_to_menu, pattern='^main_menu_from_nested$'))
-    application.add_handler(CallbackQueryHandler(handlers.request_nickname, pattern='^set_nickname$'))
-    application.add_handler(CallbackQueryHandler(payments.deposit_start, pattern='^deposit$'))
-    application.add_handler(CallbackQueryHandler(handlers.withdraw, pattern='^withdraw$'))
     
-    # Обработчики состояний
+    # Диалоги: игра, пополнение, вывод и никнейм. Повторный вход начинает диалог
+    # заново из любого состояния, например при нажатии «Играть» после ставки.
+    # Диалог, простоявший PERSISTENCE_IDLE_TTL, завершается, поэтому состояния
+    # брошенных диалогов не копятся в памяти; при запуске такие же старые
+    # состояния не загружаются из БД
     application.add_handler(ConversationHandler(
-        entry_points=[],
+        entry_points=[
+            CallbackQueryHandler(handlers.play_game, pattern='^play$'),
+            CallbackQueryHandler(payments.deposit_start, pattern='^deposit$'),
+            CallbackQueryHandler(handlers.withdraw, pattern='^withdraw$'),
+            CallbackQueryHandler(handlers.request_nickname, pattern='^set_nickname$'),
+            CommandHandler('set_nickname', handlers.request_nickname_from_command),
+            # Платеж ищется в БД, поэтому кнопка работает и после завершения диалога по таймауту
+            CallbackQueryHandler(payments.check_payment, pattern='^payment_confirmed$'),
+        ],
         states={
             handlers.GAME_CHOICE: [CallbackQueryHandler(handlers.choose_game, pattern='^game_')],
             handlers.BET_PLACEMENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, handlers.place_bet)],
             payments.DEPOSIT_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, payments.process_deposit_amount)],
             payments.LINK_SENT: [CallbackQueryHandler(payments.check_payment, pattern='^payment_confirmed$')],
             handlers.WITHDRAW_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, handlers.process_withdrawal_amount)],
-            handlers.SETTING_NICKNAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, handlers.save_nickname)]
+            handlers.SETTING_NICKNAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, handlers.save_nickname)],
+            # Конечные шаги: диалог ждет новой точки входа
+            handlers.RESULT_SHOWN: [],
+            handlers.REQUEST_SENT: [],
+            handlers.NICKNAME_SET: [],
         },
         fallbacks=[],
-        per_message=False
+        allow_reentry=True,
+        conversation_timeout=PERSISTENCE_IDLE_TTL,
+        per_message=False,
+        name="casino",
+        persistent=True
     ))
     
     # Команды
     application.add_handler(CommandHandler('start', handlers.start))
     application.add_handler(CommandHandler('top', handlers.show_top))
-    application.add_handler(CommandHandler('set_nickname', handlers.request_nickname_from_command))
     
     # Админские команды
     application.add_handler(CommandHandler('admin', admin.admin_panel))
@@ -69,52 +132,58 @@ def setup_handlers(application: Application) -> None:
     application.add_handler(CommandHandler('sub_balance', admin.subtract_from_balance))
     application.add_handler(CommandHandler('broadcast', admin.broadcast_message))
     application.add_handler(CommandHandler('server_stats', admin.show_server_stats))
+    application.add_handler(CommandHandler('history', admin.show_user_history))
+    application.add_handler(CommandHandler('export', admin.export_users))
+    application.add_handler(CommandHandler('import', admin.import_users))
+    application.add_handler(MessageHandler(
+        filters.Document.ALL & filters.CaptionRegex(r'^/import(@\w+)?(\s|$)'), admin.import_users
+    ))
     
     # Обработчик для неизвестных команд
     application.add_handler(MessageHandler(filters.ALL, handlers.unknown_command))
 
-async def start_webhook(application: Application) -> None:
+async def start_webhook(bot: Bot) -> None:
     """Запуск в режиме вебхука"""
-    await application.bot.set_webhook(
+    await bot.set_webhook(
         url=f"{WEBHOOK_URL}/telegram",
         secret_token=WEBHOOK_SECRET,
         drop_pending_updates=True
     )
-    logger.info(f"Webhook установлен на {WEBHOOK_URL}/telegram")
+    logger.info("Webhook установлен на %s/telegram", WEBHOOK_URL)
 
 async def start_polling(application: Application) -> None:
     """Запуск в режиме поллинга"""
     await application.bot.delete_webhook(drop_pending_updates=True)
     logger.info("Бот запущен в режиме поллинга...")
-    await application.start_polling(allowed_updates=True)
+    await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    
+    metrics_runner = await start_metrics_server()
+    try:
+        # Бесконечный цикл для поддержания работы приложения
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
-async def run_webhook_mode(application: Application) -> None:
-    """Запуск веб-сервера для обработки вебхуков"""
+async def start_metrics_server(sources=None):
+    """Запуск /metrics на внутреннем порту; None, если метрики отключены"""
+    if not METRICS_PORT:
+        return None
+    runner = await metrics.start_server(METRICS_HOST, METRICS_PORT, METRICS_TOKEN, sources)
+    logger.info("Метрики доступны на %s:%s/metrics", METRICS_HOST, METRICS_PORT)
+    return runner
+
+async def start_web_server(ingestor):
+    """Запуск веб-сервера для приема вебхуков"""
     from aiohttp import web
     
-    async def telegram_webhook(request):
-        """Обработчик входящих обновлений Telegram"""
-        # Проверка секретного токена
-        secret_token = request.headers.get("X-Telegram-Bot-Api-Secret-Token")
-        if secret_token != WEBHOOK_SECRET:
-            logger.warning(f"Неверный секретный токен: {secret_token}")
-            return web.Response(status=403)
-        
-        try:
-            data = await request.json()
-            logger.info(f"Получено обновление от Telegram")
-            await application.update_queue.put(data)
-            return web.Response()
-        except Exception as e:
-            logger.error(f"Ошибка обработки обновления: {e}")
-            return web.Response(status=500)
-    
     async def health_check(request):
         """Проверка работоспособности сервера"""
         return web.Response(text="OK")
     
     app = web.Application()
-    app.router.add_post('/telegram', telegram_webhook)
+    app.router.add_post('/telegram', ingestor.handle)
     app.router.add_get('/health', health_check)
     app.router.add_get('/', health_check)
     
@@ -123,33 +192,121 @@ async def run_webhook_mode(application: Application) -> None:
     site = web.TCPSite(runner, '0.0.0.0', PORT)
     await site.start()
     
-    logger.info(f"Сервер запущен на порту {PORT}")
-    await start_webhook(application)
+    logger.info("Сервер запущен на порту %s", PORT)
+    return runner
+
+async def run_webhook_mode(application: Application) -> None:
+    """Запуск веб-сервера для обработки вебхуков"""
+    from webhook import UpdateIngestor
     
-    # Бесконечный цикл для поддержания работы приложения
-    while True:
-        await asyncio.sleep(3600)
+    ingestor = UpdateIngestor(application)
+    runner = await start_web_server(ingestor)
+    metrics_runner = await start_metrics_server(ingestor.metric_sources)
+    try:
+        await start_webhook(application.bot)
+        
+        # Бесконечный цикл для поддержания работы приложения
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        await runner.cleanup()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
-async def main() -> None:
-    """Основная асинхронная функция запуска бота"""
-    # Создание приложения
-    builder = Application.builder().token(TELEGRAM_TOKEN)
+async def run_sharded_webhook_mode() -> None:
+    """Прием вебхуков с распределением по процессам-обработчикам по id пользователя"""
+    from workers import WorkerPool, ShardedUpdateIngestor
+    
+    # Схема БД создается до запуска обработчиков, чтобы они не создавали ее одновременно
+    await database.init_pool()
+    await database.init_db()
+    await database.close_pool()
+    
+    pool = WorkerPool(WEBHOOK_WORKERS, WORKER_QUEUE_SIZE)
+    pool.start()
+    supervisor = asyncio.create_task(pool.supervise())
+    runner = metrics_runner = None
+    try:
+        ingestor = ShardedUpdateIngestor(pool)
+        runner = await start_web_server(ingestor)
+        # Метрики отдает приемник, вместе со снимками процессов-обработчиков
+        metrics_runner = await start_metrics_server(ingestor.metric_sources)
+        async with Bot(TELEGRAM_TOKEN, base_url=TELEGRAM_API_URL) as bot:
+            await start_webhook(bot)
+        
+        # Бесконечный цикл для поддержания работы приложения
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        supervisor.cancel()
+        if runner is not None:
+            await runner.cleanup()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await pool.stop()
+
+def build_application() -> Application:
+    """Создание приложения с обработчиками"""
+    builder = Application.builder().token(TELEGRAM_TOKEN).base_url(TELEGRAM_API_URL)
+    # Разные пользователи обрабатываются параллельно, один пользователь — по порядку;
+    # лимит частоты проверяется до того, как обновление займет слот обработки.
+    # Принятых и не обработанных обновлений не больше UPDATE_QUEUE_SIZE: очередь
+    # Application сразу превращается в задачи и сама память не ограничивает,
+    # поэтому вебхук резервирует место в обработчике и отвечает 503 без него
+    builder.concurrent_updates(PerUserUpdateProcessor(
+        MAX_CONCURRENT_UPDATES, admit=ratelimit.admit, max_pending=UPDATE_QUEUE_SIZE
+    ))
     builder.post_init(post_init)
+    builder.post_stop(post_stop)
+    builder.post_shutdown(post_shutdown)
+    persistence = SQLitePersistence(PERSISTENCE_UPDATE_INTERVAL, PERSISTENCE_MAX_USERS, PERSISTENCE_IDLE_TTL)
+    builder.persistence(persistence)
     application = builder.build()
+    persistence.bind(application)
     
     # Настройка обработчиков
     setup_handlers(application)
-    
+    metrics.instrument_application(application)
+    return application
+
+async def run_application(application: Application, serve) -> None:
+    """Запуск приложения на время работы serve(application)"""
+    # post_init/post_stop/post_shutdown вызываются только run_polling/run_webhook,
+    # поэтому при ручном управлении жизненным циклом вызываем их сами.
+    # БД нужна уже в initialize: persistence загружает из нее состояния диалогов
+    await database.acquire_bot_lock()
+    await database.init_pool()
+    await database.init_db()
+    logger.info("База данных успешно инициализирована.")
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    try:
+        await serve(application)
+    finally:
+        if application.updater and application.updater.running:
+            await application.updater.stop()
+        await application.stop()
+        await application.post_stop(application)
+        await application.shutdown()
+        await application.post_shutdown(application)
+
+async def main() -> None:
+    """Основная асинхронная функция запуска бота"""
     # Запуск в соответствующем режиме
     if WEBHOOK_MODE and WEBHOOK_URL and WEBHOOK_SECRET:
         logger.info("Запуск в режиме WEBHOOK")
-        logger.info(f"URL: {WEBHOOK_URL}")
-        logger.info(f"PORT: {PORT}")
-        logger.info(f"Secret: {WEBHOOK_SECRET[:3]}...")
-        await run_webhook_mode(application)
+        logger.info("URL: %s", WEBHOOK_URL)
+        logger.info("PORT: %s", PORT)
+        logger.info("Secret: %s...", WEBHOOK_SECRET[:3])
+        if WEBHOOK_WORKERS > 1:
+            logger.info("Процессов-обработчиков: %s", WEBHOOK_WORKERS)
+            await run_sharded_webhook_mode()
+        else:
+            await run_application(build_application(), run_webhook_mode)
     else:
         logger.info("Запуск в режиме POLLING")
-        await start_polling(application)
+        await run_application(build_application(), start_polling)
 
 if __name__ == "__main__":
     asyncio.run(main())
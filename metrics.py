@@ -0,0 +1,208 @@
+"""Метрики в текстовом формате Prometheus.
+
+Счетчики, гистограммы и значения хранятся в памяти процесса и отдаются на
+/metrics отдельным веб-сервером (start_server) на внутреннем порту, в любом
+режиме запуска. Процессы-обработчики периодически присылают снимки своих
+метрик приемнику вебхуков, и он отдает их с меткой worker.
+"""
+import hmac
+import time
+from bisect import bisect_left
+from functools import wraps
+from telegram.ext import Application, ApplicationHandlerStop, ConversationHandler
+
+# Границы корзин гистограмм задержек, секунды
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_registry: dict[str, "_Metric"] = {}
+# Функции, обновляющие значения (например, глубину очередей) перед выгрузкой
+_collectors = []
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        if name in _registry:
+            raise ValueError(f"Метрика {name} уже зарегистрирована")
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # Значения по кортежам значений меток
+        self._values: dict[tuple, object] = {}
+        _registry[name] = self
+
+    def snapshot(self) -> dict:
+        return dict(self._values)
+
+    def render(self, lines: list[str], values: dict, extra_names: tuple = (), extra_values: tuple = ()):
+        names = extra_names + self.labelnames
+        for labels, value in values.items():
+            lines.append(f"{self.name}{_labels(names, extra_values + labels)} {_number(value)}")
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик"""
+
+    type = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(_Metric):
+    """Текущее значение величины"""
+
+    type = "gauge"
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram: "Histogram", labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+class Histogram(_Metric):
+    """Распределение значений по корзинам; значение хранится как [счетчики корзин, сумма]"""
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        entry = self._values.get(labels)
+        if entry is None:
+            # Последняя корзина — значения больше всех границ (+Inf)
+            entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def time(self, *labels) -> _Timer:
+        """Замер времени блока with"""
+        return _Timer(self, labels)
+
+    def snapshot(self) -> dict:
+        return {labels: [list(counts), total] for labels, (counts, total) in self._values.items()}
+
+    def render(self, lines: list[str], values: dict, extra_names: tuple = (), extra_values: tuple = ()):
+        names = extra_names + self.labelnames + ("le",)
+        for labels, (counts, total) in values.items():
+            label_values = extra_values + labels
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _number(bound)
+                lines.append(f"{self.name}_bucket{_labels(names, label_values + (le,))} {cumulative}")
+            base = _labels(names[:-1], label_values)
+            lines.append(f"{self.name}_sum{base} {_number(total)}")
+            lines.append(f"{self.name}_count{base} {cumulative}")
+
+def add_collector(callback):
+    """Регистрация функции, вызываемой перед каждой выгрузкой метрик"""
+    _collectors.append(callback)
+
+def _collect():
+    for callback in _collectors:
+        callback()
+
+def snapshot() -> dict:
+    """Значения всех метрик процесса для передачи в другой процесс"""
+    _collect()
+    return {name: metric.snapshot() for name, metric in _registry.items()}
+
+def render(sources: list[tuple[dict, dict]] = ()) -> str:
+    """Метрики процесса и снимки sources (метки, снимок) в формате Prometheus"""
+    _collect()
+    lines = []
+    for metric in _registry.values():
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        metric.render(lines, metric._values)
+        for labels, values in sources:
+            if values.get(metric.name):
+                metric.render(lines, values[metric.name], tuple(labels), tuple(labels.values()))
+    return "\n".join(lines) + "\n"
+
+# Обработчики обновлений
+HANDLER_SECONDS = Histogram("bot_handler_duration_seconds", "Время выполнения обработчиков обновлений", ("handler",))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в обработчиках обновлений", ("handler",))
+UPDATE_QUEUE_SIZE = Gauge("bot_update_queue_size", "Обновления в очереди приложения")
+
+def _instrument(handler):
+    callback = handler.callback
+    name = f"{callback.__module__}.{callback.__qualname__}"
+
+    @wraps(callback)
+    async def timed(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+
+    handler.callback = timed
+
+def _instrument_all(handlers):
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            _instrument_all(handler.entry_points)
+            for state_handlers in handler.states.values():
+                _instrument_all(state_handlers)
+            _instrument_all(handler.fallbacks)
+        else:
+            _instrument(handler)
+
+async def start_server(host: str, port: int, token: str = "", sources=None):
+    """Веб-сервер только с /metrics; возвращает AppRunner для остановки.
+
+    sources — функция, возвращающая снимки метрик других процессов для render.
+    """
+    from aiohttp import web
+
+    async def export(request: web.Request) -> web.Response:
+        authorization = request.headers.get("Authorization", "").encode()
+        if token and not hmac.compare_digest(authorization, f"Bearer {token}".encode()):
+            return web.Response(status=401)
+        body = render(sources() if sources else ())
+        return web.Response(body=body.encode(), headers={"Content-Type": CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get('/metrics', export)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+def instrument_application(application: Application):
+    """Замер времени и ошибок всех добавленных обработчиков и глубины очереди обновлений"""
+    for handlers in application.handlers.values():
+        _instrument_all(handlers)
+    add_collector(lambda: UPDATE_QUEUE_SIZE.set(application.update_queue.qsize()))
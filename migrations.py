@@ -0,0 +1,286 @@
+"""Версионированные миграции схемы БД.
+
+Номер последней примененной миграции хранится в PRAGMA user_version. Каждая
+миграция выполняется в одной транзакции вместе с обновлением user_version,
+поэтому при ошибке база остается на предыдущей версии.
+
+Индексы миграции только объявляют: их строит фоновая задача после запуска
+бота (build_index), по одному индексу за транзакцию, поэтому запуск бота не
+задерживается. SQLite блокирует запись на все время CREATE INDEX: остальные
+записи ждут до busy_timeout (5 сек.), а если индекс строится дольше, завершаются
+ошибкой SQLITE_BUSY (database is locked). Для ориентира: индекс users (balance)
+на 1 млн пользователей строится ~0.7 сек., transactions (user_id, tx_id) на
+5 млн записей — ~4 сек. На больших базах индексы лучше строить заранее или в
+период низкой нагрузки.
+"""
+import logging
+import time
+from collections.abc import Awaitable, Callable
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+class Migration:
+    """Шаг схемы: изменения в транзакции и индексы для фонового построения"""
+
+    def __init__(self, version: int, description: str,
+                 apply: Callable[[aiosqlite.Connection], Awaitable[None]],
+                 indexes: tuple[tuple[str, str], ...] = ()):
+        self.version = version
+        self.description = description
+        self.apply = apply
+        # (имя индекса, CREATE INDEX IF NOT EXISTS ...)
+        self.indexes = indexes
+
+MIGRATIONS: list[Migration] = []
+
+def migration(version: int, description: str, indexes: tuple[tuple[str, str], ...] = ()):
+    """Регистрация функции миграции; номера идут подряд с 1"""
+    def register(apply):
+        if version != len(MIGRATIONS) + 1:
+            raise ValueError(f"Миграция {version} зарегистрирована не по порядку")
+        MIGRATIONS.append(Migration(version, description, apply, indexes))
+        return apply
+    return register
+
+async def _ensure_column(db: aiosqlite.Connection, table: str, column: str, definition: str):
+    """Добавляет столбец в существующую таблицу, если его еще нет"""
+    cursor = await db.execute(f"PRAGMA table_info({table})")
+    if column not in [row['name'] for row in await cursor.fetchall()]:
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+# Схема до появления миграций создавалась через IF NOT EXISTS, поэтому первая
+# миграция так же применима и к новой базе, и к уже работающей
+@migration(1, "Начальная схема", indexes=(
+    ("idx_users_balance", "CREATE INDEX IF NOT EXISTS idx_users_balance ON users (balance)"),
+    # tx_id растет вместе со временем, поэтому индекс покрывает и историю, и сверку
+    ("idx_transactions_user", "CREATE INDEX IF NOT EXISTS idx_transactions_user ON transactions (user_id, tx_id)"),
+    ("idx_payments_status_created", "CREATE INDEX IF NOT EXISTS idx_payments_status_created ON payments (status, created_at)"),
+    ("idx_payments_user_created", "CREATE INDEX IF NOT EXISTS idx_payments_user_created ON payments (user_id, created_at)"),
+    ("idx_conversations_updated", "CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations (updated_at)"),
+))
+async def _initial_schema(db: aiosqlite.Connection):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            balance INTEGER DEFAULT 0 NOT NULL,
+            games_played INTEGER DEFAULT 0 NOT NULL,
+            games_won INTEGER DEFAULT 0 NOT NULL,
+            total_wagered INTEGER DEFAULT 0 NOT NULL,
+            net_profit INTEGER DEFAULT 0 NOT NULL,
+            nickname TEXT
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS payments (
+            label TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            status TEXT DEFAULT 'pending' NOT NULL,
+            created_at INTEGER NOT NULL,
+            credited_at INTEGER
+        )
+    ''')
+    await _ensure_column(db, "users", "is_blocked", "INTEGER DEFAULT 0 NOT NULL")
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            broadcast_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            status TEXT DEFAULT 'running' NOT NULL,
+            admin_chat_id INTEGER NOT NULL,
+            status_message_id INTEGER,
+            last_user_id INTEGER DEFAULT 0 NOT NULL,
+            sent INTEGER DEFAULT 0 NOT NULL,
+            failed INTEGER DEFAULT 0 NOT NULL,
+            blocked INTEGER DEFAULT 0 NOT NULL,
+            created_at INTEGER NOT NULL,
+            finished_at INTEGER
+        )
+    ''')
+    # Журнал операций с балансом: только добавление записей
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS transactions (
+            tx_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            amount INTEGER NOT NULL,
+            balance_after INTEGER NOT NULL,
+            ref TEXT,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS balance_snapshots (
+            user_id INTEGER NOT NULL,
+            tx_id INTEGER NOT NULL,
+            balance INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
+            PRIMARY KEY (user_id, tx_id)
+        )
+    ''')
+    # Общая статистика поддерживается триггерами в тех же транзакциях,
+    # что меняют пользователей, поэтому /server_stats не сканирует users
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS global_stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_users INTEGER NOT NULL,
+            total_balance INTEGER NOT NULL,
+            total_games INTEGER NOT NULL,
+            total_wager INTEGER NOT NULL,
+            casino_profit INTEGER NOT NULL,
+            recomputed_at INTEGER
+        )
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_insert_stats AFTER INSERT ON users
+        BEGIN
+            UPDATE global_stats SET
+                total_users = total_users + 1,
+                total_balance = total_balance + NEW.balance,
+                total_games = total_games + NEW.games_played,
+                total_wager = total_wager + NEW.total_wagered,
+                casino_profit = casino_profit + NEW.net_profit
+            WHERE id = 1;
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_delete_stats AFTER DELETE ON users
+        BEGIN
+            UPDATE global_stats SET
+                total_users = total_users - 1,
+                total_balance = total_balance - OLD.balance,
+                total_games = total_games - OLD.games_played,
+                total_wager = total_wager - OLD.total_wagered,
+                casino_profit = casino_profit - OLD.net_profit
+            WHERE id = 1;
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_update_stats
+        AFTER UPDATE OF balance, games_played, total_wagered, net_profit ON users
+        BEGIN
+            UPDATE global_stats SET
+                total_balance = total_balance + NEW.balance - OLD.balance,
+                total_games = total_games + NEW.games_played - OLD.games_played,
+                total_wager = total_wager + NEW.total_wagered - OLD.total_wagered,
+                casino_profit = casino_profit + NEW.net_profit - OLD.net_profit
+            WHERE id = 1;
+        END
+    ''')
+    # Состояние диалогов для persistence: данные пользователей и состояния ConversationHandler
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state TEXT NOT NULL,
+            updated_at INTEGER NOT NULL,
+            PRIMARY KEY (name, key)
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value
+        )
+    ''')
+    # Балансы, появившиеся до журнала, становятся начальными снимками. Если
+    # журнал уже ведется, снимок ставится на его последнюю запись: снимок на
+    # tx_id 0 учел бы операции журнала в балансе дважды
+    cursor = await db.execute("SELECT 1 FROM balance_snapshots LIMIT 1")
+    if not await cursor.fetchone():
+        cursor = await db.execute("SELECT COALESCE(MAX(tx_id), 0) FROM transactions")
+        tx_id = (await cursor.fetchone())[0]
+        await db.execute(
+            "INSERT INTO balance_snapshots (user_id, tx_id, balance, created_at) "
+            "SELECT user_id, ?, balance, ? FROM users "
+            "WHERE balance != 0 OR user_id IN (SELECT user_id FROM transactions)",
+            (tx_id, int(time.time()))
+        )
+        if tx_id:
+            # Операции до снимка уже учтены, snapshot_balances начнет после них
+            await db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('snapshot_tx_id', ?)", (tx_id,)
+            )
+
+# Поиск пользователя по @username или нику в админских командах
+@migration(2, "Индексы users по username и nickname", indexes=(
+    ("idx_users_username", "CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)"),
+    ("idx_users_nickname", "CREATE INDEX IF NOT EXISTS idx_users_nickname ON users (nickname) WHERE nickname IS NOT NULL"),
+))
+async def _user_name_indexes(db: aiosqlite.Connection):
+    # Схема не меняется, индексы строятся в фоне
+    pass
+
+# Сумма, фактически поступившая по операции ЮMoney (для ручной проверки)
+@migration(3, "Поступившая сумма платежа")
+async def _payment_received_amount(db: aiosqlite.Connection):
+    await _ensure_column(db, "payments", "received_amount", "REAL")
+
+async def get_version(db: aiosqlite.Connection) -> int:
+    cursor = await db.execute("PRAGMA user_version")
+    return (await cursor.fetchone())[0]
+
+async def check_version(db: aiosqlite.Connection) -> int:
+    """Проверка, что схема в актуальной версии, без применения миграций"""
+    version = await get_version(db)
+    latest = MIGRATIONS[-1].version
+    if version != latest:
+        raise RuntimeError(f"Версия схемы БД {version}, а код ожидает {latest}: миграции применяет бот при запуске")
+    return version
+
+async def migrate(db: aiosqlite.Connection) -> int:
+    """Применение недостающих миграций, возвращает версию схемы"""
+    version = await get_version(db)
+    latest = MIGRATIONS[-1].version
+    if version > latest:
+        raise RuntimeError(f"Версия схемы БД {version} новее известной коду ({latest})")
+    for step in MIGRATIONS[version:]:
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            # Другой процесс мог применить шаг между чтением версии и блокировкой
+            version = await get_version(db)
+            if version >= step.version:
+                await db.commit()
+                continue
+            await step.apply(db)
+            # PRAGMA не принимает параметры; версия — число из кода
+            await db.execute(f"PRAGMA user_version = {step.version}")
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        logger.info("Применена миграция %s: %s", step.version, step.description)
+        version = step.version
+    return version
+
+async def pending_indexes(db: aiosqlite.Connection) -> list[tuple[str, str]]:
+    """Объявленные примененными миграциями индексы, которых еще нет в базе"""
+    version = await get_version(db)
+    cursor = await db.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+    existing = {row[0] for row in await cursor.fetchall()}
+    return [
+        (name, sql)
+        for step in MIGRATIONS[:version]
+        for name, sql in step.indexes
+        if name not in existing
+    ]
+
+async def build_index(db: aiosqlite.Connection, name: str, sql: str):
+    """Построение одного индекса в отдельной транзакции"""
+    started = time.monotonic()
+    await db.execute("BEGIN IMMEDIATE")
+    try:
+        await db.execute(sql)
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+    logger.info("Построен индекс %s за %.2f сек.", name, time.monotonic() - started)
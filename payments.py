@@ -1,17 +1,93 @@
 import logging
-import requests
 import asyncio
+import random
+import time
 import uuid
+from datetime import datetime, timezone
+import aiohttp
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError
 from telegram.ext import ContextTypes, Application
 import database
+import metrics
 from ui import get_back_to_menu_keyboard_nested, get_payment_confirmation_keyboard, get_deposit_retry_keyboard
-from config import MIN_DEPOSIT, MAX_DEPOSIT, YOOMONEY_ACCESS_TOKEN, YOOMONEY_WALLET
+from config import (
+    MIN_DEPOSIT, MAX_DEPOSIT, YOOMONEY_ACCESS_TOKEN, YOOMONEY_WALLET,
+    YOOMONEY_TIMEOUT, YOOMONEY_MAX_CONCURRENCY, YOOMONEY_RETRIES,
+    PAYMENT_POLL_INTERVAL, PAYMENT_PENDING_TTL, YOOMONEY_FEE_PERCENT, ADMIN_CHAT_ID,
+)
 
 logger = logging.getLogger(__name__)
 
-# Состояния разговора для пополнения баланса
-DEPOSIT_AMOUNT, LINK_SENT = range(2)
+# Состояния разговора для пополнения баланса; значения не должны совпадать
+# с состояниями из handlers, они в одном ConversationHandler
+DEPOSIT_AMOUNT, LINK_SENT = range(8, 10)
+
+YOOMONEY_API_URL = "https://yoomoney.ru/api"
+# Базовая задержка между повторами запроса, секунды
+YOOMONEY_RETRY_BASE_DELAY = 0.5
+# Максимальный размер страницы operation-history
+OPERATION_HISTORY_PAGE_SIZE = 100
+# Доля запрошенной суммы, которая должна поступить на кошелек после комиссии
+MIN_RECEIVED_SHARE = 1 - YOOMONEY_FEE_PERCENT / 100
+
+YOOMONEY_SECONDS = metrics.Histogram("yoomoney_request_duration_seconds", "Время запросов к API ЮMoney (каждой попытки)", ("method",))
+YOOMONEY_REQUESTS = metrics.Counter(
+    "yoomoney_requests_total", "Попытки запросов к API ЮMoney по результату: ok, rejected, retryable, network", ("method", "result")
+)
+
+# Общая HTTP-сессия с пулом keep-alive соединений к API ЮMoney
+_http_session: aiohttp.ClientSession | None = None
+_http_semaphore = asyncio.Semaphore(YOOMONEY_MAX_CONCURRENCY)
+
+async def init_http_session():
+    """Создание HTTP-сессии (вызывается из post_init)"""
+    global _http_session
+    if _http_session is not None:
+        return
+    connector = aiohttp.TCPConnector(limit=YOOMONEY_MAX_CONCURRENCY, keepalive_timeout=60, ttl_dns_cache=300)
+    _http_session = aiohttp.ClientSession(
+        connector=connector,
+        headers={"Authorization": f"Bearer {YOOMONEY_ACCESS_TOKEN}"},
+        timeout=aiohttp.ClientTimeout(total=YOOMONEY_TIMEOUT),
+    )
+
+async def close_http_session():
+    """Закрытие HTTP-сессии при остановке бота"""
+    global _http_session
+    if _http_session is None:
+        return
+    session, _http_session = _http_session, None
+    await session.close()
+
+async def yoomoney_request(method: str, data: dict) -> dict | None:
+    """POST-запрос к API ЮMoney с повторами при сетевых ошибках и ответах 429/5xx"""
+    if _http_session is None:
+        await init_http_session()
+    url = f"{YOOMONEY_API_URL}/{method}"
+    for attempt in range(1, YOOMONEY_RETRIES + 1):
+        try:
+            async with _http_semaphore:
+                with YOOMONEY_SECONDS.time(method):
+                    async with _http_session.post(url, data=data) as response:
+                        if response.status == 200:
+                            result = await response.json(content_type=None)
+                            YOOMONEY_REQUESTS.inc(method, "ok")
+                            return result
+                        error = f"HTTP {response.status}"
+                        if response.status != 429 and response.status < 500:
+                            YOOMONEY_REQUESTS.inc(method, "rejected")
+                            logger.error("Запрос %s к ЮMoney отклонен: %s", method, error)
+                            return None
+                        YOOMONEY_REQUESTS.inc(method, "retryable")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            YOOMONEY_REQUESTS.inc(method, "network")
+            error = repr(e)
+        logger.warning("Запрос %s к ЮMoney не удался (попытка %s/%s): %s", method, attempt, YOOMONEY_RETRIES, error)
+        if attempt < YOOMONEY_RETRIES:
+            # Экспоненциальная задержка с полным джиттером
+            await asyncio.sleep(random.uniform(0, YOOMONEY_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+    return None
 
 def create_payment_link(amount: float, user_id: int):
     """Создает платежную ссылку ЮMoney для оплаты картой"""
@@ -40,39 +116,48 @@ def create_payment_link(amount: float, user_id: int):
             "payment_id": payment_id
         }
     except Exception as e:
-        logger.error(f"Ошибка создания платежной ссылки: {e}")
+        logger.error("Ошибка создания платежной ссылки: %s", e)
         return None
 
-async def process_payment_request(payment_id: str, user_id: int, amount: int):
-    """Проверяет статус платежа по его ID"""
+def _operation_amount(operation: dict) -> float:
+    """Поступившая сумма операции из истории ЮMoney; 0, если ее нет"""
+    try:
+        return float(operation.get("amount", 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+async def process_payment_request(payment_id: str, user_id: int, amount: int) -> str | None:
+    """Проверяет платеж по его ID.
+
+    Возвращает статус платежа после проверки: 'credited', 'review' (поступило
+    меньше ожидаемого) или None, если оплата еще не найдена.
+    """
     if not YOOMONEY_ACCESS_TOKEN:
         logger.error("YOOMONEY_ACCESS_TOKEN не настроен!")
-        return False
+        return None
     
     try:
         # Проверяем историю операций
-        response = requests.post(
-            "https://yoomoney.ru/api/operation-history",
-            headers={"Authorization": f"Bearer {YOOMONEY_ACCESS_TOKEN}"},
-            data={
-                "label": payment_id,
-                "type": "deposition"
-            },
-            timeout=15
-        )
+        data = await yoomoney_request("operation-history", {
+            "label": payment_id,
+            "type": "deposition"
+        })
         
-        if response.status_code == 200:
-            data = response.json()
+        if data:
             # Ищем наш платеж в истории
             for operation in data.get("operations", []):
                 if operation.get("status") == "success" and operation.get("label") == payment_id:
-                    # Зачисляем средства
-                    await database.update_user_balance(user_id, amount, relative=True)
-                    return True
-        return False
+                    # Зачисляем средства (повторное зачисление того же платежа невозможно)
+                    await database.add_pending_payment(payment_id, user_id, amount)
+                    payment = await database.credit_payment(payment_id, _operation_amount(operation), MIN_RECEIVED_SHARE)
+                    if payment is None:
+                        # Платеж уже обработан параллельно, например фоновой сверкой
+                        payment = await database.get_payment(payment_id)
+                    return payment['status']
+        return None
     except Exception as e:
-        logger.error(f"Ошибка проверки платежа: {e}")
-        return False
+        logger.error("Ошибка проверки платежа: %s", e)
+        return None
 
 async def deposit_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Начало процесса пополнения баланса"""
@@ -107,7 +192,7 @@ async def process_deposit_amount(update: Update, context: ContextTypes.DEFAULT_T
     """Обработка введенной суммы для пополнения"""
     try:
         amount = int(update.message.text)
-        logger.info(f"Пользователь {update.effective_user.id} ввел сумму: {amount} руб.")
+        logger.info("Пользователь %s ввел сумму: %s руб.", update.effective_user.id, amount)
     except (ValueError, TypeError):
         await update.message.reply_text(
             "❌ Пожалуйста, введите целое число.",
@@ -144,7 +229,7 @@ async def process_deposit_amount(update: Update, context: ContextTypes.DEFAULT_T
 async def create_payment_link_for_user(update: Update, context: ContextTypes.DEFAULT_TYPE, amount: int):
     """Создание и отправка платежной ссылки"""
     user = update.effective_user
-    logger.info(f"Создание платежной ссылки для {user.id} на сумму {amount} руб.")
+    logger.info("Создание платежной ссылки для %s на сумму %s руб.", user.id, amount)
     
     # Убираем reply_to_message_id чтобы избежать ошибки "Message to be replied not found"
     processing_msg = await context.bot.send_message(
@@ -162,9 +247,10 @@ async def create_payment_link_for_user(update: Update, context: ContextTypes.DEF
         )
         return LINK_SENT
     
-    # Сохраняем данные платежа в контексте
+    # Сохраняем данные платежа в контексте и в БД для фоновой сверки
     context.user_data['payment_id'] = payment_data["payment_id"]
     context.user_data['payment_amount'] = amount
+    await database.add_pending_payment(payment_data["payment_id"], user.id, amount)
     
     text = (
         f"💳 <b>Пополнение баланса на {amount} руб.</b>\n\n"
@@ -189,25 +275,39 @@ async def check_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     query = update.callback_query
     await query.answer()
     
-    payment_id = context.user_data.get('payment_id')
-    amount = context.user_data.get('payment_amount', 0)
     user_id = update.effective_user.id
     
-    if not payment_id or not amount:
+    # Данные платежа берем из БД: user_data теряется при перезапуске бота
+    payment = None
+    payment_id = context.user_data.get('payment_id')
+    if payment_id:
+        payment = await database.get_payment(payment_id)
+    if payment is None or payment['user_id'] != user_id:
+        payment = await database.get_latest_payment(user_id)
+    
+    if not payment:
         await context.bot.send_message(
             update.effective_chat.id,
             "❌ Ошибка: данные платежа не найдены. Начните процесс заново."
         )
         return LINK_SENT
     
+    payment_id = payment['label']
+    amount = payment['amount']
+    
     # Убираем reply_to_message_id чтобы избежать ошибки
     processing_msg = await context.bot.send_message(
         update.effective_chat.id,
         f"🔍 Проверяем ваш платеж {payment_id}..."
     )
     
-    # Проверяем платеж
-    if await process_payment_request(payment_id, user_id, amount):
+    # Уже обработанный платеж (например, фоновой сверкой) повторно не проверяем
+    status = payment['status']
+    if status not in ('credited', 'review'):
+        status = await process_payment_request(payment_id, user_id, amount)
+        if status == 'review':
+            await notify_payment_review(context.bot, payment_id, user_id, amount)
+    if status == 'credited':
         # Платеж подтвержден - зачисляем средства
         new_balance = await database.get_user_balance(user_id)
         
@@ -217,6 +317,12 @@ async def check_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
             f"Ваш новый баланс: <b>{new_balance}</b> руб.\n\n"
             f"<b>ID платежа:</b> <code>{payment_id}</code>"
         )
+    elif status == 'review':
+        text = (
+            f"⚠️ <b>Платеж на проверке</b>\n\n"
+            f"По платежу {payment_id} поступило меньше запрошенной суммы.\n"
+            "Администратор проверит его и зачислит средства вручную."
+        )
     else:
         text = (
             f"⌛ <b>Платеж еще не поступил</b>\n\n"
@@ -235,10 +341,91 @@ async def check_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     )
     return LINK_SENT
 
+async def reconcile_payments(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Фоновая сверка всех ожидающих платежей одним проходом по истории операций"""
+    created_after = int(time.time()) - PAYMENT_PENDING_TTL
+    expired = await database.expire_pending_payments(created_after)
+    if expired:
+        logger.info("Фоновая сверка: просрочено платежей %s", expired)
+    pending = {payment['label']: payment for payment in await database.get_pending_payments(created_after)}
+    if not pending:
+        return
+    
+    since = datetime.fromtimestamp(min(p['created_at'] for p in pending.values()), tz=timezone.utc)
+    params = {
+        "type": "deposition",
+        "from": since.isoformat(timespec="seconds"),
+        "records": OPERATION_HISTORY_PAGE_SIZE,
+    }
+    credited = 0
+    while pending:
+        data = await yoomoney_request("operation-history", params)
+        if not data:
+            break
+        for operation in data.get("operations", []):
+            label = operation.get("label")
+            if operation.get("status") != "success" or label not in pending:
+                continue
+            pending.pop(label)
+            payment = await database.credit_payment(label, _operation_amount(operation), MIN_RECEIVED_SHARE)
+            if payment is None:
+                continue
+            if payment['status'] == 'credited':
+                credited += 1
+                await notify_payment_credited(context, label, payment['user_id'], payment['amount'])
+            else:
+                await notify_payment_review(context.bot, label, payment['user_id'], payment['amount'])
+        # Постраничный обход истории
+        next_record = data.get("next_record")
+        if not next_record:
+            break
+        params["start_record"] = next_record
+    
+    if credited:
+        logger.info("Фоновая сверка: зачислено платежей %s", credited)
+
+async def notify_payment_credited(context: ContextTypes.DEFAULT_TYPE, payment_id: str, user_id: int, amount: int):
+    """Уведомление пользователя об автоматическом зачислении"""
+    new_balance = await database.get_user_balance(user_id)
+    text = (
+        f"✅ <b>Платеж подтвержден!</b>\n\n"
+        f"На ваш счет зачислено: <b>{amount}</b> руб.\n"
+        f"Ваш новый баланс: <b>{new_balance}</b> руб.\n\n"
+        f"<b>ID платежа:</b> <code>{payment_id}</code>"
+    )
+    try:
+        await context.bot.send_message(user_id, text, parse_mode='HTML')
+    except TelegramError as e:
+        logger.warning("Не удалось уведомить пользователя %s о зачислении: %s", user_id, e)
+
+async def notify_payment_review(bot, payment_id: str, user_id: int, amount: int):
+    """Сообщение администратору о платеже с суммой меньше ожидаемой"""
+    logger.warning("Платеж %s пользователя %s на %s руб. отправлен на ручную проверку", payment_id, user_id, amount)
+    if not ADMIN_CHAT_ID:
+        return
+    payment = await database.get_payment(payment_id)
+    text = (
+        f"⚠️ <b>Платеж на ручной проверке</b>\n\n"
+        f"Пользователь: <code>{user_id}</code>\n"
+        f"Запрошено: <b>{amount}</b> руб., поступило: <b>{payment['received_amount']}</b> руб.\n"
+        f"<b>ID платежа:</b> <code>{payment_id}</code>\n\n"
+        "Средства не зачислены; при необходимости зачислите их через /add_balance."
+    )
+    try:
+        await bot.send_message(ADMIN_CHAT_ID, text, parse_mode='HTML')
+    except TelegramError as e:
+        logger.warning("Не удалось уведомить администратора о платеже %s: %s", payment_id, e)
+
 def setup_payment_verification(application: Application):
     """Инициализация платежной системы"""
     if YOOMONEY_ACCESS_TOKEN:
         logger.info("Платежная система ЮMoney инициализирована")
-        logger.info(f"Кошелек получателя: {YOOMONEY_WALLET}")
+        logger.info("Кошелек получателя: %s", YOOMONEY_WALLET)
+        application.job_queue.run_repeating(
+            reconcile_payments,
+            interval=PAYMENT_POLL_INTERVAL,
+            first=PAYMENT_POLL_INTERVAL,
+            name="payment_reconciliation",
+        )
     else:
-        logger.warning("YOOMONEY_ACCESS_TOKEN не настроен! Автопроверка платежей работать не будет!")
\ No newline at end of file
+        logger.warning("YOOMONEY_ACCESS_TOKEN не настроен! Автопроверка платежей работать не будет!")
@@ -0,0 +1,187 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from telegram.ext import Application, BasePersistence, PersistenceInput
+import database
+
+logger = logging.getLogger(__name__)
+
+# Данные пользователя не выгружаются раньше этого простоя, секунды: к этому
+# времени начатые для него обработчики и задачи уже завершились, а их изменения
+# Application уже передал на запись (простой не меньше двух update_interval)
+MIN_EVICT_IDLE = 60
+
+def _encode(value) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), sort_keys=True)
+
+class SQLitePersistence(BasePersistence):
+    """Хранение context.user_data и состояний ConversationHandler в SQLite.
+
+    Данные пользователя загружаются из БД при первом обращении, а не при запуске,
+    и выгружаются из памяти после простоя или при превышении max_users (LRU).
+    Выгрузка идет через Application.drop_user_data, поэтому следующий прогон
+    update_persistence вызывает drop_user_data и для выгруженных пользователей:
+    их строки в БД при этом сохраняются.
+    Изменения за один прогон Application.update_persistence записываются одной
+    транзакцией, неизменившиеся данные не перезаписываются.
+    """
+
+    def __init__(self, update_interval: float, max_users: int, idle_ttl: int):
+        super().__init__(
+            store_data=PersistenceInput(chat_data=False, bot_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.max_users = max_users
+        self.idle_ttl = idle_ttl
+        self._application: Application | None = None
+        # user_id -> [время последнего обращения, JSON версии из БД]; порядок — LRU
+        self._resident: OrderedDict[int, list] = OrderedDict()
+        # Изменения, ожидающие записи
+        self._dirty_users: dict[int, str] = {}
+        self._dropped_users: set[int] = set()
+        # Выгруженные из памяти пользователи, drop_user_data для которых еще не вызван
+        self._evicted: set[int] = set()
+        # (имя диалога, ключ) -> JSON состояния или None, если диалог завершен
+        self._dirty_conversations: dict[tuple[str, str], str | None] = {}
+        self._write_task: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+
+    def bind(self, application: Application):
+        """Приложение, из памяти которого выгружаются данные неактивных пользователей"""
+        self._application = application
+
+    async def get_user_data(self) -> dict:
+        # Данные загружаются по одному пользователю в refresh_user_data
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        # Состояния, не менявшиеся дольше idle_ttl, считаются брошенными
+        rows = await database.load_conversations(name, int(time.time()) - self.idle_ttl)
+        return {tuple(json.loads(row['key'])): json.loads(row['state']) for row in rows}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        entry = self._resident.get(user_id)
+        if entry is not None:
+            entry[0] = time.monotonic()
+            self._resident.move_to_end(user_id)
+            return
+        encoded = self._dirty_users.get(user_id) or await database.load_user_data(user_id)
+        if encoded:
+            for key, value in json.loads(encoded).items():
+                user_data.setdefault(key, value)
+        self._resident[user_id] = [time.monotonic(), encoded or "{}"]
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        encoded = _encode(data)
+        entry = self._resident.get(user_id)
+        if entry is None or entry[1] != encoded:
+            if entry is not None:
+                entry[1] = encoded
+            self._dropped_users.discard(user_id)
+            self._dirty_users[user_id] = encoded
+        await self._schedule_write()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        if user_id in self._evicted:
+            self._evicted.discard(user_id)
+            # Вернувшийся после выгрузки пользователь: Application не передает
+            # изменения удаляемых id, поэтому сохраняем их сами
+            if user_id in self._application.user_data:
+                await self.update_user_data(user_id, self._application.user_data[user_id])
+            return
+        self._resident.pop(user_id, None)
+        self._dirty_users.pop(user_id, None)
+        self._dropped_users.add(user_id)
+        await self._schedule_write()
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object | None) -> None:
+        self._dirty_conversations[(name, _encode(key))] = None if new_state is None else _encode(new_state)
+        await self._schedule_write()
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        await self._write()
+
+    async def _schedule_write(self):
+        # Application.update_persistence запускает все update_* одновременно,
+        # поэтому изменения одного прогона попадают в одну транзакцию
+        if self._write_task is None:
+            self._write_task = asyncio.create_task(self._write_soon())
+        await asyncio.shield(self._write_task)
+
+    async def _write_soon(self):
+        await asyncio.sleep(0)
+        self._write_task = None
+        await self._write()
+
+    async def _write(self):
+        async with self._lock:
+            users, self._dirty_users = self._dirty_users, {}
+            dropped, self._dropped_users = self._dropped_users, set()
+            conversations, self._dirty_conversations = self._dirty_conversations, {}
+            if users or dropped or conversations:
+                try:
+                    await database.save_persistent_state(
+                        list(users.items()),
+                        list(dropped),
+                        [(name, key, state) for (name, key), state in conversations.items() if state is not None],
+                        [(name, key) for (name, key), state in conversations.items() if state is None],
+                    )
+                except Exception as e:
+                    # Изменения остаются в буфере до следующей записи
+                    logger.error("Ошибка записи состояния диалогов: %s", e)
+                    for user_id, encoded in users.items():
+                        self._dirty_users.setdefault(user_id, encoded)
+                    self._dropped_users |= dropped - self._dirty_users.keys()
+                    for key, state in conversations.items():
+                        self._dirty_conversations.setdefault(key, state)
+                    return
+            self._evict()
+
+    def _evict(self):
+        if self._application is None:
+            return
+        now = time.monotonic()
+        min_idle = max(MIN_EVICT_IDLE, 2 * self.update_interval)
+        overflow = len(self._resident) - self.max_users
+        evicted = []
+        for user_id, (accessed, _) in self._resident.items():
+            idle = now - accessed
+            if idle < min_idle or (idle < self.idle_ttl and len(evicted) >= overflow):
+                break
+            if user_id not in self._dirty_users:
+                evicted.append(user_id)
+        for user_id in evicted:
+            del self._resident[user_id]
+            self._evicted.add(user_id)
+            self._application.drop_user_data(user_id)
+        if evicted:
+            logger.debug("Выгружены из памяти данные %s неактивных пользователей", len(evicted))
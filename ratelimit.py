@@ -0,0 +1,105 @@
+"""Ограничение частоты запросов пользователей.
+
+Проверка admit вызывается PerUserUpdateProcessor для каждого обновления до
+очереди пользователя и семафора параллельности, поэтому отброшенное обновление
+не занимает слот обработки. У каждого пользователя свое ведро токенов: действие
+стоит RATE_LIMIT_COSTS токенов (по умолчанию 1), ведро пополняется на
+RATE_LIMIT_RATE токенов в секунду до RATE_LIMIT_BURST. Если токенов не хватает,
+обновление отбрасывается, а пользователь один раз получает просьбу подождать.
+
+В режиме нескольких процессов обновления пользователя всегда попадают в один
+процесс, поэтому ведра в памяти процесса достаточно.
+"""
+import logging
+import time
+from collections import OrderedDict
+from telegram import Update
+from telegram.error import TelegramError
+from config import ADMIN_ID, RATE_LIMIT_RATE, RATE_LIMIT_BURST, RATE_LIMIT_COSTS
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SLOW_DOWN_TEXT = "⏳ Слишком много запросов, подождите несколько секунд."
+
+LIMITED = metrics.Counter("bot_rate_limited_total", "Обновления, отброшенные ограничением частоты", ("action",))
+BUCKETS = metrics.Gauge("bot_rate_limit_buckets", "Пользователи с неполным ведром токенов")
+
+def _action(update: Update) -> str:
+    """Действие для таблицы стоимости: данные кнопки, /команда или message"""
+    if update.callback_query:
+        return update.callback_query.data or "callback"
+    message = update.effective_message
+    if message and message.text and message.text.startswith("/"):
+        return message.text.split(maxsplit=1)[0].split("@")[0].lower()
+    return "message"
+
+class RateLimiter:
+    """Ведра токенов по пользователям.
+
+    Ведро хранится кортежем (токены, время обновления, предупрежден ли). Записи
+    упорядочены по последнему обращению, поэтому устаревшие ведра вытесняются
+    с начала за O(1) на запрос: через burst / rate секунд простоя ведро снова
+    полное и ничем не отличается от отсутствующего.
+    """
+
+    def __init__(self, rate: float, burst: float, costs: dict[str, float]):
+        self.rate = rate
+        self.burst = burst
+        self.costs = costs
+        self.ttl = burst / rate
+        self._buckets: OrderedDict[int, tuple[float, float, bool]] = OrderedDict()
+
+    def acquire(self, user_id: int, cost: float, now: float | None = None) -> bool | None:
+        """Списание cost токенов: True — разрешено, False — отказ,
+        None — отказ, о котором пользователя уже предупредили"""
+        now = time.monotonic() if now is None else now
+        # Действие дороже всего ведра иначе не выполнилось бы никогда
+        cost = min(cost, self.burst)
+        buckets = self._buckets
+        tokens, updated_at, warned = buckets.get(user_id, (self.burst, now, False))
+        tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+        if tokens >= cost:
+            buckets[user_id] = (tokens - cost, now, False)
+            allowed = True
+        else:
+            buckets[user_id] = (tokens, now, True)
+            allowed = None if warned else False
+        buckets.move_to_end(user_id)
+        while now - next(iter(buckets.values()))[1] >= self.ttl:
+            buckets.popitem(last=False)
+        return allowed
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+_limiter = RateLimiter(RATE_LIMIT_RATE, RATE_LIMIT_BURST, RATE_LIMIT_COSTS) if RATE_LIMIT_RATE > 0 else None
+if _limiter is not None:
+    metrics.add_collector(lambda: BUCKETS.set(len(_limiter)))
+
+async def admit(update: object) -> bool:
+    """False, если пользователь превысил лимит запросов и обновление нужно отбросить"""
+    if _limiter is None or not isinstance(update, Update) or update.effective_user is None:
+        return True
+    user_id = update.effective_user.id
+    if str(user_id) == ADMIN_ID:
+        return True
+
+    action = _action(update)
+    allowed = _limiter.acquire(user_id, _limiter.costs.get(action, 1))
+    if allowed:
+        return True
+
+    # Текст команды задает пользователь: в метку попадают только действия из таблицы стоимости
+    LIMITED.inc(action if action in _limiter.costs else "other")
+    if allowed is False:
+        logger.info("Пользователь %s превысил лимит запросов (%s)", user_id, action)
+    try:
+        if update.callback_query:
+            # Ответ на кнопку нужен в любом случае, иначе у пользователя крутится индикатор загрузки
+            await update.callback_query.answer(SLOW_DOWN_TEXT if allowed is False else None)
+        elif allowed is False and update.effective_message:
+            await update.effective_message.reply_text(SLOW_DOWN_TEXT)
+    except TelegramError as e:
+        logger.warning("Не удалось ответить пользователю %s на превышение лимита: %s", user_id, e)
+    return False
@@ -0,0 +1,85 @@
+"""Тексты сообщений бота.
+
+Статические тексты собираются один раз при импорте из config и реестра игр.
+Динамические — функции-шаблоны: f-строка компилируется в одну сборку строки,
+а списки строк склеиваются через str.join, без += в цикле.
+"""
+from html import escape
+from config import MIN_BET, MAX_BET, MIN_WITHDRAWAL
+from games import RULES_TEXT as GAME_RULES_TEXT
+
+RULES = (
+    "<b>📜 Правила Игры и Коэффициенты</b>\n\n"
+    f"<b>Ставки:</b> от {MIN_BET} до {MAX_BET} руб.\n"
+    f"<b>Вывод:</b> от {MIN_WITHDRAWAL} руб.\n\n"
+    f"{GAME_RULES_TEXT}"
+)
+CHOOSE_GAME = "Выберите игру:"
+ENTER_BET = f"Вы выбрали игру. Теперь введите вашу ставку (от {MIN_BET} до {MAX_BET} руб.):"
+NOT_A_NUMBER = "Пожалуйста, введите числовое значение."
+INSUFFICIENT_FUNDS = "Недостаточно средств для ставки."
+ENTER_NICKNAME = "Введите ваш новый никнейм (3-15 символов, буквы, цифры, _-):"
+INVALID_NICKNAME = (
+    "❌ <b>Ошибка:</b> Никнейм должен быть длиной от 3 до 15 символов и содержать только "
+    "латинские буквы, цифры, знаки подчеркивания (_) или дефисы (-)."
+)
+UNKNOWN_COMMAND = "Неизвестная команда. Используйте /start для начала работы."
+UNKNOWN_CALLBACK = "Неизвестная команда. Возвращаемся в меню."
+
+def welcome(mention_html: str) -> str:
+    return f"👋 Привет, {mention_html}!\n\nДобро пожаловать в наше казино! Выбери действие:"
+
+def main_menu(mention_html: str) -> str:
+    return f"👋 Привет, {mention_html}!\n\nВы в главном меню. Выбери действие:"
+
+def balance(amount: int) -> str:
+    return f"💰 Ваш текущий баланс: <b>{amount}</b> руб."
+
+def invalid_bet(user_balance: int) -> str:
+    return f"Некорректная ставка. Ваш баланс: {user_balance} руб."
+
+def bet_result(result_text: str, bet: int, win_amount: int, final_balance: int) -> str:
+    return (
+        f"{result_text}\n\n"
+        f"Ваша ставка: {bet} руб. | Выигрыш: {win_amount} руб.\n"
+        f"Ваш новый баланс: <b>{final_balance}</b> руб."
+    )
+
+def withdrawal_too_low(user_balance: int) -> str:
+    return f"❌ Ошибка: минимальная сумма для вывода {MIN_WITHDRAWAL} руб. У вас на балансе {user_balance} руб."
+
+def withdrawal_prompt(user_balance: int) -> str:
+    return f"Ваш баланс: {user_balance} руб. Введите сумму, которую хотите вывести:"
+
+def invalid_withdrawal(user_balance: int) -> str:
+    return (
+        f"❌ Некорректная сумма.\n"
+        f"• Минимальный вывод: {MIN_WITHDRAWAL} руб.\n"
+        f"• Ваш баланс: {user_balance} руб."
+    )
+
+def withdrawal_accepted(amount: int) -> str:
+    return (
+        f"✅ Ваш запрос на вывод {amount} руб. принят в обработку.\n"
+        "Администратор свяжется с вами в ближайшее время для уточнения деталей."
+    )
+
+def nickname_saved(nickname: str) -> str:
+    return f"✅ Ваш никнейм успешно изменен на: <b>{escape(nickname)}</b>"
+
+# Таблица лидеров
+LEADERBOARD_EMPTY = "🏆 Таблица лидеров пока пуста."
+LEADERBOARD_MARK = "➡️ "
+
+def leaderboard_header(size: int) -> str:
+    return f"<b>🏆 Топ-{size} игроков по балансу:</b>\n\n"
+
+def leaderboard_line(rank: int, user_id: int, name: str | None, user_balance: int) -> str:
+    display_name = escape(name) if name else f"User {user_id}"
+    return f"<b>{rank}.</b> {display_name} — <code>{user_balance}</code> руб.\n"
+
+def leaderboard(header: str, lines) -> str:
+    return header + "".join(lines)
+
+def leaderboard_own_rank(rank: int, user_balance: int) -> str:
+    return f"\n{LEADERBOARD_MARK}Ваше место: <b>{rank}</b> — <code>{user_balance}</code> руб."
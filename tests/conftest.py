@@ -0,0 +1,30 @@
+import asyncio
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# config требует токены при импорте; тестам они не нужны
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:test")
+os.environ.setdefault("YOOMONEY_WALLET", "test")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+@pytest.fixture
+def run_with_db(tmp_path):
+    """Запуск сценария на новой временной базе с открытым пулом"""
+    import database
+
+    def run(scenario, pool_size: int = 1):
+        async def wrapper():
+            database.DB_NAME = str(tmp_path / "test.db")
+            await database.init_pool(pool_size)
+            try:
+                await database.init_db()
+                await scenario()
+            finally:
+                await database.close_pool()
+
+        asyncio.run(wrapper())
+
+    return run
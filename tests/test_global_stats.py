@@ -0,0 +1,44 @@
+import asyncio
+import database
+
+async def set_stats(**values):
+    async with database._connection() as db:
+        for key, value in values.items():
+            await db.execute(f"UPDATE global_stats SET {key} = ? WHERE id = 1", (value,))
+        await db.commit()
+
+def test_recompute_reports_and_fixes_drift(run_with_db):
+    async def scenario():
+        for user_id in (1, 2):
+            await database.add_user_if_not_exists(user_id, f"user{user_id}")
+            await database.update_user_balance(user_id, 100 * user_id, relative=True)
+        stats = await database.get_global_stats()
+        assert (stats["total_users"], stats["total_balance"]) == (2, 300)
+
+        await set_stats(total_users=5, total_balance=250)
+        assert await database.recompute_global_stats() == {"total_users": 3, "total_balance": -50}
+        stats = await database.get_global_stats()
+        assert (stats["total_users"], stats["total_balance"]) == (2, 300)
+        assert await database.recompute_global_stats() == {}
+
+    run_with_db(scenario)
+
+def test_recompute_keeps_concurrent_changes(run_with_db):
+    async def scenario():
+        for user_id in range(1, 51):
+            await database.add_user_if_not_exists(user_id, f"user{user_id}")
+        await set_stats(total_balance=1000)
+
+        async def deposits():
+            for user_id in range(1, 51):
+                await database.update_user_balance(user_id, 10, relative=True)
+
+        # Пересчет не держит блокировку записи, пополнения идут параллельно
+        drift, _ = await asyncio.gather(database.recompute_global_stats(), deposits())
+        # Пополнения после снимка не считаются расхождением
+        assert drift == {"total_balance": 1000}
+        stats = await database.get_global_stats()
+        assert stats["total_balance"] == 500
+        assert await database.recompute_global_stats() == {}
+
+    run_with_db(scenario, pool_size=2)
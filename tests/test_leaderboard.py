@@ -0,0 +1,27 @@
+import database
+import templates
+from leaderboard import Leaderboard
+
+def test_rank_from_reserve_without_query(run_with_db, monkeypatch):
+    async def scenario():
+        for user_id in range(1, 11):
+            await database.add_user_if_not_exists(user_id, f"user{user_id}")
+            await database.update_user_balance(user_id, user_id * 100)
+        board = Leaderboard(size=2, reserve=3)
+        await board.resync()
+        queried = []
+        get_user_rank = database.get_user_rank
+
+        async def counting_rank(user_id):
+            queried.append(user_id)
+            return await get_user_rank(user_id)
+
+        monkeypatch.setattr(database, "get_user_rank", counting_rank)
+
+        # Пятый по балансу игрок в запасе таблицы
+        assert (await board.render(6)).endswith(templates.leaderboard_own_rank(5, 600))
+        assert queried == []
+        assert (await board.render(2)).endswith(templates.leaderboard_own_rank(9, 200))
+        assert queried == [2]
+
+    run_with_db(scenario)
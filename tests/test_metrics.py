@@ -0,0 +1,23 @@
+import asyncio
+import aiohttp
+import metrics
+
+def test_metrics_server_requires_token():
+    async def scenario():
+        runner = await metrics.start_server("127.0.0.1", 0, token="secret")
+        try:
+            host, port = runner.addresses[0][:2]
+            url = f"http://{host}:{port}/metrics"
+            async with aiohttp.ClientSession() as session:
+                async with session.get(url) as response:
+                    assert response.status == 401
+                async with session.get(url, headers={"Authorization": "Bearer wrong"}) as response:
+                    assert response.status == 401
+                async with session.get(url, headers={"Authorization": "Bearer secret"}) as response:
+                    assert response.status == 200
+                    assert response.headers["Content-Type"].startswith("text/plain")
+                    await response.text()
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(scenario())
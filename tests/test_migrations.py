@@ -0,0 +1,90 @@
+import database
+import migrations
+
+async def reset_to_unversioned():
+    """База в состоянии до миграций: схема есть, снимков и user_version нет"""
+    async with database._connection() as db:
+        await db.execute("DELETE FROM balance_snapshots")
+        await db.execute("DELETE FROM meta")
+        await db.execute("PRAGMA user_version = 0")
+        await db.commit()
+
+async def set_balance_without_ledger(user_id: int, balance: int):
+    async with database._connection() as db:
+        await db.execute("UPDATE users SET balance = ? WHERE user_id = ?", (balance, user_id))
+        await db.commit()
+
+async def migrate():
+    async with database._connection() as db:
+        await migrations.migrate(db)
+
+def test_snapshots_seeded_after_existing_ledger(run_with_db):
+    async def scenario():
+        for user_id in (1, 2, 3):
+            await database.add_user_if_not_exists(user_id, f"user{user_id}")
+        # Баланс до журнала, затем операции в журнале
+        await set_balance_without_ledger(1, 500)
+        await database.update_user_balance(1, 100, relative=True)
+        await set_balance_without_ledger(2, 30)
+        await database.update_user_balance(2, 50, relative=True)
+        await database.update_user_balance(2, -80, relative=True)
+        await set_balance_without_ledger(3, 70)
+        await reset_to_unversioned()
+
+        await migrate()
+        for user_id, balance in ((1, 600), (2, 0), (3, 70)):
+            assert await database.reconstruct_balance(user_id) == balance
+
+        # Следующий снимок начинается после засеянного и не конфликтует с ним
+        await database.update_user_balance(1, -25, relative=True)
+        await database.update_user_balance(2, 40, relative=True)
+        assert await database.snapshot_balances() == 2
+        for user_id, balance in ((1, 575), (2, 40), (3, 70)):
+            assert await database.reconstruct_balance(user_id) == balance
+
+    run_with_db(scenario)
+
+def test_snapshots_seeded_at_zero_without_ledger(run_with_db):
+    async def scenario():
+        await database.add_user_if_not_exists(1, "user1")
+        await set_balance_without_ledger(1, 500)
+        await reset_to_unversioned()
+
+        await migrate()
+        async with database._connection() as db:
+            cursor = await db.execute("SELECT user_id, tx_id, balance FROM balance_snapshots")
+            assert [tuple(row) for row in await cursor.fetchall()] == [(1, 0, 500)]
+        await database.update_user_balance(1, 100, relative=True)
+        assert await database.reconstruct_balance(1) == 600
+
+    run_with_db(scenario)
+
+def test_steps_applied_concurrently_are_skipped(run_with_db, monkeypatch):
+    async def scenario():
+        await reset_to_unversioned()
+        applied = []
+        for step in migrations.MIGRATIONS:
+            async def counting_apply(db, step=step, apply=step.apply):
+                applied.append(step.version)
+                await apply(db)
+            monkeypatch.setattr(step, "apply", counting_apply)
+
+        get_version = migrations.get_version
+        raced = False
+
+        async def racing_get_version(db):
+            nonlocal raced
+            version = await get_version(db)
+            if not raced:
+                raced = True
+                # Другой процесс применяет миграции до того, как этот возьмет блокировку
+                async with database._connection() as other:
+                    await migrations.migrate(other)
+            return version
+
+        monkeypatch.setattr(migrations, "get_version", racing_get_version)
+        await migrate()
+        # Каждый шаг применен один раз, вторым процессом
+        assert applied == [step.version for step in migrations.MIGRATIONS]
+
+    run_with_db(scenario, pool_size=2)
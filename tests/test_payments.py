@@ -0,0 +1,33 @@
+import database
+
+def test_payment_credited_after_fee(run_with_db):
+    async def scenario():
+        await database.add_user_if_not_exists(1, "user")
+        await database.add_pending_payment("p1", 1, 100)
+
+        # Поступило 97 руб. из 100: в пределах комиссии 3%
+        payment = await database.credit_payment("p1", 97.0, 0.97)
+        assert payment['status'] == 'credited'
+        assert await database.get_user_balance(1) == 100
+        # Повторное зачисление того же платежа невозможно
+        assert await database.credit_payment("p1", 97.0, 0.97) is None
+        assert await database.get_user_balance(1) == 100
+
+    run_with_db(scenario)
+
+def test_underpaid_payment_goes_to_review(run_with_db):
+    async def scenario():
+        await database.add_user_if_not_exists(1, "user")
+        await database.add_pending_payment("p1", 1, 1000)
+
+        payment = await database.credit_payment("p1", 10.0, 0.97)
+        assert payment['status'] == 'review'
+        assert await database.get_user_balance(1) == 0
+        stored = await database.get_payment("p1")
+        assert stored['received_amount'] == 10.0
+        assert stored['credited_at'] is None
+        # Платеж на проверке не зачисляется повторной сверкой
+        assert await database.credit_payment("p1", 1000.0, 0.97) is None
+        assert await database.get_user_balance(1) == 0
+
+    run_with_db(scenario)
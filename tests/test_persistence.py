@@ -0,0 +1,65 @@
+import time
+from telegram.ext import Application
+import database
+from persistence import SQLitePersistence
+
+def build_application() -> tuple[Application, SQLitePersistence]:
+    persistence = SQLitePersistence(update_interval=10, max_users=100, idle_ttl=3600)
+    application = Application.builder().token("123456:test").persistence(persistence).build()
+    persistence.bind(application)
+    return application, persistence
+
+async def touch(application: Application, user_id: int, **values):
+    """Обращение пользователя, как при обработке обновления"""
+    await application.persistence.refresh_user_data(user_id, application.user_data[user_id])
+    application.user_data[user_id].update(values)
+    application.mark_data_for_update_persistence(user_ids=user_id)
+
+def make_idle(persistence: SQLitePersistence, user_id: int):
+    persistence._resident[user_id][0] = time.monotonic() - 10_000
+
+def test_evicted_user_data_stays_in_db(run_with_db):
+    async def scenario():
+        application, persistence = build_application()
+        await touch(application, 1, step="bet")
+        await application.update_persistence()
+
+        make_idle(persistence, 1)
+        await persistence.flush()
+        assert 1 not in application.user_data
+        # Выгрузка не удаляет данные из БД на следующем прогоне
+        await application.update_persistence()
+        assert await database.load_user_data(1) == '{"step":"bet"}'
+
+        await touch(application, 1)
+        assert application.user_data[1] == {"step": "bet"}
+
+    run_with_db(scenario)
+
+def test_user_returning_after_eviction_is_saved(run_with_db):
+    async def scenario():
+        application, persistence = build_application()
+        await touch(application, 1, step="bet")
+        await application.update_persistence()
+        make_idle(persistence, 1)
+        await persistence.flush()
+
+        # Пользователь вернулся до прогона, на котором Application передает выгрузку
+        await touch(application, 1, step="game")
+        await application.update_persistence()
+        assert await database.load_user_data(1) == '{"step":"game"}'
+        assert application.user_data[1] == {"step": "game"}
+
+    run_with_db(scenario)
+
+def test_dropped_user_data_is_deleted(run_with_db):
+    async def scenario():
+        application, _ = build_application()
+        await touch(application, 1, step="bet")
+        await application.update_persistence()
+
+        application.drop_user_data(1)
+        await application.update_persistence()
+        assert await database.load_user_data(1) is None
+
+    run_with_db(scenario)
@@ -0,0 +1,142 @@
+import asyncio
+from datetime import datetime
+from telegram import Chat, Message, Update, User
+from update_processor import PerUserUpdateProcessor
+
+def make_update(update_id: int, user_id: int) -> Update:
+    user = User(user_id, f"user{user_id}", False)
+    message = Message(update_id, datetime.now(), Chat(user_id, Chat.PRIVATE), from_user=user, text="text")
+    return Update(update_id, message=message)
+
+def test_flooding_user_does_not_block_other_users():
+    async def scenario():
+        processor = PerUserUpdateProcessor(max_concurrent_updates=4)
+        release = asyncio.Event()
+        flood_done = []
+
+        async def flood_update(i):
+            await release.wait()
+            flood_done.append(i)
+
+        async def other_update():
+            pass
+
+        # Обновлений одного пользователя больше, чем слотов семафора
+        flood = [
+            asyncio.create_task(processor.process_update(make_update(i, 1), flood_update(i)))
+            for i in range(20)
+        ]
+        await asyncio.sleep(0)
+        await asyncio.wait_for(processor.process_update(make_update(100, 2), other_update()), timeout=1)
+        assert processor.current_concurrent_updates == 1
+
+        release.set()
+        await asyncio.wait_for(asyncio.gather(*flood), timeout=1)
+        assert flood_done == list(range(20))
+        assert processor._user_queues == {}
+
+    asyncio.run(scenario())
+
+def test_failed_update_does_not_stop_user_queue():
+    async def scenario():
+        processor = PerUserUpdateProcessor(max_concurrent_updates=2)
+        release = asyncio.Event()
+        done = []
+
+        async def failing():
+            await release.wait()
+            raise RuntimeError("boom")
+
+        async def succeeding():
+            done.append(True)
+
+        first = asyncio.create_task(processor.process_update(make_update(1, 1), failing()))
+        await asyncio.sleep(0)
+        await processor.process_update(make_update(2, 1), succeeding())
+        release.set()
+        await first
+        assert done == [True]
+
+    asyncio.run(scenario())
+
+def test_rejected_update_takes_no_slot():
+    async def scenario():
+        async def admit(update):
+            return update.effective_user.id != 1
+
+        processor = PerUserUpdateProcessor(max_concurrent_updates=1, admit=admit)
+        release = asyncio.Event()
+        ran = []
+
+        async def busy():
+            await release.wait()
+
+        async def limited():
+            ran.append(True)
+
+        # Единственный слот занят другим пользователем
+        other = asyncio.create_task(processor.process_update(make_update(1, 2), busy()))
+        await asyncio.sleep(0)
+        await asyncio.wait_for(processor.process_update(make_update(2, 1), limited()), timeout=1)
+        assert ran == []
+        release.set()
+        await other
+
+    asyncio.run(scenario())
+
+def test_pending_updates_are_capped():
+    async def scenario():
+        processor = PerUserUpdateProcessor(max_concurrent_updates=2, max_pending=3)
+        release = asyncio.Event()
+        done = []
+
+        async def blocked(i):
+            await release.wait()
+            done.append(i)
+
+        coroutines = [blocked(i) for i in range(5)]
+        tasks = [
+            asyncio.create_task(processor.process_update(make_update(i, 1 + i % 2), coroutine))
+            for i, coroutine in enumerate(coroutines)
+        ]
+        await asyncio.sleep(0)
+        # Обновления сверх лимита отброшены, а не поставлены в очередь
+        assert processor.pending_updates == 3
+        assert all(coroutine.cr_frame is None for coroutine in coroutines[3:])
+
+        release.set()
+        await asyncio.wait_for(asyncio.gather(*tasks), timeout=1)
+        assert sorted(done) == [0, 1, 2]
+        assert processor.pending_updates == 0
+
+    asyncio.run(scenario())
+
+def test_reserve_waits_for_capacity():
+    async def scenario():
+        processor = PerUserUpdateProcessor(max_concurrent_updates=1, max_pending=1)
+        release = asyncio.Event()
+
+        async def blocked():
+            await release.wait()
+
+        assert processor.try_reserve()
+        assert not processor.try_reserve()
+        running = asyncio.create_task(processor.process_update(make_update(1, 1), blocked()))
+        waiting = asyncio.create_task(processor.reserve())
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+
+        release.set()
+        await running
+        await asyncio.wait_for(waiting, timeout=1)
+        assert processor.pending_updates == 1
+
+    asyncio.run(scenario())
+
+def test_cancelled_reservation_frees_capacity():
+    processor = PerUserUpdateProcessor(max_concurrent_updates=1, max_pending=1)
+    assert processor.try_reserve()
+    assert not processor.try_reserve()
+    processor.cancel_reservation()
+    assert processor.pending_updates == 0
+    assert processor.try_reserve()
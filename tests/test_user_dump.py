@@ -0,0 +1,72 @@
+import argparse
+import asyncio
+import sqlite3
+from contextlib import closing
+import pytest
+import database
+import user_dump
+
+def test_cli_import_requires_stopped_bot(run_with_db):
+    async def scenario():
+        await database.acquire_bot_lock()
+        try:
+            with pytest.raises(RuntimeError):
+                with database.exclusive_lock():
+                    pass
+        finally:
+            database.release_bot_lock()
+        with database.exclusive_lock():
+            pass
+
+    run_with_db(scenario)
+
+def test_import_overwrites_buffered_stats(run_with_db, tmp_path):
+    async def scenario():
+        await database.add_user_if_not_exists(1, "user1")
+        await database.init_stats_buffer(interval_ms=60_000)
+        try:
+            # Игра до загрузки остается в буфере
+            await database.update_user_stats(1, 10, 0)
+            path = tmp_path / "users.csv"
+            path.write_text("user_id,games_played\n1,100\n", encoding="utf-8")
+            assert await user_dump.import_file(str(path), "csv") == 1
+        finally:
+            await database.close_stats_buffer()
+        async with database._connection() as db:
+            cursor = await db.execute("SELECT games_played FROM users WHERE user_id = 1")
+            assert (await cursor.fetchone())[0] == 100
+        assert database.stats_journal_files() == []
+
+    run_with_db(scenario)
+
+def cli_args(tmp_path, action: str) -> argparse.Namespace:
+    return argparse.Namespace(
+        action=action, path=str(tmp_path / "users.csv"), format=None,
+        batch_size=100, db=str(tmp_path / "cli.db"),
+    )
+
+def schema_version(path) -> int:
+    with closing(sqlite3.connect(path)) as db:
+        return db.execute("PRAGMA user_version").fetchone()[0]
+
+def test_cli_export_does_not_migrate(tmp_path):
+    args = cli_args(tmp_path, "export")
+    with pytest.raises(RuntimeError):
+        asyncio.run(user_dump._run(args))
+    assert schema_version(args.db) == 0
+
+def test_cli_import_checks_bot_before_migrating(tmp_path):
+    args = cli_args(tmp_path, "import")
+    (tmp_path / "users.csv").write_text("user_id\n1\n", encoding="utf-8")
+
+    async def scenario():
+        database.DB_NAME = args.db
+        await database.acquire_bot_lock()
+        try:
+            with pytest.raises(RuntimeError):
+                await user_dump._run(args)
+        finally:
+            database.release_bot_lock()
+
+    asyncio.run(scenario())
+    assert schema_version(args.db) == 0
@@ -0,0 +1,113 @@
+import asyncio
+import json
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+from telegram.request import BaseRequest
+import webhook
+from update_processor import PerUserUpdateProcessor
+from webhook import UpdateIngestor, UPDATES
+
+class FakeRequest:
+    def __init__(self, data: dict):
+        self.headers = {"X-Telegram-Bot-Api-Secret-Token": webhook.WEBHOOK_SECRET}
+        self._body = json.dumps(data).encode()
+
+    async def read(self) -> bytes:
+        return self._body
+
+class OfflineRequest(BaseRequest):
+    """Bot API без сети: любой метод отвечает данными бота (для getMe)"""
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        result = {"id": 1, "is_bot": True, "first_name": "bot", "username": "bot"}
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+def message_update(update_id: int, user_id: int) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "chat": {"id": user_id, "type": "private"}, "from": user, "text": "text",
+    }}
+
+def counted(result: str) -> float:
+    return UPDATES._values.get((result,), 0)
+
+def test_unparsable_update_is_acknowledged():
+    async def scenario():
+        application = Application.builder().token("123456:test").build()
+        ingestor = UpdateIngestor(application)
+        invalid, duplicate = counted("invalid"), counted("duplicate")
+        # JSON корректен, но Update.de_json на нем падает
+        data = {"update_id": 1, "message": {"message_id": 1}}
+
+        response = await ingestor.handle(FakeRequest(data))
+        assert response.status == 200
+        assert counted("invalid") == invalid + 1
+        assert application.update_queue.empty()
+
+        response = await ingestor.handle(FakeRequest(data))
+        assert response.status == 200
+        assert counted("duplicate") == duplicate + 1
+
+    asyncio.run(scenario())
+
+async def wait_idle(processor: PerUserUpdateProcessor):
+    for _ in range(100):
+        if processor.pending_updates == 0:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("Обновления не обработаны")
+
+def test_burst_over_pending_limit_is_rejected():
+    async def scenario():
+        processor = PerUserUpdateProcessor(max_concurrent_updates=2, max_pending=5)
+        application = (
+            Application.builder().token("123456:test")
+            .request(OfflineRequest()).get_updates_request(OfflineRequest())
+            .concurrent_updates(processor).build()
+        )
+        release = asyncio.Event()
+        handled = []
+
+        async def blocked(update, context):
+            await release.wait()
+            handled.append(update.update_id)
+
+        application.add_handler(TypeHandler(Update, blocked))
+        ingestor = UpdateIngestor(application)
+        await application.initialize()
+        await application.start()
+        try:
+            statuses = []
+            for i in range(20):
+                response = await ingestor.handle(FakeRequest(message_update(100 + i, i)))
+                statuses.append(response.status)
+                # Application успевает забрать принятые обновления в задачи
+                await asyncio.sleep(0)
+            assert statuses == [200] * 5 + [503] * 15
+            assert application.update_queue.empty()
+            assert processor.pending_updates == 5
+
+            release.set()
+            await wait_idle(processor)
+            assert sorted(handled) == list(range(100, 105))
+            # Обработанные обновления освобождают место
+            response = await ingestor.handle(FakeRequest(message_update(200, 1)))
+            assert response.status == 200
+            await wait_idle(processor)
+        finally:
+            release.set()
+            await application.stop()
+            await application.shutdown()
+
+    asyncio.run(scenario())
@@ -1,67 +1,86 @@
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from games import GAMES
+
+class CachedInlineKeyboardMarkup(InlineKeyboardMarkup):
+    """Неизменяемая клавиатура с заранее подготовленным to_dict.
+
+    Клавиатуры создаются один раз при импорте и передаются в каждый ответ,
+    поэтому при отправке не нужно заново обходить кнопки для сериализации.
+    """
+
+    __slots__ = ("_cached_dict",)
+
+    def __init__(self, inline_keyboard):
+        super().__init__(inline_keyboard)
+        with self._unfrozen():
+            self._cached_dict = super().to_dict()
+
+    def to_dict(self, recursive: bool = True) -> dict:
+        if not recursive:
+            return super().to_dict(recursive=False)
+        return self._cached_dict
+
+def _keyboard(*rows: tuple[tuple[str, str], ...]) -> CachedInlineKeyboardMarkup:
+    """Клавиатура из строк кнопок вида (текст, callback_data)"""
+    return CachedInlineKeyboardMarkup(
+        [[InlineKeyboardButton(text, callback_data=data) for text, data in row] for row in rows]
+    )
+
+_BACK_TO_MENU_ROW = (("⬅️ Назад в меню", "main_menu_from_nested"),)
+
+# Реестр всех клавиатур бота по имени
+KEYBOARDS: dict[str, CachedInlineKeyboardMarkup] = {
+    # Клавиатура главного меню
+    "main_menu": _keyboard(
+        (("🎲 Играть", "play"),),
+        (("💰 Баланс", "balance"), ("📜 Правила", "rules")),
+        (("🏆 Топ игроков", "top"), ("👤 Мой ник", "set_nickname")),
+        (("💳 Пополнить баланс", "deposit"), ("📤 Вывод средств", "withdraw")),
+    ),
+    # Простая кнопка возврата в меню
+    "back_simple": _keyboard((("⬅️ Назад", "back_to_start"),)),
+    # Кнопка возврата из вложенных меню
+    "back_nested": _keyboard(_BACK_TO_MENU_ROW),
+    # Выбор игры
+    "game_choice": _keyboard(
+        tuple((game.emoji, f"game_{game.key}") for game in GAMES.values()),
+        _BACK_TO_MENU_ROW,
+    ),
+    # Клавиатура подтверждения оплаты
+    "payment_confirmation": _keyboard((("✅ Я оплатил(а)", "payment_confirmed"),), _BACK_TO_MENU_ROW),
+    # Клавиатура при ошибке платежа
+    "deposit_retry": _keyboard((("🔄 Попробовать снова", "deposit"),), _BACK_TO_MENU_ROW),
+    # Клавиатура выбора суммы депозита (упрощенная)
+    "deposit_options": _keyboard(
+        (("💳 Оплатить через ЮMoney", "method_yoomoney"),),
+        (("⬅️ Назад", "back_to_deposit"),),
+    ),
+}
 
 def get_main_menu_keyboard() -> InlineKeyboardMarkup:
     """Клавиатура главного меню"""
-    keyboard = [
-        [InlineKeyboardButton("🎲 Играть", callback_data="play")],
-        [
-            InlineKeyboardButton("💰 Баланс", callback_data="balance"),
-            InlineKeyboardButton("📜 Правила", callback_data="rules")
-        ],
-        [
-            InlineKeyboardButton("🏆 Топ игроков", callback_data="top"),
-            InlineKeyboardButton("👤 Мой ник", callback_data="set_nickname")
-        ],
-        [
-            InlineKeyboardButton("💳 Пополнить баланс", callback_data="deposit"),
-            InlineKeyboardButton("📤 Вывод средств", callback_data="withdraw")
-        ]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return KEYBOARDS["main_menu"]
 
 def get_back_to_menu_keyboard_simple() -> InlineKeyboardMarkup:
     """Простая кнопка возврата в меню"""
-    keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_start")]]
-    return InlineKeyboardMarkup(keyboard)
+    return KEYBOARDS["back_simple"]
 
 def get_back_to_menu_keyboard_nested() -> InlineKeyboardMarkup:
     """Кнопка возврата из вложенных меню"""
-    keyboard = [[InlineKeyboardButton("⬅️ Назад в меню", callback_data="main_menu_from_nested")]]
-    return InlineKeyboardMarkup(keyboard)
+    return KEYBOARDS["back_nested"]
 
 def get_game_choice_keyboard() -> InlineKeyboardMarkup:
     """Выбор игры"""
-    keyboard = [
-        [
-            InlineKeyboardButton("🎲", callback_data="game_dice"),
-            InlineKeyboardButton("🏀", callback_data="game_basketball"),
-            InlineKeyboardButton("⚽", callback_data="game_football"),
-            InlineKeyboardButton("🎰", callback_data="game_dart"),
-        ],
-        [InlineKeyboardButton("⬅️ Назад в меню", callback_data="main_menu_from_nested")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return KEYBOARDS["game_choice"]
 
 def get_payment_confirmation_keyboard() -> InlineKeyboardMarkup:
     """Клавиатура подтверждения оплаты"""
-    keyboard = [
-        [InlineKeyboardButton("✅ Я оплатил(а)", callback_data="payment_confirmed")],
-        [InlineKeyboardButton("⬅️ Назад в меню", callback_data="main_menu_from_nested")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return KEYBOARDS["payment_confirmation"]
 
 def get_deposit_retry_keyboard() -> InlineKeyboardMarkup:
     """Клавиатура при ошибке платежа"""
-    keyboard = [
-        [InlineKeyboardButton("🔄 Попробовать снова", callback_data="deposit")],
-        [InlineKeyboardButton("⬅️ Назад в меню", callback_data="main_menu_from_nested")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return KEYBOARDS["deposit_retry"]
 
 def get_deposit_options_keyboard() -> InlineKeyboardMarkup:
     """Клавиатура выбора суммы депозита (упрощенная)"""
-    keyboard = [
-        [InlineKeyboardButton("💳 Оплатить через ЮMoney", callback_data="method_yoomoney")],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_deposit")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
\ No newline at end of file
+    return KEYBOARDS["deposit_options"]
@@ -0,0 +1,188 @@
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+from logging_setup import set_update_context
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Семафор базового класса не ограничивает обработку, см. PerUserUpdateProcessor
+UNBOUNDED = 2 ** 31
+
+PENDING = metrics.Gauge("bot_pending_updates", "Принятые и еще не обработанные обновления")
+DROPPED = metrics.Counter("bot_updates_dropped_total", "Обновления, отброшенные при превышении max_pending")
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений с сохранением порядка для каждого пользователя.
+
+    Обновления разных пользователей обрабатываются одновременно, а обновления
+    одного пользователя — строго по очереди, поэтому состояния ConversationHandler
+    и context.user_data не гоняются между собой.
+
+    BaseUpdateProcessor.process_update занимает свой семафор до вызова
+    do_process_update, поэтому параллельность ограничивает собственный семафор,
+    который берется только для выполнения. До него обновление проходит проверку
+    admit (ограничение частоты) и, если пользователь уже обрабатывается, ставится
+    в его очередь: отброшенные и ожидающие обновления слотов не занимают. Очередь
+    выполняет задача, уже обрабатывающая этого пользователя, поэтому пользователь
+    занимает не больше одного слота.
+
+    Application забирает каждое обновление из update_queue сразу в отдельную
+    задачу, поэтому ни размер очереди, ни число задач сами по себе не ограничены. Лимит
+    max_pending считает принятые и еще не обработанные обновления: и выполняемые,
+    и ожидающие слота или своей очереди. Источник обновлений резервирует место
+    до передачи обновления в update_queue (try_reserve или reserve) и при
+    исчерпанном лимите отказывает (вебхук отвечает 503) или ждет. Обновление без
+    резерва (поллинг) сверх лимита отбрасывается.
+    """
+
+    def __init__(self, max_concurrent_updates: int, admit: Callable[[object], Awaitable[bool]] | None = None,
+                 max_pending: int = UNBOUNDED):
+        if max_concurrent_updates < 1:
+            raise ValueError("max_concurrent_updates должно быть положительным")
+        if max_pending < max_concurrent_updates:
+            raise ValueError("max_pending не может быть меньше max_concurrent_updates")
+        # Базовый класс создает свой семафор по свойству max_concurrent_updates
+        self._limit = UNBOUNDED
+        super().__init__(UNBOUNDED)
+        self._limit = max_concurrent_updates
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._running = 0
+        self._admit = admit
+        self.max_pending = max_pending
+        # Принятые и не обработанные обновления, из них зарезервированные, но еще не начатые
+        self._pending = 0
+        self._reserved = 0
+        self._capacity = asyncio.Event()
+        self._capacity.set()
+        # user_id -> обновления, ожидающие завершения текущего; запись есть,
+        # пока пользователь обрабатывается
+        self._user_queues: dict[int, deque] = {}
+
+    @property
+    def max_concurrent_updates(self) -> int:
+        return self._limit
+
+    @property
+    def current_concurrent_updates(self) -> int:
+        return self._running
+
+    @property
+    def pending_updates(self) -> int:
+        return self._pending
+
+    def try_reserve(self) -> bool:
+        """Место для обновления, которое будет передано в update_queue; False, если лимит исчерпан"""
+        if self._pending >= self.max_pending:
+            return False
+        self._reserved += 1
+        self._add_pending(1)
+        return True
+
+    async def reserve(self) -> None:
+        """Резерв места с ожиданием, пока обработка не освободит его"""
+        while not self.try_reserve():
+            await self._capacity.wait()
+
+    def cancel_reservation(self) -> None:
+        """Возврат резерва, если обновление так и не передано в update_queue"""
+        self._reserved -= 1
+        self._add_pending(-1)
+
+    def _add_pending(self, delta: int):
+        self._pending += delta
+        PENDING.set(self._pending)
+        if self._pending >= self.max_pending:
+            self._capacity.clear()
+        else:
+            self._capacity.set()
+
+    def _release(self, coroutine=None):
+        """Конец обработки обновления; невыполненная корутина закрывается"""
+        if coroutine is not None:
+            coroutine.close()
+        self._add_pending(-1)
+
+    @asynccontextmanager
+    async def _slot(self):
+        async with self._slots:
+            self._running += 1
+            try:
+                yield
+            finally:
+                self._running -= 1
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        # Каждое обновление принимается в своей задаче, контекст лога не пересекается
+        set_update_context(update)
+        if self._reserved:
+            self._reserved -= 1
+        elif self._pending >= self.max_pending:
+            DROPPED.inc()
+            logger.warning("Превышен лимит необработанных обновлений (%s), обновление отброшено", self.max_pending)
+            coroutine.close()
+            return
+        else:
+            self._add_pending(1)
+
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            try:
+                async with self._slot():
+                    await coroutine
+            finally:
+                # Закрытие выполненной корутины ничего не делает
+                self._release(coroutine)
+            return
+
+        try:
+            admitted = self._admit is None or await self._admit(update)
+        except BaseException:
+            self._release(coroutine)
+            raise
+        if not admitted:
+            self._release(coroutine)
+            return
+
+        queue = self._user_queues.get(user.id)
+        if queue is not None:
+            queue.append((update, coroutine))
+            return
+
+        queue = self._user_queues[user.id] = deque()
+        try:
+            async with self._slot():
+                while True:
+                    # Обновления из очереди выполняются в задаче первого
+                    set_update_context(update)
+                    try:
+                        await coroutine
+                    except Exception:
+                        # Ошибка одного обновления не должна останавливать очередь пользователя
+                        logger.exception("Ошибка обработки обновления пользователя %s", user.id)
+                    finally:
+                        coroutine = None
+                        self._release()
+                    if not queue:
+                        break
+                    update, coroutine = queue.popleft()
+        finally:
+            del self._user_queues[user.id]
+            # Невыполненные обновления при отмене задачи (остановка приложения)
+            if coroutine is not None:
+                self._release(coroutine)
+            for _, pending in queue:
+                self._release(pending)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        for queue in self._user_queues.values():
+            for _, pending in queue:
+                self._release(pending)
+            queue.clear()
@@ -0,0 +1,200 @@
+"""Выгрузка и загрузка пользователей в CSV и JSONL.
+
+Выгрузка читает users страницами и пишет строки по мере чтения, загрузка
+разбирает файл построчно и записывает его пачками через executemany, поэтому
+память не зависит от размера таблицы. Файлы с расширением .gz сжимаются и
+распаковываются на лету.
+
+Из командной строки (удобно для файлов больше лимитов Telegram):
+    python user_dump.py export users.csv.gz
+    python user_dump.py import users.jsonl --batch-size 5000
+
+Кэш балансов и таблица лидеров бота не видят изменений из другого процесса,
+поэтому загрузка из командной строки требует остановленного бота (блокировка
+database.exclusive_lock, она берется до применения миграций), а пока она идет,
+бот не запускается. Для работающего бота используйте /import. Выгрузка может
+идти при запущенном боте и схему не меняет: при неактуальной версии схемы она
+завершается ошибкой.
+
+Игровая статистика пишется ботом отложенно (database.StatsBuffer), дельтами
+поверх значений в БД. Перед загрузкой буфер записывается: игры, сыгранные до
+загрузки, перезаписываются значениями из файла, а сыгранные во время и после
+нее прибавляются к ним. Журналы незаписанной статистики, оставшиеся после
+аварийной остановки, бот применил бы при запуске поверх загруженных значений,
+поэтому при них загрузка из командной строки не выполняется.
+"""
+import argparse
+import asyncio
+import csv
+import gzip
+import json
+from itertools import chain
+from typing import Iterator, TextIO
+import database
+from config import USER_TRANSFER_BATCH_SIZE
+
+FORMATS = ("csv", "jsonl")
+# Текстовые столбцы; пустое значение в CSV означает NULL
+TEXT_COLUMNS = ("username", "nickname")
+
+def detect_format(filename: str) -> str:
+    """Формат по расширению файла, с учетом сжатия .gz"""
+    name = filename.lower().removesuffix(".gz")
+    for fmt in FORMATS:
+        if name.endswith(f".{fmt}"):
+            return fmt
+    raise ValueError(f"Неизвестный формат файла {filename}: нужен .csv или .jsonl")
+
+def open_text(path: str, mode: str) -> TextIO:
+    if path.lower().endswith(".gz"):
+        return gzip.open(path, f"{mode}t", encoding="utf-8", newline="")
+    return open(path, mode, encoding="utf-8", newline="")
+
+async def export_file(path: str, fmt: str, batch_size: int = USER_TRANSFER_BATCH_SIZE) -> int:
+    """Запись всех пользователей в файл; возвращает их количество"""
+    count = 0
+    with open_text(path, "w") as f:
+        if fmt == "csv":
+            writer = csv.writer(f)
+            writer.writerow(database.USER_COLUMNS)
+            async for row in database.iter_users(batch_size):
+                writer.writerow(tuple(row))
+                count += 1
+        else:
+            async for row in database.iter_users(batch_size):
+                f.write(json.dumps(dict(row), ensure_ascii=False) + "\n")
+                count += 1
+    return count
+
+def _columns(names: list[str]) -> tuple[str, ...]:
+    """Проверенные столбцы файла в порядке USER_COLUMNS"""
+    unknown = [name for name in names if name not in database.USER_COLUMNS]
+    if unknown:
+        raise ValueError(f"Неизвестные столбцы: {', '.join(unknown)}")
+    if "user_id" not in names:
+        raise ValueError("Нет столбца user_id")
+    if len(set(names)) != len(names):
+        raise ValueError("Столбцы повторяются")
+    return tuple(column for column in database.USER_COLUMNS if column in names)
+
+def _value(column: str, value, line_no: int):
+    if column in TEXT_COLUMNS:
+        if value is None or isinstance(value, str):
+            return value or None
+    elif type(value) is int:
+        return value
+    elif isinstance(value, str) and value.strip().lstrip("-").isdigit():
+        return int(value)
+    raise ValueError(f"Строка {line_no}: недопустимое значение {column}: {value!r}")
+
+def read_users(f: TextIO, fmt: str) -> tuple[tuple[str, ...], Iterator[tuple]]:
+    """Столбцы файла и ленивый итератор строк со значениями в порядке этих столбцов"""
+    if fmt == "csv":
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            raise ValueError("Файл пуст")
+        header = [name.strip() for name in header]
+        columns = _columns(header)
+        positions = [header.index(column) for column in columns]
+
+        def csv_rows():
+            for row in reader:
+                if not row:
+                    continue
+                if len(row) != len(header):
+                    raise ValueError(f"Строка {reader.line_num}: ожидается значений: {len(header)}")
+                yield tuple(_value(column, row[position], reader.line_num) for column, position in zip(columns, positions))
+
+        return columns, csv_rows()
+
+    def records():
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Строка {line_no}: некорректный JSON ({e.msg})") from None
+            if not isinstance(record, dict):
+                raise ValueError(f"Строка {line_no}: ожидается объект JSON")
+            yield line_no, record
+
+    lines = records()
+    first = next(lines, None)
+    if first is None:
+        raise ValueError("Файл пуст")
+    columns = _columns(list(first[1]))
+
+    def json_rows():
+        for line_no, record in chain([first], lines):
+            if record.keys() != set(columns):
+                raise ValueError(f"Строка {line_no}: набор полей отличается от первой строки")
+            yield tuple(_value(column, record[column], line_no) for column in columns)
+
+    return columns, json_rows()
+
+def validate_file(path: str, fmt: str) -> int:
+    """Полная проверка файла без записи в БД; возвращает количество строк"""
+    with open_text(path, "r") as f:
+        _, rows = read_users(f, fmt)
+        return sum(1 for _ in rows)
+
+async def import_file(path: str, fmt: str, batch_size: int = USER_TRANSFER_BATCH_SIZE, ref: str | None = None) -> int:
+    """Загрузка пользователей из файла; возвращает количество строк.
+
+    Файл сначала проверяется целиком в отдельном потоке, чтобы ошибка в конце
+    файла не оставила половину загрузки в БД.
+    """
+    await asyncio.to_thread(validate_file, path, fmt)
+    await database.flush_stats()
+    count = 0
+    with open_text(path, "r") as f:
+        columns, rows = read_users(f, fmt)
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                count += await database.import_users(columns, batch, ref)
+                batch = []
+        if batch:
+            count += await database.import_users(columns, batch, ref)
+    return count
+
+async def _run(args: argparse.Namespace):
+    fmt = args.format or detect_format(args.path)
+    database.DB_NAME = args.db
+    await database.init_pool(1)
+    try:
+        if args.action == "export":
+            await database.check_db()
+            count = await export_file(args.path, fmt, args.batch_size)
+            print(f"Выгружено пользователей: {count}")
+        else:
+            with database.exclusive_lock():
+                await database.init_db()
+                if database.stats_journal_files():
+                    raise RuntimeError(
+                        "Остались журналы незаписанной статистики после аварийной остановки бота: "
+                        "запустите и штатно остановите бота, затем повторите загрузку"
+                    )
+                count = await import_file(args.path, fmt, args.batch_size, ref="cli")
+            print(f"Загружено пользователей: {count}")
+    finally:
+        await database.close_pool()
+
+def main():
+    parser = argparse.ArgumentParser(description="Выгрузка и загрузка пользователей")
+    parser.add_argument("action", choices=("export", "import"))
+    parser.add_argument("path", help="файл .csv или .jsonl, можно со сжатием .gz")
+    parser.add_argument("--format", choices=FORMATS, help="формат, если он не следует из расширения")
+    parser.add_argument("--batch-size", type=int, default=USER_TRANSFER_BATCH_SIZE, help="строк в одной транзакции")
+    parser.add_argument("--db", default=database.DB_NAME, help="файл базы данных")
+    args = parser.parse_args()
+    try:
+        asyncio.run(_run(args))
+    except (ValueError, RuntimeError) as e:
+        parser.exit(1, f"Ошибка: {e}\n")
+
+if __name__ == "__main__":
+    main()
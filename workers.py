@@ -0,0 +1,203 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import time
+from telegram import Update
+from telegram.ext import Application
+from webhook import UpdateIngestor, STAGE_SECONDS, UPDATES
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Как часто проверять, что процессы-обработчики живы, секунды
+SUPERVISE_INTERVAL = 5
+# Сколько ждать завершения процесса-обработчика при остановке, секунды
+STOP_TIMEOUT = 30
+# Как часто процесс-обработчик отправляет снимок своих метрик приемнику, секунды
+METRICS_PUSH_INTERVAL = 5
+
+WORKER_QUEUE_SIZE_GAUGE = metrics.Gauge("webhook_worker_queue_size", "Обновления в очереди процесса-обработчика", ("worker",))
+
+def shard_key(data: dict) -> int:
+    """Id инициатора обновления (как Update.effective_user) без разбора в объекты.
+
+    Все обновления одного пользователя попадают в один процесс, поэтому там
+    сохраняются их порядок и состояния ConversationHandler.
+    """
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        sender = value.get("from") or value.get("user")
+        if isinstance(sender, dict) and "id" in sender:
+            return sender["id"]
+        chat = value.get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return chat["id"]
+    return 0
+
+def worker_main(worker_id: int, updates, snapshots) -> None:
+    """Точка входа процесса-обработчика"""
+    try:
+        asyncio.run(_run_worker(worker_id, updates, snapshots))
+    except KeyboardInterrupt:
+        pass
+
+async def _push_metrics(worker_id: int, snapshots):
+    while True:
+        await asyncio.sleep(METRICS_PUSH_INTERVAL)
+        try:
+            snapshots.put_nowait((worker_id, metrics.snapshot()))
+        except queue.Full:
+            # Приемник не успевает разбирать снимки, следующий будет свежее
+            pass
+
+async def _run_worker(worker_id: int, updates, snapshots) -> None:
+    # Импорт здесь: при запуске через spawn main уже загружен как __mp_main__
+    import main as bot_main
+
+    async def serve(application: Application):
+        loop = asyncio.get_running_loop()
+        logger.info("Процесс-обработчик %s запущен", worker_id)
+        pusher = asyncio.create_task(_push_metrics(worker_id, snapshots))
+        processor = application.update_processor
+        reserved = False
+        try:
+            while True:
+                # Application сразу забирает обновления из своей очереди в задачи,
+                # поэтому место резервируется в обработчике до чтения следующего
+                # обновления. Пока обработка на пределе, очередь процесса не
+                # читается: она заполняется, и приемник начинает отвечать 503
+                if not reserved:
+                    await processor.reserve()
+                    reserved = True
+                try:
+                    # Ожидание с таймаутом, чтобы поток не зависал при остановке процесса
+                    data = await loop.run_in_executor(None, updates.get, True, 1)
+                except queue.Empty:
+                    continue
+                if data is None:
+                    processor.cancel_reservation()
+                    logger.info("Процесс-обработчик %s остановлен", worker_id)
+                    return
+                try:
+                    update = Update.de_json(data, application.bot)
+                except Exception as e:
+                    # Приемник уже подтвердил обновление, процесс продолжает работу;
+                    # резерв остается за следующим обновлением
+                    UPDATES.inc("invalid")
+                    logger.error("Не удалось разобрать обновление %s: %s", data.get("update_id"), e)
+                    continue
+                application.update_queue.put_nowait(update)
+                reserved = False
+        finally:
+            pusher.cancel()
+
+    await bot_main.run_application(bot_main.build_application(), serve)
+
+class WorkerPool:
+    """Процессы-обработчики, у каждого своя очередь обновлений"""
+
+    def __init__(self, count: int, queue_size: int):
+        self._context = multiprocessing.get_context("spawn")
+        self.queues = [self._context.Queue(queue_size) for _ in range(count)]
+        self.processes: list = [None] * count
+        # Снимки метрик от процессов и последний снимок каждого из них
+        self.snapshots = self._context.Queue(count * 4)
+        self.worker_metrics: dict[int, dict] = {}
+
+    def _spawn(self, worker_id: int):
+        # Номер процесса передается через окружение, чтобы config прочитал его при импорте
+        os.environ["WORKER_ID"] = str(worker_id)
+        try:
+            process = self._context.Process(
+                target=worker_main, args=(worker_id, self.queues[worker_id], self.snapshots), name=f"worker-{worker_id}"
+            )
+            process.start()
+        finally:
+            del os.environ["WORKER_ID"]
+        self.processes[worker_id] = process
+
+    def start(self):
+        for worker_id in range(len(self.queues)):
+            self._spawn(worker_id)
+
+    def submit(self, data: dict) -> bool:
+        """Передача обновления процессу его пользователя; False, если очередь переполнена"""
+        try:
+            self.queues[shard_key(data) % len(self.queues)].put_nowait(data)
+        except queue.Full:
+            return False
+        return True
+
+    def _collect_metrics(self):
+        while True:
+            try:
+                worker_id, snapshot = self.snapshots.get_nowait()
+            except queue.Empty:
+                return
+            self.worker_metrics[worker_id] = snapshot
+
+    async def supervise(self):
+        """Перезапуск упавших процессов-обработчиков и сбор их метрик"""
+        while True:
+            await asyncio.sleep(SUPERVISE_INTERVAL)
+            self._collect_metrics()
+            for worker_id, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.error("Процесс-обработчик %s завершился с кодом %s, перезапуск", worker_id, process.exitcode)
+                    self._spawn(worker_id)
+
+    async def stop(self):
+        """Остановка процессов после обработки уже принятых обновлений"""
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for updates in self.queues:
+            try:
+                await loop.run_in_executor(None, updates.put, None, True, max(0, deadline - time.monotonic()))
+            except queue.Full:
+                # Процесс уже не разбирает очередь, он будет завершен принудительно
+                pass
+        for worker_id, process in enumerate(self.processes):
+            await loop.run_in_executor(None, process.join, max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning("Процесс-обработчик %s не остановился вовремя, завершаем принудительно", worker_id)
+                process.terminate()
+                process.join()
+        for updates in self.queues + [self.snapshots]:
+            # Необработанные остатки не нужны, не ждем их передачи при выходе
+            updates.cancel_join_thread()
+
+    def queue_sizes(self) -> list[int | None]:
+        sizes = []
+        for updates in self.queues:
+            try:
+                sizes.append(updates.qsize())
+            except NotImplementedError:
+                # qsize недоступен на macOS
+                sizes.append(None)
+        return sizes
+
+class ShardedUpdateIngestor(UpdateIngestor):
+    """Прием вебхуков с передачей обновлений процессам-обработчикам"""
+
+    def __init__(self, pool: WorkerPool):
+        super().__init__(None)
+        self.pool = pool
+        metrics.add_collector(self._collect_queue_sizes)
+
+    def dispatch(self, data: dict) -> bool:
+        started = time.perf_counter()
+        if not self.pool.submit(data):
+            return False
+        STAGE_SECONDS.observe(time.perf_counter() - started, "enqueue")
+        return True
+
+    def _collect_queue_sizes(self):
+        for worker_id, size in enumerate(self.pool.queue_sizes()):
+            if size is not None:
+                WORKER_QUEUE_SIZE_GAUGE.set(size, str(worker_id))
+
+    def metric_sources(self) -> list[tuple[dict, dict]]:
+        return [({"worker": str(worker_id)}, snapshot) for worker_id, snapshot in sorted(self.pool.worker_metrics.items())]